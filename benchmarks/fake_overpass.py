@@ -0,0 +1,129 @@
+import re
+import json
+import time
+import threading
+import numpy as np
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from sklearn.neighbors import BallTree
+from typing import Dict, List
+from src.pipeline.proximity import EARTH_RADIUS_M
+
+BBOX_PATTERN = re.compile(r"\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\);")
+AROUND_PATTERN = re.compile(r"\(around:([\d.]+),([-\d.]+),([-\d.]+)\)")
+
+
+class FakeOverpassServer:
+    """
+    Local stand-in for the Overpass API serving a fixed set of elements. It
+    understands the bbox and around clauses of the queries this repo builds
+    (category filters are ignored, every element is one of the POI
+    categories), so the fetch stage can be benchmarked without the network.
+
+    Usage:
+        with FakeOverpassServer(elements) as server:
+            OverPassAPI(overpass_url=server.url, ...)
+    """
+
+    def __init__(
+        self,
+        elements: List[Dict],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_s: float = 0.0,
+    ):
+        self.elements = elements
+        self.latency_s = latency_s
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+        coordinates = np.array(
+            [
+                (
+                    e.get("lat", e.get("center", {}).get("lat")),
+                    e.get("lon", e.get("center", {}).get("lon")),
+                )
+                for e in elements
+            ],
+            dtype=float,
+        ).reshape(-1, 2)
+        self.lat = coordinates[:, 0]
+        self.lon = coordinates[:, 1]
+        self.tree = (
+            BallTree(np.radians(coordinates), metric="haversine")
+            if len(elements)
+            else None
+        )
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api/interpreter"
+
+    def answer(self, query: str) -> List[Dict]:
+        if self.tree is None:
+            return []
+
+        matched = np.zeros(len(self.elements), dtype=bool)
+        for min_lat, min_lon, max_lat, max_lon in set(BBOX_PATTERN.findall(query)):
+            matched |= (
+                (self.lat >= float(min_lat))
+                & (self.lat <= float(max_lat))
+                & (self.lon >= float(min_lon))
+                & (self.lon <= float(max_lon))
+            )
+
+        arounds = sorted(set(AROUND_PATTERN.findall(query)))
+        if arounds:
+            radius, lat, lon = np.array(arounds, dtype=float).T
+            for indices in self.tree.query_radius(
+                np.radians(np.column_stack([lat, lon])), r=radius / EARTH_RADIUS_M
+            ):
+                matched[indices] = True
+
+        return [self.elements[i] for i in np.flatnonzero(matched)]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                query = parse_qs(self.rfile.read(length).decode())["data"][0]
+                with server.lock:
+                    server.num_requests += 1
+                if server.latency_s:
+                    time.sleep(server.latency_s)
+
+                body = json.dumps({"elements": server.answer(query)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self) -> "FakeOverpassServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FakeOverpassServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,654 @@
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmarks.synthetic import (
+    generate_sites,
+    generate_pois,
+    change_pois,
+    write_raw_shards,
+)
+from benchmarks.fake_overpass import FakeOverpassServer
+from src.etl import clean_site_data, extract_poi_data, ENRICHED_SITES_FILE_NAME
+from src.pipeline.cluster_pois import ClustesSites
+from src.pipeline.poi_api import OverPassAPI
+from src.pipeline.enrich_sites import EnrichSites
+from src.pipeline.transforms import (
+    read_raw_data,
+    prepare_poi_data,
+    prepare_site_data,
+    compute_distance_between_pois_sites,
+    POI_CATEGORIES,
+)
+
+STAGES = ["clean", "cluster", "fetch", "read_raw", "proximity", "enrich"]
+
+STAGE_DEPENDENCIES = {
+    "clean": [],
+    "cluster": ["clean"],
+    "fetch": ["cluster"],
+    "read_raw": [],
+    "proximity": ["clean", "read_raw"],
+    "enrich": ["proximity"],
+}
+
+## Startup of the CLI, every statement runs in a fresh interpreter: parsing
+## the arguments, the imports of a gold-only run (`run_pipeline.py enrich`)
+## and the imports of every stage
+STARTUP_CASES = {
+    "cli": "import run_pipeline; run_pipeline.build_parser()",
+    "enrich": "import run_pipeline; from src.etl import run_staged_pipeline",
+    "all": (
+        "import run_pipeline, src.etl, src.pipeline.poi_store, "
+        "src.pipeline.cluster_pois, src.pipeline.proximity, src.pipeline.ring_features; "
+        "src.pipeline.proximity.POIProximityIndex(src.etl.pd.DataFrame(columns=['lat', 'lon'])); "
+        "src.pipeline.ring_features.POIRingIndex({})"
+    ),
+}
+## Modules that take seconds to import, only the stages that use them may
+## import them
+LAZY_MODULES = ["hdbscan", "sklearn", "scipy.spatial", "requests", "tqdm"]
+## Startup cases that must not import any of `LAZY_MODULES`
+LAZY_STARTUP_CASES = ["cli", "enrich"]
+
+
+def measure(func: Callable, repeat: int = 1, trace_memory: bool = True) -> Dict:
+    """
+    Times `repeat` runs of `func` and, in one extra run under tracemalloc,
+    records the peak memory allocated while it runs. Timing and tracing are
+    kept apart because tracing slows the Python parts down.
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+
+    metrics = {
+        "wall_s": min(timings),
+        "wall_s_runs": [round(t, 6) for t in timings],
+    }
+
+    if trace_memory:
+        result = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        metrics["peak_mb"] = round(peak / 1024 / 1024, 3)
+
+    return result, metrics
+
+
+def measure_startup(statement: str, repeat: int = 1) -> Dict:
+    """
+    Wall time of `statement` in a fresh interpreter started in the repository
+    root, the fastest of `repeat` runs, and which of `LAZY_MODULES` it
+    imported.
+    """
+    script = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))"
+    )
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=repo_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        wall_s, modules = json.loads(output.strip().splitlines()[-1])
+        timings.append(wall_s)
+
+    return {
+        "wall_s": min(timings),
+        "wall_s_runs": [round(t, 6) for t in timings],
+        "lazy_modules": [module for module in LAZY_MODULES if module in modules],
+    }
+
+
+class BenchmarkCase:
+    """
+    Synthetic data of one size and the stages of the pipeline run on it.
+    Every stage returns the number of input rows and a function doing the
+    measured work; the inputs a stage needs are built by its dependencies,
+    which run unmeasured when they were not selected.
+    """
+
+    def __init__(
+        self,
+        num_sites: int,
+        work_dir: str,
+        pois_per_site: float = 1.5,
+        seed: int = 0,
+        eps_km: float = 0.25,
+        min_sample_size: int = 7,
+        min_samples: int = 3,
+        fetch_workers: int = 4,
+        around_batch_size: int = 25,
+        read_workers: int = 1,
+    ):
+        self.num_sites = num_sites
+        self.eps_km = eps_km
+        self.min_sample_size = min_sample_size
+        self.min_samples = min_samples
+        self.fetch_workers = fetch_workers
+        self.around_batch_size = around_batch_size
+        self.read_workers = read_workers
+
+        start = time.perf_counter()
+        self.site_df = generate_sites(num_sites, seed=seed)
+        self.elements = generate_pois(
+            self.site_df, num_pois=int(num_sites * pois_per_site), seed=seed
+        )
+        self.raw_file_paths = write_raw_shards(
+            self.elements, output_dir=os.path.join(work_dir, f"raw_{num_sites}")
+        )
+        print(
+            f"(Benchmark): Generated {num_sites} sites and {len(self.elements)} POIs "
+            f"in {time.perf_counter() - start:.1f}s."
+        )
+        self.outputs = {}
+
+    def clean(self) -> Tuple[int, Callable]:
+        return len(self.site_df), lambda: clean_site_data(self.site_df.copy())
+
+    def cluster(self) -> Tuple[int, Callable]:
+        site_df = self.outputs["clean"]
+        coords_rad = np.radians(site_df[["lat", "lon"]].to_numpy())
+
+        def run():
+            clusterer = ClustesSites(
+                eps_km=self.eps_km,
+                min_sample_size=self.min_sample_size,
+                min_samples=self.min_samples,
+            )
+            return site_df.assign(cluster=clusterer.predict_clusters(coords_rad))
+
+        return len(site_df), run
+
+    def fetch(self) -> Tuple[int, Callable]:
+        site_df = self.outputs["cluster"]
+
+        def run():
+            with FakeOverpassServer(self.elements) as server:
+                overpass_api = OverPassAPI(
+                    overpass_url=server.url,
+                    max_workers=self.fetch_workers,
+                    requests_per_second=1e6,
+                    burst=self.fetch_workers,
+                )
+                return extract_poi_data(
+                    site_df=site_df,
+                    overpass_api=overpass_api,
+                    around_batch_size=self.around_batch_size,
+                )
+
+        return len(site_df), run
+
+    def read_raw(self) -> Tuple[int, Callable]:
+        def run():
+            poi_dfs = read_raw_data(
+                poi_json_file_paths=self.raw_file_paths,
+                max_workers=self.read_workers,
+            )
+            return {
+                category: prepare_poi_data(df=poi_df)
+                for category, poi_df in zip(POI_CATEGORIES, poi_dfs)
+            }
+
+        return len(self.elements), run
+
+    def proximity(self) -> Tuple[int, Callable]:
+        site_df = prepare_site_data(site_df=self.outputs["clean"])
+        all_poi_data = pd.concat(
+            [
+                poi_df[["poi_id", "lat", "lon", "category"]]
+                for poi_df in self.outputs["read_raw"].values()
+            ],
+            ignore_index=True,
+        )
+        self.outputs["site_staging"] = site_df
+
+        return len(site_df), lambda: compute_distance_between_pois_sites(
+            all_poi_data=all_poi_data, site_data=site_df
+        )
+
+    def enrich(self) -> Tuple[int, Callable]:
+        poi_dfs = self.outputs["read_raw"]
+
+        def run():
+            return EnrichSites(
+                site_data_path=self.outputs["site_staging"],
+                fast_food_data_path=poi_dfs["fast_food"],
+                supermarket_data_path=poi_dfs["supermarket"],
+                fuel_data_path=poi_dfs["fuel"],
+                proximity_data_path=self.outputs["proximity"],
+            ).enirch_site_data_with_features()
+
+        return len(self.outputs["site_staging"]), run
+
+    def run_stage(
+        self, stage: str, selected: List[str], repeat: int, trace_memory: bool
+    ) -> List[Dict]:
+        if stage in self.outputs:
+            return []
+
+        results = []
+        for dependency in STAGE_DEPENDENCIES[stage]:
+            results += self.run_stage(dependency, selected, repeat, trace_memory)
+
+        rows, func = getattr(self, stage)()
+        if stage not in selected:
+            self.outputs[stage] = func()
+            return results
+
+        self.outputs[stage], metrics = measure(
+            func, repeat=repeat, trace_memory=trace_memory
+        )
+        metrics.update(
+            size=self.num_sites,
+            stage=stage,
+            rows=rows,
+            rows_per_s=round(rows / metrics["wall_s"], 1) if metrics["wall_s"] else None,
+        )
+        print(
+            f"(Benchmark): size={self.num_sites} stage={stage} wall={metrics['wall_s']:.3f}s "
+            f"peak={metrics.get('peak_mb', '-')}MB rows/s={metrics['rows_per_s']}"
+        )
+        return results + [metrics]
+
+
+def check_incremental(
+    num_sites: int,
+    work_dir: str,
+    pois_per_site: float = 1.5,
+    seed: int = 0,
+    changed_share: float = 0.05,
+    fetch_workers: int = 4,
+) -> Dict:
+    """
+    Runs `run_pipeline.py --incremental` on a site file, and then on a copy
+    with `changed_share` of the sites added, deleted and moved against POIs
+    that changed around the added and moved sites (see `change_pois`). Runs
+    the full pipeline on the second file and POIs, and compares the two gold
+    marts on every column (the ring features included).
+
+    Returns:
+        The wall time of the incremental and of the full run, the number of
+        sites whose rows differ (sites only in one mart count as well) and
+        the columns that differ.
+    """
+    rng = np.random.default_rng(seed)
+    site_df = generate_sites(num_sites, seed=seed)
+    elements = generate_pois(site_df, num_pois=int(num_sites * pois_per_site), seed=seed)
+
+    num_changed = max(1, int(num_sites * changed_share))
+    first_df = site_df.iloc[num_changed:]
+    second_df = site_df.drop(index=site_df.index[num_changed : 2 * num_changed]).copy()
+    moved = rng.choice(second_df.index[num_changed:], size=2 * num_changed, replace=False)
+    second_df.loc[moved, "geoCoordinates"] = (
+        second_df.loc[moved[::-1], "geoCoordinates"].to_numpy()
+    )
+    is_changed = second_df.index.isin(site_df.index[:num_changed]) | second_df.index.isin(
+        moved
+    )
+    changed_elements = change_pois(
+        elements,
+        changed_site_df=second_df[is_changed],
+        unchanged_site_df=second_df[~is_changed],
+        seed=seed,
+    )
+
+    check_dir = os.path.join(work_dir, f"incremental_{num_sites}")
+    for name, df in [("first", first_df), ("second", second_df)]:
+        os.makedirs(os.path.join(check_dir, name), exist_ok=True)
+        df.to_csv(os.path.join(check_dir, f"{name}.csv"), index=False)
+    os.makedirs(os.path.join(check_dir, "full"), exist_ok=True)
+
+    script = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "run_pipeline.py"
+    )
+
+    def run(server: FakeOverpassServer, run_dir: str, site_file: str, *flags: str) -> float:
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                sys.executable,
+                script,
+                "--site_df_path",
+                os.path.join(check_dir, site_file),
+                "--overpass_url",
+                server.url,
+                "--requests_per_second",
+                "1000000",
+                "--fetch_workers",
+                str(fetch_workers),
+                "--cache_mode",
+                "refresh",
+                "--cache_dir",
+                "./cache",
+                "--output_dir",
+                "./staging",
+                "--enriched_dataset_save_path",
+                "./mart",
+                *flags,
+            ],
+            cwd=os.path.join(check_dir, run_dir),
+            capture_output=True,
+            check=True,
+        )
+        return time.perf_counter() - start
+
+    with FakeOverpassServer(elements) as server:
+        run(server, "first", "first.csv", "--incremental")
+    with FakeOverpassServer(changed_elements) as server:
+        incremental_s = run(server, "first", "second.csv", "--incremental")
+        full_s = run(server, "full", "second.csv")
+
+    marts = [
+        pd.read_csv(os.path.join(check_dir, run_dir, "mart", ENRICHED_SITES_FILE_NAME))
+        .sort_values("site_id")
+        .set_index("site_id")
+        for run_dir in ["first", "full"]
+    ]
+    differing = set(marts[0].index).symmetric_difference(marts[1].index)
+    differing_columns = sorted(
+        set(marts[0].columns).symmetric_difference(marts[1].columns)
+    )
+    if differing_columns:
+        differing |= set(marts[0].index) | set(marts[1].index)
+    else:
+        incremental_df, full_df = (
+            mart.loc[mart.index.intersection(marts[1 - i].index)]
+            for i, mart in enumerate(marts)
+        )
+        same = (incremental_df == full_df) | (incremental_df.isna() & full_df.isna())
+        differing |= set(incremental_df.index[~same.all(axis=1)])
+        differing_columns = list(same.columns[~same.all(axis=0)])
+
+    return {
+        "wall_s": incremental_s,
+        "full_wall_s": round(full_s, 6),
+        "changed_sites": 3 * num_changed,
+        "changed_pois": len(
+            set(map(json.dumps, elements)).symmetric_difference(
+                map(json.dumps, changed_elements)
+            )
+        ),
+        "differing_sites": len(differing),
+        "differing_columns": differing_columns,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results: Dict, baseline: Dict, threshold: float) -> bool:
+    """
+    Prints the wall time and peak memory of every (size, stage) against a
+    baseline results file.
+
+    Returns:
+        bool: True when a stage got slower than the baseline by more than
+              `threshold` (0.2 = 20%).
+    """
+    baseline_by_key = {
+        (row["size"], row["stage"]): row for row in baseline["results"]
+    }
+    regressed = False
+
+    print(
+        f"\nCompared with {baseline['meta'].get('git_commit')} "
+        f"(threshold {threshold:.0%}):"
+    )
+    for row in results["results"]:
+        base = baseline_by_key.get((row["size"], row["stage"]))
+        if base is None:
+            continue
+        ratio = row["wall_s"] / base["wall_s"] if base["wall_s"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        memory = ""
+        if "peak_mb" in row and "peak_mb" in base:
+            memory = f"  peak {base['peak_mb']:.1f} -> {row['peak_mb']:.1f} MB"
+        print(
+            f"  {row['stage']:>10} size={row['size']:<8} "
+            f"{base['wall_s']:.3f}s -> {row['wall_s']:.3f}s ({ratio:.2f}x){memory}{flag}"
+        )
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic data."
+    )
+
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Numbers of sites to generate, one benchmark case per size.",
+    )
+
+    parser.add_argument(
+        "--stages",
+        type=str,
+        nargs="+",
+        choices=STAGES,
+        default=STAGES,
+        help="Stages to measure, the stages they depend on still run unmeasured.",
+    )
+
+    parser.add_argument(
+        "--pois_per_site",
+        type=float,
+        default=1.5,
+        help="Number of generated POIs per site.",
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Number of timed runs per stage, the fastest one is reported.",
+    )
+
+    parser.add_argument(
+        "--skip_memory",
+        action="store_true",
+        help="Do not run the stages again under tracemalloc to record peak memory.",
+    )
+
+    parser.add_argument(
+        "--skip_startup",
+        action="store_true",
+        help="Do not measure the startup of the CLI (stages 'startup_<case>', size 0).",
+    )
+
+    parser.add_argument(
+        "--fetch_workers",
+        type=int,
+        default=4,
+        help="Number of concurrent requests to the fake Overpass server.",
+    )
+
+    parser.add_argument(
+        "--read_workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse the raw POI files.",
+    )
+
+    parser.add_argument(
+        "--skip_incremental_check",
+        action="store_true",
+        help=(
+            "Do not compare the gold mart of an incremental run against a full run "
+            "on the smallest size (stage 'incremental_check')."
+        ),
+    )
+
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator.")
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="./data/benchmarks/results.json",
+        help="Path of the JSON results file.",
+    )
+
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Results file of an earlier commit to compare against.",
+    )
+
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Slowdown against '--compare' that counts as a regression (0.2 = 20%%).",
+    )
+
+    args = parser.parse_args()
+
+    ## The stages log every step, keep the output to the measurements
+    logging.disable(logging.CRITICAL)
+
+    results = []
+    eager_cases = []
+    if not args.skip_startup:
+        for name, statement in STARTUP_CASES.items():
+            metrics = measure_startup(statement, repeat=args.repeat)
+            metrics.update(size=0, stage=f"startup_{name}", rows=None, rows_per_s=None)
+            print(
+                f"(Benchmark): startup={name} wall={metrics['wall_s']:.3f}s "
+                f"lazy_modules={metrics['lazy_modules']}"
+            )
+            if name in LAZY_STARTUP_CASES and metrics["lazy_modules"]:
+                eager_cases.append(name)
+            results.append(metrics)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in args.sizes:
+            case = BenchmarkCase(
+                num_sites=size,
+                work_dir=work_dir,
+                pois_per_site=args.pois_per_site,
+                seed=args.seed,
+                fetch_workers=args.fetch_workers,
+                read_workers=args.read_workers,
+            )
+            for stage in STAGES:
+                results += case.run_stage(
+                    stage,
+                    selected=args.stages,
+                    repeat=args.repeat,
+                    trace_memory=not args.skip_memory,
+                )
+            del case
+            gc.collect()
+
+        mismatch = None
+        if not args.skip_incremental_check:
+            size = min(args.sizes)
+            metrics = check_incremental(
+                num_sites=size,
+                work_dir=work_dir,
+                pois_per_site=args.pois_per_site,
+                seed=args.seed,
+                fetch_workers=args.fetch_workers,
+            )
+            metrics.update(size=size, stage="incremental_check", rows=size, rows_per_s=None)
+            print(
+                f"(Benchmark): size={size} incremental={metrics['wall_s']:.3f}s "
+                f"full={metrics['full_wall_s']:.3f}s "
+                f"differing_sites={metrics['differing_sites']} "
+                f"differing_columns={metrics['differing_columns']}"
+            )
+            if metrics["differing_sites"]:
+                mismatch = metrics
+            results.append(metrics)
+
+    results = {
+        "meta": {
+            "git_commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "seed": args.seed,
+            "pois_per_site": args.pois_per_site,
+            "repeat": args.repeat,
+            "max_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+        },
+        "results": results,
+    }
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Benchmark results saved here: {args.output}")
+
+    regressed = False
+    if eager_cases:
+        print(
+            f"\nStartup {eager_cases} imported modules that should only be "
+            f"imported by the stages using them, see LAZY_MODULES."
+        )
+        regressed = True
+
+    if mismatch:
+        print(
+            f"\nThe gold mart of the incremental run differs from the full run on "
+            f"{mismatch['differing_sites']} of {mismatch['size']} sites."
+        )
+        regressed = True
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        regressed = compare_results(results, baseline, threshold=args.threshold) or regressed
+
+    if regressed:
+        sys.exit(1)
@@ -0,0 +1,339 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+from src.pipeline.raw_store import RawShardWriter
+from src.pipeline.validation import GERMANY_BOUNDS
+
+## (locality, state, lat, lon, share of the urban sites, spread in km)
+CITIES = [
+    ("Berlin", "Berlin", 52.5200, 13.4050, 0.20, 9.0),
+    ("Hamburg", "Hamburg", 53.5511, 9.9937, 0.13, 7.0),
+    ("München", "Bayern", 48.1351, 11.5820, 0.11, 6.0),
+    ("Köln", "Nordrhein-Westfalen", 50.9375, 6.9603, 0.08, 5.0),
+    ("Frankfurt am Main", "Hessen", 50.1109, 8.6821, 0.07, 4.5),
+    ("Stuttgart", "Baden-Württemberg", 48.7758, 9.1829, 0.06, 4.0),
+    ("Düsseldorf", "Nordrhein-Westfalen", 51.2277, 6.7735, 0.05, 3.5),
+    ("Leipzig", "Sachsen", 51.3397, 12.3731, 0.05, 4.0),
+    ("Dortmund", "Nordrhein-Westfalen", 51.5136, 7.4653, 0.05, 4.0),
+    ("Essen", "Nordrhein-Westfalen", 51.4556, 7.0116, 0.04, 3.5),
+    ("Bremen", "Bremen", 53.0793, 8.8017, 0.04, 4.0),
+    ("Dresden", "Sachsen", 51.0504, 13.7373, 0.04, 4.0),
+    ("Hannover", "Niedersachsen", 52.3759, 9.7320, 0.04, 4.0),
+    ("Nürnberg", "Bayern", 49.4521, 11.0767, 0.04, 3.5),
+]
+
+OPERATORS = [
+    ("DEHHM", "Hamburger Energiewerke"),
+    ("DEEBW", "EnBW"),
+    ("DEION", "IONITY"),
+    ("DEALL", "Allego"),
+    ("DETES", "Tesla"),
+]
+
+## (category, key, value, share of the POIs)
+POI_KINDS = [
+    ("fast_food", "amenity", "fast_food", 0.45),
+    ("supermarket", "shop", "supermarket", 0.25),
+    ("supermarket", "shop", "convenience", 0.10),
+    ("fuel", "amenity", "fuel", 0.20),
+]
+
+BRANDS = {
+    "fast_food": ["McDonald's", "Burger King", "Subway", "KFC", "Dönerladen", None],
+    "supermarket": ["REWE", "EDEKA", "Lidl", "Aldi Süd", "Netto", "Penny", None],
+    "fuel": ["Aral", "Shell", "Esso", "TotalEnergies", "JET", None],
+}
+
+OPENING_HOURS = [
+    "Mo-Sa 08:00-20:00",
+    "Mo-Fr 07:00-22:00; Sa 08:00-22:00",
+    "24/7",
+    "Mo-Su 00:00-24:00",
+    "Mo-Su 10:00-23:00",
+    None,
+]
+
+URBAN_SHARE = 0.8
+DIRTY_SHARE = 0.005
+NEAR_SITE_POI_SHARE = 0.7
+WAY_SHARE = 0.25
+KM_PER_DEGREE = 111.32
+
+
+def _random_tokens(rng: np.random.Generator, num: int, length: int = 43) -> np.ndarray:
+    alphabet = np.array(
+        list("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_")
+    )
+    return np.array(
+        ["".join(chars) for chars in rng.choice(alphabet, size=(num, length))]
+    )
+
+
+def _scatter(
+    rng: np.random.Generator, lat: np.ndarray, lon: np.ndarray, spread_km: np.ndarray
+):
+    lat = lat + rng.normal(0, 1, len(lat)) * spread_km / KM_PER_DEGREE
+    lon = lon + rng.normal(0, 1, len(lon)) * spread_km / (
+        KM_PER_DEGREE * np.cos(np.radians(lat))
+    )
+    return lat, lon
+
+
+def generate_sites(num_sites: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Generates a site file with the columns of the real one. Most sites sit in
+    dense clusters around the large German cities, the rest are scattered
+    uniformly over the country, and a few rows have broken or foreign
+    coordinates so the cleaning is exercised as well.
+    """
+    rng = np.random.default_rng(seed)
+    num_urban = int(num_sites * URBAN_SHARE)
+
+    city_shares = np.array([city[4] for city in CITIES])
+    city_idx = rng.choice(len(CITIES), size=num_urban, p=city_shares / city_shares.sum())
+    city_lat = np.array([city[2] for city in CITIES])[city_idx]
+    city_lon = np.array([city[3] for city in CITIES])[city_idx]
+    city_spread = np.array([city[5] for city in CITIES])[city_idx]
+    urban_lat, urban_lon = _scatter(rng, city_lat, city_lon, city_spread)
+
+    num_rural = num_sites - num_urban
+    rural_lat = rng.uniform(
+        GERMANY_BOUNDS["lat_min"], GERMANY_BOUNDS["lat_max"], num_rural
+    )
+    rural_lon = rng.uniform(
+        GERMANY_BOUNDS["lon_min"], GERMANY_BOUNDS["lon_max"], num_rural
+    )
+
+    lat = np.concatenate([urban_lat, rural_lat])
+    lon = np.concatenate([urban_lon, rural_lon])
+    locality = np.concatenate(
+        [np.array([city[0] for city in CITIES])[city_idx], np.full(num_rural, "Landkreis")]
+    )
+    state = np.concatenate(
+        [np.array([city[1] for city in CITIES])[city_idx], np.full(num_rural, "Niedersachsen")]
+    )
+    operator_idx = rng.integers(0, len(OPERATORS), num_sites)
+
+    geo_coordinates = pd.Series(
+        [f"[{x:.6f},{y:.6f}]" for x, y in zip(lon, lat)], dtype=object
+    )
+    dirty = rng.random(num_sites) < DIRTY_SHARE
+    geo_coordinates[dirty] = rng.choice(
+        ["[2.3522,48.8566]", "[,]", "nan", "[91.0,200.0]"], size=int(dirty.sum())
+    )
+
+    site_df = pd.DataFrame(
+        {
+            "id": _random_tokens(rng, num_sites),
+            "locality": locality,
+            "postalCode": rng.integers(1067, 99998, num_sites),
+            "state": state,
+            "streetAddress": [f"Teststraße {n}" for n in rng.integers(1, 200, num_sites)],
+            "geoCoordinates": geo_coordinates,
+            "operatorId": np.array([op[0] for op in OPERATORS])[operator_idx],
+            "operatorName": np.array([op[1] for op in OPERATORS])[operator_idx],
+        }
+    )
+    return site_df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def _site_coordinates(site_df: pd.DataFrame):
+    ## Coordinates of the sites with valid coordinates in Germany
+    coordinates = site_df["geoCoordinates"].str.strip("[]").str.split(",", expand=True)
+    site_lon = pd.to_numeric(coordinates[0], errors="coerce").to_numpy()
+    site_lat = pd.to_numeric(coordinates[1], errors="coerce").to_numpy()
+    valid = (
+        (site_lat >= GERMANY_BOUNDS["lat_min"])
+        & (site_lat <= GERMANY_BOUNDS["lat_max"])
+        & (site_lon >= GERMANY_BOUNDS["lon_min"])
+        & (site_lon <= GERMANY_BOUNDS["lon_max"])
+    )
+    return site_lat[valid], site_lon[valid]
+
+
+def _offset(lat: float, lon: float, north_m: float, east_m: float):
+    return (
+        round(lat + north_m / (KM_PER_DEGREE * 1000), 7),
+        round(lon + east_m / (KM_PER_DEGREE * 1000 * np.cos(np.radians(lat))), 7),
+    )
+
+
+def _distances_m(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray):
+    ## Equirectangular distances, close enough over a few kilometers
+    north_m = (lats - lat) * KM_PER_DEGREE * 1000
+    east_m = (lons - lon) * KM_PER_DEGREE * 1000 * np.cos(np.radians(lat))
+    return north_m, east_m, np.hypot(north_m, east_m)
+
+
+def change_pois(
+    elements: List[Dict],
+    changed_site_df: pd.DataFrame,
+    unchanged_site_df: pd.DataFrame,
+    seed: int = 0,
+    start_id: int = 2 * 10**8,
+) -> List[Dict]:
+    """
+    A later version of `elements` in which the POIs around the sites of
+    `changed_site_df` changed, as an incremental run sees them when it
+    fetches around those sites. Around every changed site:
+    - a POI is added 300 m from the nearest unchanged site within 700 m, so
+      it is inside a larger ring of that site but outside its 100 m ring
+    - a POI within 500 m is moved by 150 m
+    - a POI within 500 m gets other tags
+    - a POI within 500 m is deleted
+    """
+    rng = np.random.default_rng(seed + 2)
+    elements = [
+        {key: dict(value) if isinstance(value, dict) else value for key, value in e.items()}
+        for e in elements
+    ]
+    site_lat, site_lon = _site_coordinates(changed_site_df)
+    unchanged_lat, unchanged_lon = _site_coordinates(unchanged_site_df)
+
+    def location(element):
+        return element.get("center", element)
+
+    deleted = set()
+    added = []
+    for lat, lon in zip(site_lat, site_lon):
+        north_m, east_m, distance_m = _distances_m(lat, lon, unchanged_lat, unchanged_lon)
+        candidates = np.flatnonzero((distance_m > 0) & (distance_m <= 700))
+        if len(candidates):
+            nearest = candidates[np.argmin(distance_m[candidates])]
+            ## 300 m from the unchanged site, towards the changed one
+            scale = 300 / distance_m[nearest]
+            poi_lat, poi_lon = _offset(
+                unchanged_lat[nearest],
+                unchanged_lon[nearest],
+                -north_m[nearest] * scale,
+                -east_m[nearest] * scale,
+            )
+            category, key, value, _ = POI_KINDS[rng.integers(len(POI_KINDS))]
+            added.append(
+                {
+                    "type": "node",
+                    "id": int(start_id + len(added)),
+                    "lat": poi_lat,
+                    "lon": poi_lon,
+                    "tags": _poi_tags(rng, category, key, value),
+                }
+            )
+
+        poi_lat = np.array([location(e)["lat"] for e in elements])
+        poi_lon = np.array([location(e)["lon"] for e in elements])
+        near = [
+            i
+            for i in np.flatnonzero(_distances_m(lat, lon, poi_lat, poi_lon)[2] <= 500)
+            if i not in deleted
+        ]
+        if len(near) < 3:
+            continue
+        moved, retagged, removed = rng.choice(near, size=3, replace=False)
+
+        bearing = rng.uniform(0, 2 * np.pi)
+        point = location(elements[moved])
+        point["lat"], point["lon"] = _offset(
+            point["lat"], point["lon"], 150 * np.cos(bearing), 150 * np.sin(bearing)
+        )
+        tags = elements[retagged]["tags"]
+        tags["name"] = f"{tags['name']} (renamed)"
+        tags["wheelchair"] = "no" if tags.get("wheelchair") == "yes" else "yes"
+        deleted.add(removed)
+
+    return [e for i, e in enumerate(elements) if i not in deleted] + added
+
+
+def _poi_tags(rng: np.random.Generator, category: str, key: str, value: str) -> Dict:
+    tags = {key: value, "name": f"{value.title()} {rng.integers(1, 10**6)}"}
+
+    brand = BRANDS[category][rng.integers(len(BRANDS[category]))]
+    if brand is not None:
+        tags["brand"] = brand
+        tags["brand:wikidata"] = f"Q{rng.integers(10**5, 10**8)}"
+    opening_hours = OPENING_HOURS[rng.integers(len(OPENING_HOURS))]
+    if opening_hours is not None:
+        tags["opening_hours"] = opening_hours
+
+    for tag, values in [
+        ("toilets", ["yes", "no"]),
+        ("internet_access", ["wlan", "no", "yes"]),
+        ("wifi", ["yes", "no"]),
+        ("indoor_seating", ["yes", "no"]),
+        ("outdoor_seating", ["yes", "no"]),
+        ("wheelchair", ["yes", "limited", "no"]),
+    ]:
+        if rng.random() < 0.4:
+            tags[tag] = values[rng.integers(len(values))]
+
+    tags["addr:city"] = "Teststadt"
+    tags["addr:postcode"] = str(rng.integers(1067, 99998))
+    return tags
+
+
+def generate_pois(
+    site_df: pd.DataFrame, num_pois: int, seed: int = 0, start_id: int = 10**8
+) -> List[Dict]:
+    """
+    Generates Overpass elements (nodes and ways with a center) in the shape
+    the API returns them. Most POIs lie within ~150m of a site so that the
+    proximity and enrichment stages find matches, the rest are spread around
+    the cities like the background POIs of a bounding box query.
+    """
+    rng = np.random.default_rng(seed + 1)
+    site_lat, site_lon = _site_coordinates(site_df)
+
+    num_near = int(num_pois * NEAR_SITE_POI_SHARE) if len(site_lat) else 0
+    near_idx = rng.integers(0, max(len(site_lat), 1), num_near)
+    near_lat, near_lon = _scatter(
+        rng, site_lat[near_idx], site_lon[near_idx], np.full(num_near, 0.08)
+    )
+
+    num_far = num_pois - num_near
+    city_idx = rng.integers(0, len(CITIES), num_far)
+    far_lat, far_lon = _scatter(
+        rng,
+        np.array([city[2] for city in CITIES])[city_idx],
+        np.array([city[3] for city in CITIES])[city_idx],
+        np.array([city[5] for city in CITIES])[city_idx] * 1.5,
+    )
+
+    lat = np.concatenate([near_lat, far_lat])
+    lon = np.concatenate([near_lon, far_lon])
+
+    kind_shares = np.array([kind[3] for kind in POI_KINDS])
+    kind_idx = rng.choice(len(POI_KINDS), size=num_pois, p=kind_shares / kind_shares.sum())
+    is_way = rng.random(num_pois) < WAY_SHARE
+
+    elements = []
+    for i in range(num_pois):
+        category, key, value, _ = POI_KINDS[kind_idx[i]]
+        element = {"type": "way" if is_way[i] else "node", "id": int(start_id + i)}
+        if is_way[i]:
+            element["center"] = {"lat": round(float(lat[i]), 7), "lon": round(float(lon[i]), 7)}
+            element["nodes"] = [int(n) for n in rng.integers(10**9, 10**10, 5)]
+        else:
+            element["lat"] = round(float(lat[i]), 7)
+            element["lon"] = round(float(lon[i]), 7)
+        element["tags"] = _poi_tags(rng, category, key, value)
+        elements.append(element)
+    return elements
+
+
+def write_raw_shards(
+    elements: List[Dict], output_dir: str, elements_per_file: int = 25
+) -> List[str]:
+    """
+    Writes the elements as raw POI responses to raw shards like the bronze
+    layer does, with some elements repeated across responses as overlapping
+    queries return them.
+
+    Returns:
+        List[str]: References of the responses.
+    """
+    refs = []
+    with RawShardWriter(output_dir, reset=True) as raw_writer:
+        for file_id, start in enumerate(range(0, len(elements), elements_per_file)):
+            ## Overlap the previous response by a few elements
+            shard = elements[max(0, start - 3) : start + elements_per_file]
+            refs.append(raw_writer.write(f"cluster_{file_id}", shard))
+    return refs
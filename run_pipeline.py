@@ -1,113 +1,567 @@
 import os
+import sys
 import logging
 logging.getLogger().setLevel(logging.INFO)
 
 import warnings
 warnings.filterwarnings("ignore")
 
-
-from src.etl import run_etl_pipeline
-from src.pipeline.enrich_sites import EnrichSites
 import argparse
+from typing import Dict, List, Optional
+from src.utils.instrumentation import INSTRUMENTATION, span
+from src.pipeline.poi_cache import CACHE_MODES
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Input to run pipeline.")
+## The subcommands import the modules of their stages when they run, so that
+## `--help` and a run of the gold layer alone start without the whole ETL
+## module graph (HDBSCAN, scikit-learn, requests, tqdm)
+COMMANDS = ("fetch", "transform", "enrich", "all")
+## Layer whose stages a subcommand runs, see `LAYER_STAGES` in src/etl.py
+COMMAND_LAYERS = {"fetch": "bronze", "transform": "silver", "enrich": "gold"}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="path where intermediate/staging data should be stored.",
+    )
+
+    common_parser.add_argument(
+        "--stage_workers",
+        type=int,
+        default=2,
+        help="Number of pipeline stages that may run at the same time.",
+    )
+
+    common_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun every stage even if its inputs, parameters and outputs are unchanged.",
+    )
+
+    common_parser.add_argument(
+        "--metrics_dir",
+        type=str,
+        default=None,
+        help="Directory of the run report (run_report.json), the Prometheus textfile (run_metrics.prom) and the profiles (default: output_dir).",
+    )
+
+    common_parser.add_argument(
+        "--profile_stage",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Stages or spans (e.g. 'cluster', 'read_raw_data') to run under cProfile, the stats are saved to <metrics_dir>/profiles/<stage>.prof.",
+    )
+
+    raw_parser = argparse.ArgumentParser(add_help=False)
+    raw_parser.add_argument(
+        "--raw_dir",
+        type=str,
+        default=None,
+        help="path where the raw POI responses should be stored (default: <output_dir>/raw).",
+    )
+
+    raw_parser.add_argument(
+        "--proximity_radius_m",
+        type=float,
+        default=100,
+        help="Radius in meters around a site within which POIs are considered nearby.",
+    )
 
-    parser.add_argument(
+    bronze_parser = argparse.ArgumentParser(add_help=False)
+    bronze_parser.add_argument(
         "--site_df_path",
         type=str,
         required=True,
         help="The directory where output should be stored.",
     )
 
-    parser.add_argument(
-    "--eps_km",
-    type=float,
-    default=0.1,
-    help="(HDBSCAN model) The epsilon value to apply to the algorithm.",
-)
+    bronze_parser.add_argument(
+        "--eps_km",
+        type=float,
+        default=0.1,
+        help="(HDBSCAN model) The epsilon value to apply to the algorithm.",
+    )
 
-    parser.add_argument(
+    bronze_parser.add_argument(
         "--min_sample_size",
         type=int,
         default=5,
         help="(HDBSCAN model) The minimum number of samples a cluster should have to be considered a cluster.",
     )
 
-    parser.add_argument(
+    bronze_parser.add_argument(
         "--min_samples",
         type=int,
         default=4,
         help="(HDBSCAN model) The minimum number of samples the center of a cluster should have to be considered as a center of the cluster.",
     )
 
-    parser.add_argument(
-        "--output_dir",
+    bronze_parser.add_argument(
+        "--overpass_url",
         type=str,
-        required=True,
-        help="path where intermediate/staging data should be stored.",
+        default="https://overpass-api.de/api/interpreter",
+        help="Overpass API endpoint used to query the POIs.",
+    )
+
+    bronze_parser.add_argument(
+        "--poi_store",
+        type=str,
+        default=None,
+        help="Answer the POI queries from a local POI store (built with 'python -m src.pipeline.poi_store') instead of the Overpass API.",
+    )
+
+    bronze_parser.add_argument(
+        "--fetch_workers",
+        type=int,
+        default=2,
+        help="Number of concurrent Overpass requests.",
+    )
+
+    bronze_parser.add_argument(
+        "--requests_per_second",
+        type=float,
+        default=1.0,
+        help="Rate limit applied across all Overpass requests.",
+    )
+
+    bronze_parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=5,
+        help="Number of retries for a failed or rate-limited Overpass request.",
+    )
+
+    bronze_parser.add_argument(
+        "--around_batch_size",
+        type=int,
+        default=1,
+        help="Number of unclustered sites packed into one Overpass around query (1 sends one query per site).",
+    )
+
+    bronze_parser.add_argument(
+        "--query_planner",
+        type=str,
+        choices=("hdbscan", "quadtree"),
+        default="hdbscan",
+        help="How the sites are grouped into Overpass queries: 'hdbscan' clusters (bounding box plus around queries) or 'quadtree' tiles covering every site with the fewest bounding box queries.",
+    )
+
+    bronze_parser.add_argument(
+        "--max_tile_area_km2",
+        type=float,
+        default=25.0,
+        help="(Quadtree planner) Largest area of one bounding box query.",
+    )
+
+    bronze_parser.add_argument(
+        "--request_cost_s",
+        type=float,
+        default=1.0,
+        help="(Quadtree planner) Estimated cost of one Overpass request, in seconds.",
+    )
+
+    bronze_parser.add_argument(
+        "--area_cost_s_per_km2",
+        type=float,
+        default=0.05,
+        help="(Quadtree planner) Estimated cost of querying one square kilometre, in seconds.",
+    )
+
+    bronze_parser.add_argument(
+        "--cache_mode",
+        "--cache-mode",
+        type=str,
+        choices=CACHE_MODES,
+        default="use",
+        help="How the Overpass response cache is used: 'use' reads and fills it, 'refresh' refetches everything, 'offline' never touches the network.",
+    )
+
+    bronze_parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="./data/cache/overpass",
+        help="Directory of the Overpass response cache.",
+    )
+
+    bronze_parser.add_argument(
+        "--cache_ttl_hours",
+        type=float,
+        default=168,
+        help="Age after which a cached Overpass response is fetched again.",
+    )
+
+    bronze_parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=2048,
+        help="Size of the Overpass response cache after which least recently used entries are evicted.",
+    )
+
+    silver_parser = argparse.ArgumentParser(add_help=False)
+    silver_parser.add_argument(
+        "--read_workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse the raw POI files.",
+    )
+
+    silver_parser.add_argument(
+        "--read_chunk_size",
+        type=int,
+        default=512,
+        help="Number of raw POI files parsed per worker task.",
+    )
+
+    category_parser = argparse.ArgumentParser(add_help=False)
+    category_parser.add_argument(
+        "--category_workers",
+        type=int,
+        default=3,
+        help="Number of threads running the per-category branches (fast_food, fuel, supermarket) of the transform and enrich stages and reading their datasets.",
     )
 
-    parser.add_argument(
+    gold_parser = argparse.ArgumentParser(add_help=False)
+    gold_parser.add_argument(
         "--enriched_dataset_save_path",
         type=str,
         required=True,
         help="path where the enriched dataset should be saved",
     )
 
-    args = parser.parse_args()
+    ring_parser = argparse.ArgumentParser(add_help=False)
+    ring_parser.add_argument(
+        "--ring_radii_m",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Radii in meters within which the POIs of every category are counted around each site, the POIs are fetched out to the largest one (default: 100 250 500 1000).",
+    )
+
+    modes_parser = argparse.ArgumentParser(add_help=False)
+    modes_parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Only cluster the sites for every combination of '--sweep_eps_km', '--sweep_min_sample_size' and '--sweep_min_samples' and save the predicted Overpass requests per setting to <output_dir>/cluster_sweep.csv.",
+    )
+
+    modes_parser.add_argument(
+        "--sweep_eps_km",
+        type=float,
+        nargs="+",
+        default=None,
+        help="(Sweep) Epsilon values to try (default: '--eps_km').",
+    )
+
+    modes_parser.add_argument(
+        "--sweep_min_sample_size",
+        type=int,
+        nargs="+",
+        default=None,
+        help="(Sweep) Minimum cluster sizes to try (default: '--min_sample_size').",
+    )
+
+    modes_parser.add_argument(
+        "--sweep_min_samples",
+        type=int,
+        nargs="+",
+        default=None,
+        help="(Sweep) min_samples values to try, HDBSCAN is fitted once per value (default: '--min_samples').",
+    )
+
+    modes_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process sites that are new, moved or deleted since the last run and merge them into the existing outputs.",
+    )
+
+    modes_parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Process the site file in chunks and geographic tiles so that memory stays within '--memory_budget_mb' whatever the input size.",
+    )
+
+    modes_parser.add_argument(
+        "--in_memory",
+        action="store_true",
+        help="Run every stage in this process and hand the staging datasets from the silver to the gold layer in memory, they are persisted in the background.",
+    )
+
+    modes_parser.add_argument(
+        "--no_persist_staging",
+        action="store_true",
+        help="(In memory) Do not write the staging datasets to '--output_dir'.",
+    )
+
+    modes_parser.add_argument(
+        "--memory_budget_mb",
+        type=float,
+        default=1024,
+        help="(Streaming) Memory budget used to size the chunks of the site file.",
+    )
+
+    modes_parser.add_argument(
+        "--tile_deg",
+        type=float,
+        default=0.5,
+        help="(Streaming) Size in degrees of the tiles the sites are partitioned into.",
+    )
+
+    parser = argparse.ArgumentParser(description="Input to run pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "fetch",
+        parents=[common_parser, raw_parser, bronze_parser, ring_parser],
+        help="Bronze layer: clean and cluster the sites and fetch their POIs.",
+    )
+    subparsers.add_parser(
+        "transform",
+        parents=[common_parser, raw_parser, silver_parser, category_parser],
+        help="Silver layer: build the staging datasets from the fetched POIs.",
+    )
+    subparsers.add_parser(
+        "enrich",
+        parents=[common_parser, gold_parser, ring_parser, category_parser],
+        help="Gold layer: enrich the sites from the staging datasets.",
+    )
+    subparsers.add_parser(
+        "all",
+        parents=[
+            common_parser,
+            raw_parser,
+            bronze_parser,
+            silver_parser,
+            category_parser,
+            gold_parser,
+            ring_parser,
+            modes_parser,
+        ],
+        help="Every layer, the default when no subcommand is given.",
+    )
+    return parser
+
+
+def build_overpass_api(args: argparse.Namespace):
+    if args.poi_store:
+        from src.pipeline.poi_store import LocalOverPassAPI
+
+        return LocalOverPassAPI(
+            store_path=args.poi_store, max_workers=args.fetch_workers
+        )
+
+    from src.pipeline.poi_api import OverPassAPI
+    from src.pipeline.poi_cache import OverpassResponseCache
+
+    return OverPassAPI(
+        overpass_url=args.overpass_url,
+        max_workers=args.fetch_workers,
+        requests_per_second=args.requests_per_second,
+        max_retries=args.max_retries,
+        cache=OverpassResponseCache(
+            cache_dir=args.cache_dir,
+            ttl_hours=args.cache_ttl_hours,
+            max_size_mb=args.cache_max_mb,
+            mode=args.cache_mode,
+        ),
+    )
+
+
+def build_query_planner(args: argparse.Namespace):
+    if args.query_planner != "quadtree":
+        return None
+
+    from src.etl import fetch_radius_m
+    from src.pipeline.query_planner import QuadtreeQueryPlanner
+
+    return QuadtreeQueryPlanner(
+        radius_m=fetch_radius_m(args.proximity_radius_m, ring_radii_m(args)),
+        max_tile_area_km2=args.max_tile_area_km2,
+        request_cost_s=args.request_cost_s,
+        area_cost_s_per_km2=args.area_cost_s_per_km2,
+    )
+
+
+def ring_radii_m(args: argparse.Namespace) -> List[float]:
+    from src.pipeline.ring_features import RING_RADII_M
+
+    return args.ring_radii_m or RING_RADII_M
 
-    site_df_path = args.site_df_path
-    output_dir = args.output_dir
-    enriched_dataset_save_path = args.enriched_dataset_save_path
-    eps_km = args.eps_km
-    min_sample_size = args.min_sample_size
-    min_samples = args.min_samples
 
+def build_etl_kwargs(args: argparse.Namespace) -> Dict:
+    """
+    Settings of the ETL stages from the flags of a subcommand. A subcommand
+    only has the flags of the stages it runs, the other settings are None.
+    """
+    def flag(name: str):
+        return getattr(args, name, None)
 
-    if args.eps_km == 0.1:
-        logging.info("No '--eps_km' provided. Using default: 0.0")
+    fetches = hasattr(args, "site_df_path")
+    if fetches:
+        if args.eps_km == 0.1:
+            logging.info("No '--eps_km' provided. Using default: 0.0")
 
-    if args.min_sample_size == 7:
-        logging.info("No '--min_sample_size' provided. Using default: 5")
-    
-        
-    if args.min_samples == 4:
-        logging.info("No '--min_samples' provided. Using default: same as 4")
-       
-    (
-        site_data_file_name,
-        fast_food_poi_df_file_name,
-        fuel_station_poi_df_file_name,
-        supermarket_poi_df_file_name,
-        proximity_data_file_name,
-    ) = run_etl_pipeline(
-        site_df_path=site_df_path,
-        eps_km=eps_km,
-        min_sample_size=min_sample_size,
-        min_samples=min_samples,
-        output_dir=output_dir,
+        if args.min_sample_size == 7:
+            logging.info("No '--min_sample_size' provided. Using default: 5")
+
+        if args.min_samples == 4:
+            logging.info("No '--min_samples' provided. Using default: same as 4")
+
+    return dict(
+        site_df_path=flag("site_df_path"),
+        eps_km=flag("eps_km"),
+        min_sample_size=flag("min_sample_size"),
+        min_samples=flag("min_samples"),
+        output_dir=args.output_dir,
+        raw_dir=flag("raw_dir") or os.path.join(args.output_dir, "raw"),
+        proximity_radius_m=flag("proximity_radius_m"),
+        overpass_api=build_overpass_api(args) if fetches else None,
+        around_batch_size=flag("around_batch_size"),
+        read_workers=flag("read_workers"),
+        read_chunk_size=flag("read_chunk_size"),
+        query_planner=build_query_planner(args) if fetches else None,
+        category_workers=flag("category_workers"),
+        ring_radii_m=ring_radii_m(args) if hasattr(args, "ring_radii_m") else None,
     )
 
-    ## GOLDEN LAYER ##
 
-    enrich_sites = EnrichSites(
-        site_data_path=f"{output_dir}/{site_data_file_name}",
-        fast_food_data_path=f"{output_dir}/{fast_food_poi_df_file_name}",
-        fuel_data_path=f"{output_dir}/{fuel_station_poi_df_file_name}",
-        supermarket_data_path=f"{output_dir}/{supermarket_poi_df_file_name}",
-        proximity_data_path=f"{output_dir}/{proximity_data_file_name}",
+def run_layer(args: argparse.Namespace) -> None:
+    ## Only the stages of the layer run, on the outputs an earlier run left
+    ## in '--output_dir'; up to date stages are skipped as in a staged run
+    from src.etl import LAYER_STAGES, run_staged_pipeline
+
+    etl_kwargs = build_etl_kwargs(args)
+    if args.command == "enrich":
+        etl_kwargs.update(
+            enriched_dataset_save_path=args.enriched_dataset_save_path
+        )
+    else:
+        etl_kwargs.update(enriched_dataset_save_path=None)
+
+    run_staged_pipeline(
+        max_workers=args.stage_workers,
+        force=args.force,
+        stage_names=LAYER_STAGES[COMMAND_LAYERS[args.command]],
+        **etl_kwargs,
     )
 
-    enirched_site_data = enrich_sites.enirch_site_data_with_features()
 
-    print(enirched_site_data.head())
+def run_all(args: argparse.Namespace) -> None:
+    from src.etl import (
+        run_etl_pipeline,
+        run_staged_pipeline,
+        run_incremental_etl_pipeline,
+        run_streaming_etl_pipeline,
+        run_cluster_sweep,
+        enrich_stage,
+    )
+
+    output_dir = args.output_dir
+    enriched_dataset_save_path = args.enriched_dataset_save_path
+
+    if args.sweep:
+        sweep_df = run_cluster_sweep(
+            site_df_path=args.site_df_path,
+            output_dir=output_dir,
+            eps_km_values=args.sweep_eps_km or [args.eps_km],
+            min_sample_size_values=args.sweep_min_sample_size or [args.min_sample_size],
+            min_samples_values=args.sweep_min_samples or [args.min_samples],
+            around_batch_size=args.around_batch_size,
+            proximity_radius_m=args.proximity_radius_m,
+            ring_radii_m=ring_radii_m(args),
+        )
+        logging.info(f"Cluster parameter sweep:\n{sweep_df.to_string(index=False)}")
+        return
 
-    os.makedirs(enriched_dataset_save_path, exist_ok=True)
-    enirched_site_data.to_csv(
-        f"{enriched_dataset_save_path}/enriched_site_data.csv", index=False
+    etl_kwargs = build_etl_kwargs(args)
+    if args.streaming:
+        run_streaming_etl_pipeline(
+            enriched_dataset_save_path=enriched_dataset_save_path,
+            memory_budget_mb=args.memory_budget_mb,
+            tile_deg=args.tile_deg,
+            **etl_kwargs,
+        )
+    elif args.incremental:
+        file_names, affected_site_ids, removed_site_ids = (
+            run_incremental_etl_pipeline(**etl_kwargs)
+        )
+
+        ## GOLDEN LAYER ##
+        enirched_site_data = enrich_stage(
+            output_dir=output_dir,
+            enriched_dataset_save_path=enriched_dataset_save_path,
+            site_ids=affected_site_ids,
+            removed_site_ids=removed_site_ids,
+            ring_radii_m=etl_kwargs["ring_radii_m"],
+            category_workers=args.category_workers,
+        )
+        logging.info(f"Enriched site data:\n{enirched_site_data.head()}")
+        ## GOLDEN LAYER ##
+    elif args.in_memory:
+        from src.pipeline.staging_store import StagingStore
+
+        with StagingStore(
+            output_dir, persist=not args.no_persist_staging
+        ) as staging_store:
+            run_etl_pipeline(store=staging_store, **etl_kwargs)
+
+            ## GOLDEN LAYER ##
+            enirched_site_data = enrich_stage(
+                output_dir=output_dir,
+                enriched_dataset_save_path=enriched_dataset_save_path,
+                store=staging_store,
+                ring_radii_m=etl_kwargs["ring_radii_m"],
+                category_workers=args.category_workers,
+            )
+            logging.info(f"Enriched site data:\n{enirched_site_data.head()}")
+            ## GOLDEN LAYER ##
+    else:
+        run_staged_pipeline(
+            max_workers=args.stage_workers,
+            force=args.force,
+            enriched_dataset_save_path=enriched_dataset_save_path,
+            **etl_kwargs,
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    ## Without a subcommand every layer runs, as before the subcommands
+    if argv and argv[0] not in COMMANDS and argv[0] not in ("-h", "--help"):
+        argv = ["all"] + argv
+    args = build_parser().parse_args(argv)
+
+    metrics_dir = args.metrics_dir or args.output_dir
+    INSTRUMENTATION.configure(
+        profile_stages=args.profile_stage,
+        profile_dir=os.path.join(metrics_dir, "profiles"),
     )
 
-    logging.info(f"Enriched dataset saved here: {enriched_dataset_save_path}/enriched_site_data.csv")
+    if args.command != "all":
+        mode = args.command
+    elif args.sweep:
+        mode = "sweep"
+    elif args.streaming:
+        mode = "streaming"
+    elif args.incremental:
+        mode = "incremental"
+    elif args.in_memory:
+        mode = "in_memory"
+    else:
+        mode = "staged"
+    try:
+        with span("pipeline", mode=mode):
+            if args.command == "all":
+                run_all(args)
+            else:
+                run_layer(args)
+    finally:
+        INSTRUMENTATION.write_json(os.path.join(metrics_dir, "run_report.json"))
+        INSTRUMENTATION.write_prometheus(os.path.join(metrics_dir, "run_metrics.prom"))
 
-    ## GOLDEN LAYER ##
\ No newline at end of file
+
+if __name__ == "__main__":
+    main()
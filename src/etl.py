@@ -1,53 +1,104 @@
-import ast
+import os
 import logging
+import resource
 import numpy as np
-from glob import glob
 import pandas as pd
-from tqdm import tqdm
-from src.pipeline.poi_api import OverPassAPI
-from src.pipeline.cluster_pois import ClustesSites
-from src.pipeline.transforms import transformation_pipeline
-from src.pipeline.enrich_sites import EnrichSites
+from src.pipeline.query_planner import QuadtreeQueryPlanner, summarize_query_boxes
+from src.pipeline.transforms import (
+    read_raw_data,
+    prepare_poi_data,
+    prepare_site_data,
+    compute_distance_between_pois_sites,
+    transform_site_data,
+    transform_poi_data,
+    build_proximity_data,
+    incremental_transformation_pipeline,
+    POI_STAGING_DATASETS,
+    SITE_STAGING_DATASET,
+    PROXIMITY_STAGING_DATASET,
+    POI_CATEGORIES,
+)
+from src.pipeline.incremental import SiteManifest, SITE_MANIFEST_FILE_NAME
+from src.pipeline.enrich_sites import EnrichSites, merge_enriched_site_data
+from src.pipeline.poi_features import TAG_FEATURES, tag_columns
+from src.pipeline.ring_features import RING_RADII_M
+from src.pipeline.schema import PROXIMITY_DTYPES, apply_dtype_policy
+from src.pipeline.staging_store import StagingStore
+from src.pipeline.raw_store import RawShardWriter, is_raw_ref
+from src.utils.instrumentation import span
+from src.pipeline.dag import Stage, StageRunner, PIPELINE_STATE_FILE_NAME
+from src.pipeline.spill import (
+    assign_tiles,
+    estimate_rows_per_chunk,
+    reset_dataset,
+    spill_partitions,
+    list_partitions,
+    read_partition,
+)
+from src.pipeline.validation import (
+    GERMANY_BOUNDS,
+    parse_geo_coordinates,
+    validate_coordinates,
+    within_bounds,
+)
 from src.utils.helpers import (
     extract_cluster_bounding_boxes_dict,
-    save_cluster_pois, save_site_pois
+    split_pois_by_site,
+    map_in_order,
+    save_intermediete_data, read_intermediate_data
 )
-from typing import List, Dict
+from typing import TYPE_CHECKING, List, Dict, Optional
 
+## HDBSCAN, scikit-learn, requests and tqdm take seconds to import, they are
+## imported by the stages that use them so a run of the later layers alone
+## starts without them
+if TYPE_CHECKING:
+    from src.pipeline.poi_api import OverPassAPI
 
-def clean_site_data(site_df: pd.DataFrame) -> pd.DataFrame:
-    logging.info(f"Cleaning and removing outliers from site_data.")
+CLEAN_SITES_FILE_NAME = "sites_clean.parquet"
+CLUSTERED_SITES_FILE_NAME = "sites_clustered.parquet"
+ENRICHED_SITES_FILE_NAME = "enriched_site_data.csv"
+CLUSTER_SWEEP_FILE_NAME = "cluster_sweep.csv"
+## Stages of every layer, run on their own by `run_staged_pipeline`
+LAYER_STAGES = {
+    "bronze": ["clean", "cluster", "fetch"],
+    "silver": ["transform_sites", "transform_pois", "proximity"],
+    "gold": ["enrich"],
+}
 
-    site_df["geoCoordinates"] = site_df["geoCoordinates"].apply(
-        ast.literal_eval
-    )
-    site_df["lon"] = site_df["geoCoordinates"].apply(lambda x: x[0])
-    site_df["lat"] = site_df["geoCoordinates"].apply(lambda x: x[1])
 
-    GERMANY_BOUNDS = {
-        "lat_min": 47.2,
-        "lat_max": 55.1,
-        "lon_min": 5.9,
-        "lon_max": 15.0,
-    }
+def default_overpass_api() -> "OverPassAPI":
+    from src.pipeline.poi_api import OverPassAPI
+
+    return OverPassAPI()
+
+
+def fetch_radius_m(
+    proximity_radius_m: float, ring_radii_m: List[float] = RING_RADII_M
+) -> float:
+    ## POIs are fetched out to the largest ring, so the ring features of a
+    ## site do not depend on the clustering or on which sites a run fetched
+    return max([proximity_radius_m] + list(ring_radii_m))
+
 
-    mask = (
-        (site_df["lat"] >= GERMANY_BOUNDS["lat_min"])
-        & (site_df["lat"] <= GERMANY_BOUNDS["lat_max"])
-        & (site_df["lon"] >= GERMANY_BOUNDS["lon_min"])
-        & (site_df["lon"] <= GERMANY_BOUNDS["lon_max"])
+def clean_site_data(site_df: pd.DataFrame) -> pd.DataFrame:
+    logging.info(f"Cleaning and removing outliers from site_data.")
+
+    site_df["lon"], site_df["lat"] = parse_geo_coordinates(
+        site_df["geoCoordinates"]
     )
+    site_df = validate_coordinates(site_df)
 
-    site_df["is_outlier"] = ~mask
+    site_df["is_outlier"] = ~within_bounds(site_df, bounds=GERMANY_BOUNDS)
 
     logging.info(
-        f"The number of sites that lie outside the approximated border of Germany is: {len(site_df[site_df['is_outlier'] == True])}"
+        f"The number of sites that lie outside the approximated border of Germany is: {int(site_df['is_outlier'].sum())}"
     )
 
-    site_df = site_df[site_df["is_outlier"] == False]
+    site_df = site_df[~site_df["is_outlier"]]
 
     logging.info(f"Successfuly removed outliers if any.")
-    return site_df
+    return apply_dtype_policy(site_df)
 
 
 def extract_clusters(
@@ -55,9 +106,17 @@ def extract_clusters(
     eps_km: float,
     min_sample_size: int,
     min_samples: int,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
 ) -> pd.DataFrame:
+    """
+    Groups the sites into the areas queried together: HDBSCAN clusters (with
+    -1 for sites queried on their own), or the tiles of `query_planner`.
+    """
+    if query_planner is not None:
+        return query_planner.plan(site_df)
+
+    from src.pipeline.cluster_pois import ClustesSites
 
-    
     clusterer = ClustesSites(
         eps_km=eps_km, min_sample_size=min_sample_size, min_samples=min_samples
     )
@@ -68,76 +127,1022 @@ def extract_clusters(
     return site_df
 
 
-def extract_poi_data(site_df: pd.DataFrame) -> List[Dict]:
-    cluster_pois = {}
+def sweep_cluster_parameters(
+    site_df: pd.DataFrame,
+    eps_km_values: List[float],
+    min_sample_size_values: List[int],
+    min_samples_values: List[int],
+    around_batch_size: int = 1,
+    radius: int = 100,
+) -> pd.DataFrame:
+    """
+    Clusters the sites for every combination of the parameter grids, fitting
+    HDBSCAN once per `min_samples`, and predicts the Overpass queries each
+    setting would send.
+
+    Returns:
+        pd.DataFrame: One row per setting with the number of clusters, the
+                      share of noise sites and the request count, area and
+                      overlap of its queries, cheapest setting first.
+    """
+    from src.pipeline.cluster_pois import ClusterSweep
+
+    with span("cluster_sweep") as sweep_span:
+        sweep = ClusterSweep(coords_rad=np.radians(site_df[["lat", "lon"]].to_numpy()))
+        site_df = site_df[["lat", "lon"]].copy()
+
+        results = []
+        for min_samples in min_samples_values:
+            for min_sample_size in min_sample_size_values:
+                for eps_km in eps_km_values:
+                    site_df["cluster"] = sweep.predict_clusters(
+                        eps_km=eps_km,
+                        min_sample_size=min_sample_size,
+                        min_samples=min_samples,
+                    )
+                    is_noise = site_df["cluster"] == -1
+                    result = {
+                        "eps_km": eps_km,
+                        "min_sample_size": min_sample_size,
+                        "min_samples": min_samples,
+                        "num_clusters": int(site_df["cluster"].max()) + 1,
+                        "noise_fraction": round(float(is_noise.mean()), 4),
+                    }
+                    result.update(
+                        summarize_query_boxes(
+                            extract_cluster_bounding_boxes_dict(
+                                df=site_df, radius_m=radius
+                            ),
+                            num_around_sites=int(is_noise.sum()),
+                            around_batch_size=around_batch_size,
+                            radius_m=radius,
+                        )
+                    )
+                    results.append(result)
+
+        sweep_span.add(rows_in=len(site_df), rows_out=len(results))
+        sweep_span.set(num_fits=len(sweep.single_linkage_trees))
+
+    return pd.DataFrame(results).sort_values(
+        ["num_requests", "total_area_km2"], kind="stable", ignore_index=True
+    )
+
+
+def run_cluster_sweep(
+    site_df_path: str,
+    output_dir: str,
+    eps_km_values: List[float],
+    min_sample_size_values: List[int],
+    min_samples_values: List[int],
+    around_batch_size: int = 1,
+    proximity_radius_m: float = 100,
+    ring_radii_m: List[float] = RING_RADII_M,
+) -> pd.DataFrame:
+    site_df = clean_site_data(site_df=pd.read_csv(site_df_path))
+    sweep_df = sweep_cluster_parameters(
+        site_df=site_df,
+        eps_km_values=eps_km_values,
+        min_sample_size_values=min_sample_size_values,
+        min_samples_values=min_samples_values,
+        around_batch_size=around_batch_size,
+        radius=fetch_radius_m(proximity_radius_m, ring_radii_m),
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    sweep_path = f"{output_dir}/{CLUSTER_SWEEP_FILE_NAME}"
+    sweep_df.to_csv(sweep_path, index=False)
+    logging.info(f"Cluster parameter sweep saved here: {sweep_path}")
+    return sweep_df
+
+
+def extract_batched_site_poi_data(
+    unclustered_sites_df: pd.DataFrame,
+    overpass_api: "OverPassAPI",
+    batch_size: int,
+    radius: float = 100,
+) -> Dict:
+    batches = [
+        unclustered_sites_df.iloc[start : start + batch_size]
+        for start in range(0, len(unclustered_sites_df), batch_size)
+    ]
+
+    batch_queries = {
+        batch_id: overpass_api.build_batched_around_query(
+            coordinates=list(zip(batch["lat"], batch["lon"])), radius=radius
+        )
+        for batch_id, batch in enumerate(batches)
+    }
+    batch_pois = overpass_api.query_overpass_many(
+        batch_queries, desc="Querying batches of individual sites"
+    )
+
     individual_sites = {}
+    for batch_id, batch in enumerate(batches):
+        individual_sites.update(
+            split_pois_by_site(
+                elements=batch_pois[batch_id],
+                site_ids=batch["id"].tolist(),
+                lats=batch["lat"].tolist(),
+                lons=batch["lon"].tolist(),
+                radius=radius,
+            )
+        )
 
-    overpass_api = OverPassAPI()
+    logging.info(
+        f"(OverPassAPI): Batched {len(unclustered_sites_df)} individual sites into "
+        f"{len(batches)} around queries, saving {len(unclustered_sites_df) - len(batches)} round trips."
+    )
+    return individual_sites
 
-    cluster_boxes = extract_cluster_bounding_boxes_dict(df=site_df)
 
-    for cluster_id, bbox in tqdm(
-        cluster_boxes.items(), desc="Querying cluster POIs"
-    ):
-        query = overpass_api.build_bbox_query(bbox)
-        poi_response = overpass_api.query_overpass(query)
-        cluster_pois[cluster_id] = poi_response
+def extract_poi_data(
+    site_df: pd.DataFrame,
+    overpass_api: "OverPassAPI",
+    around_batch_size: int = 1,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
+    radius_m: float = 100,
+) -> List[Dict]:
+    """
+    Queries the POIs of the clusters (or planned tiles) with bounding boxes
+    and of the unclustered sites with around queries, both reaching at least
+    `radius_m` meters beyond every site.
+    """
+    if query_planner is not None:
+        cluster_boxes = query_planner.tile_boxes(site_df)
+    else:
+        cluster_boxes = extract_cluster_bounding_boxes_dict(
+            df=site_df, radius_m=radius_m
+        )
+
+    cluster_queries = {
+        cluster_id: overpass_api.build_bbox_query(bbox)
+        for cluster_id, bbox in cluster_boxes.items()
+    }
+    cluster_pois = overpass_api.query_overpass_many(
+        cluster_queries, desc="Querying cluster POIs"
+    )
 
     unclustered_sites_df = site_df[site_df["cluster"] == -1]
+    query_summary = summarize_query_boxes(
+        cluster_boxes,
+        num_around_sites=len(unclustered_sites_df),
+        around_batch_size=around_batch_size,
+        radius_m=radius_m,
+    )
+    logging.info(f"(OverPassAPI): Query plan {query_summary}")
 
-    for lat, lon, site_id in tqdm(
-        unclustered_sites_df[["lat", "lon", "id"]].values,
-        desc="Querying individual sites",
-    ):
-        around_query = overpass_api.build_around_query(lat=lat, lon=lon)
-        poi_response = overpass_api.query_overpass(query=around_query)
-        individual_sites[site_id] = poi_response
+    if around_batch_size > 1:
+        individual_sites = extract_batched_site_poi_data(
+            unclustered_sites_df=unclustered_sites_df,
+            overpass_api=overpass_api,
+            batch_size=around_batch_size,
+            radius=radius_m,
+        )
+    else:
+        around_queries = {
+            site_id: overpass_api.build_around_query(lat=lat, lon=lon, radius=radius_m)
+            for lat, lon, site_id in unclustered_sites_df[["lat", "lon", "id"]].values
+        }
+        individual_sites = overpass_api.query_overpass_many(
+            around_queries, desc="Querying individual sites"
+        )
 
+    logging.info(
+        f"(OverPassAPI): Request summary {overpass_api.summarize_request_stats()}"
+    )
     return cluster_pois, individual_sites
 
 
+def save_raw_poi_data(
+    site_df: pd.DataFrame,
+    cluster_pois: Dict,
+    individual_pois: Dict,
+    raw_writer: RawShardWriter,
+    manifest: Optional[SiteManifest] = None,
+    cluster_key_prefix: str = "",
+) -> List[str]:
+    """
+    Appends the responses of the clusters ('cluster_<id>') and of the
+    individual sites ('site_<id>') to the raw shards.
+
+    Returns:
+        List[str]: References of the responses, readable by `read_raw_data`.
+    """
+    cluster_refs = raw_writer.write_many(
+        cluster_pois, key_prefix=f"cluster_{cluster_key_prefix}"
+    )
+    site_refs = raw_writer.write_many(individual_pois, key_prefix="site_")
+    raw_writer.flush()
+
+    ## Recording which sites every raw response covers
+    if manifest is None:
+        return list(cluster_refs.values()) + list(site_refs.values())
+
+    site_ids_by_cluster = site_df.groupby("cluster")["id"].apply(list)
+    for cluster_id, ref in cluster_refs.items():
+        manifest.add_raw_file(ref, site_ids_by_cluster[cluster_id])
+    for site_id, ref in site_refs.items():
+        manifest.add_raw_file(ref, [site_id])
+
+    return list(cluster_refs.values()) + list(site_refs.values())
+
+
+def clean_sites_stage(site_df_path: str, output_dir: str) -> None:
+    with span("clean") as stage_span:
+        site_df = pd.read_csv(site_df_path)
+        stage_span.add(rows_in=len(site_df), bytes_read=os.path.getsize(site_df_path))
+
+        site_df = clean_site_data(site_df=site_df)
+        save_intermediete_data(
+            df=site_df, output_dir=output_dir, file_name=CLEAN_SITES_FILE_NAME
+        )
+        stage_span.add(rows_out=len(site_df))
+
+
+def cluster_sites_stage(
+    output_dir: str,
+    eps_km: float,
+    min_sample_size: int,
+    min_samples: int,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
+) -> None:
+    with span("cluster", eps_km=eps_km) as stage_span:
+        site_df = read_intermediate_data(f"{output_dir}/{CLEAN_SITES_FILE_NAME}")
+        site_df = extract_clusters(
+            site_df=site_df,
+            eps_km=eps_km,
+            min_sample_size=min_sample_size,
+            min_samples=min_samples,
+            query_planner=query_planner,
+        )
+        save_intermediete_data(
+            df=site_df, output_dir=output_dir, file_name=CLUSTERED_SITES_FILE_NAME
+        )
+        stage_span.add(rows_in=len(site_df), rows_out=len(site_df))
+        stage_span.set(num_clusters=int(site_df["cluster"].max()) + 1)
+        if query_planner is not None:
+            stage_span.set(**query_planner.stats)
+
+
+def fetch_pois_stage(
+    output_dir: str,
+    raw_dir: str,
+    overpass_api: "OverPassAPI",
+    around_batch_size: int = 1,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
+    proximity_radius_m: float = 100,
+    ring_radii_m: List[float] = RING_RADII_M,
+) -> None:
+    with span("fetch") as stage_span:
+        site_df = read_intermediate_data(f"{output_dir}/{CLUSTERED_SITES_FILE_NAME}")
+
+        cluster_pois, individual_pois = extract_poi_data(
+            site_df=site_df,
+            overpass_api=overpass_api,
+            around_batch_size=around_batch_size,
+            query_planner=query_planner,
+            radius_m=fetch_radius_m(proximity_radius_m, ring_radii_m),
+        )
+
+        ## The manifest lists the raw responses of this run, a full fetch
+        ## starts the raw shards over
+        manifest = SiteManifest(manifest_path=f"{output_dir}/{SITE_MANIFEST_FILE_NAME}")
+        manifest.reset()
+        manifest.run_id += 1
+
+        with RawShardWriter(raw_dir, reset=True) as raw_writer:
+            save_raw_poi_data(
+                site_df=site_df,
+                cluster_pois=cluster_pois,
+                individual_pois=individual_pois,
+                manifest=manifest,
+                raw_writer=raw_writer,
+            )
+        manifest.update_sites(site_df)
+        manifest.save()
+
+        stage_span.add(
+            rows_in=len(site_df),
+            rows_out=sum(len(pois) for pois in cluster_pois.values())
+            + sum(len(pois) for pois in individual_pois.values()),
+        )
+        stage_span.set(**overpass_api.summarize_request_stats())
+
+
+def transform_sites_stage(
+    output_dir: str, store: Optional[StagingStore] = None
+) -> None:
+    with span("transform_sites") as stage_span:
+        site_df = read_intermediate_data(f"{output_dir}/{CLEAN_SITES_FILE_NAME}")
+        transform_site_data(site_df=site_df, output_dir=output_dir, store=store)
+        stage_span.add(rows_in=len(site_df), rows_out=len(site_df))
+
+
+def transform_pois_stage(
+    output_dir: str,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    store: Optional[StagingStore] = None,
+    category_workers: int = 1,
+) -> None:
+    with span("transform_pois"):
+        manifest = SiteManifest(manifest_path=f"{output_dir}/{SITE_MANIFEST_FILE_NAME}")
+        transform_poi_data(
+            poi_json_file_paths=list(manifest.raw_files),
+            output_dir=output_dir,
+            read_workers=read_workers,
+            read_chunk_size=read_chunk_size,
+            store=store,
+            category_workers=category_workers,
+        )
+
+
+def proximity_stage(
+    output_dir: str,
+    proximity_radius_m: float = 100,
+    store: Optional[StagingStore] = None,
+    category_workers: int = 1,
+) -> None:
+    with span("proximity", radius_m=proximity_radius_m):
+        build_proximity_data(
+            output_dir=output_dir,
+            proximity_radius_m=proximity_radius_m,
+            store=store,
+            category_workers=category_workers,
+        )
+
+
+def enrich_stage(
+    output_dir: str,
+    enriched_dataset_save_path: str,
+    site_ids: List = None,
+    removed_site_ids: List = None,
+    store: Optional[StagingStore] = None,
+    ring_radii_m: List[float] = RING_RADII_M,
+    category_workers: int = 1,
+) -> pd.DataFrame:
+    """
+    Builds the golden layer. With `site_ids` only those sites are enriched and
+    merged, together with `removed_site_ids`, into the existing enriched
+    dataset; when there is no enriched dataset yet every site is enriched.
+    With a `store` the staging datasets are taken from memory.
+    """
+    with span("enrich") as stage_span:
+        enriched_dataset_file = f"{enriched_dataset_save_path}/{ENRICHED_SITES_FILE_NAME}"
+        if not os.path.exists(enriched_dataset_file):
+            site_ids, removed_site_ids = None, None
+
+        def staging_input(dataset_name: str, columns: List = None):
+            if store is not None and dataset_name in store:
+                return store.read(dataset_name, columns=columns)
+            return f"{output_dir}/{dataset_name}"
+
+        poi_columns = ["poi_id", "lat", "lon"] + tag_columns(TAG_FEATURES)
+        enrich_sites = EnrichSites(
+            site_data_path=staging_input(SITE_STAGING_DATASET),
+            fast_food_data_path=staging_input(
+                POI_STAGING_DATASETS["fast_food"], columns=poi_columns
+            ),
+            fuel_data_path=staging_input(
+                POI_STAGING_DATASETS["fuel"], columns=poi_columns
+            ),
+            supermarket_data_path=staging_input(
+                POI_STAGING_DATASETS["supermarket"], columns=poi_columns
+            ),
+            proximity_data_path=staging_input(PROXIMITY_STAGING_DATASET),
+            site_ids=site_ids,
+            ring_radii_m=ring_radii_m,
+            load_workers=category_workers,
+        )
+        enirched_site_data = enrich_sites.enirch_site_data_with_features()
+
+        if site_ids is not None:
+            enirched_site_data = merge_enriched_site_data(
+                existing_enriched_df=pd.read_csv(enriched_dataset_file),
+                enriched_df=enirched_site_data,
+                replaced_site_ids=list(site_ids) + list(removed_site_ids or []),
+            )
+
+        os.makedirs(enriched_dataset_save_path, exist_ok=True)
+        enirched_site_data.to_csv(enriched_dataset_file, index=False)
+        stage_span.add(
+            rows_out=len(enirched_site_data),
+            bytes_written=os.path.getsize(enriched_dataset_file),
+        )
+        logging.info(f"Enriched dataset saved here: {enriched_dataset_file}")
+        return enirched_site_data
+
+
+def build_pipeline_stages(
+    site_df_path: str,
+    eps_km: float,
+    min_sample_size: int,
+    min_samples: int,
+    output_dir: str,
+    raw_dir: str,
+    enriched_dataset_save_path: str,
+    proximity_radius_m: float = 100,
+    overpass_api: "OverPassAPI" = None,
+    around_batch_size: int = 1,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
+    ring_radii_m: List[float] = RING_RADII_M,
+    category_workers: int = 1,
+) -> List[Stage]:
+    """
+    The stages of the whole pipeline. The Overpass API is only created when
+    the fetch stage runs, and the settings of stages that are not run may be
+    None.
+    """
+    clean_sites_path = f"{output_dir}/{CLEAN_SITES_FILE_NAME}"
+    clustered_sites_path = f"{output_dir}/{CLUSTERED_SITES_FILE_NAME}"
+    manifest_path = f"{output_dir}/{SITE_MANIFEST_FILE_NAME}"
+    site_staging_path = f"{output_dir}/{SITE_STAGING_DATASET}"
+    poi_staging_paths = [
+        f"{output_dir}/{dataset_name}" for dataset_name in POI_STAGING_DATASETS.values()
+    ]
+    proximity_path = f"{output_dir}/{PROXIMITY_STAGING_DATASET}"
+    ## A rebuilt local POI store changes the fetched POIs like new OSM data
+    fetch_inputs = [clustered_sites_path]
+    if overpass_api is not None:
+        from src.pipeline.poi_store import LocalOverPassAPI
+
+        if isinstance(overpass_api, LocalOverPassAPI):
+            fetch_inputs.append(overpass_api.store.db_path)
+    query_planner_params = (
+        query_planner.params() if query_planner is not None else "hdbscan"
+    )
+
+    return [
+        Stage(
+            name="clean",
+            func=lambda: clean_sites_stage(
+                site_df_path=site_df_path, output_dir=output_dir
+            ),
+            inputs=[site_df_path],
+            outputs=[clean_sites_path],
+        ),
+        Stage(
+            name="cluster",
+            func=lambda: cluster_sites_stage(
+                output_dir=output_dir,
+                eps_km=eps_km,
+                min_sample_size=min_sample_size,
+                min_samples=min_samples,
+                query_planner=query_planner,
+            ),
+            inputs=[clean_sites_path],
+            outputs=[clustered_sites_path],
+            params={
+                "eps_km": eps_km,
+                "min_sample_size": min_sample_size,
+                "min_samples": min_samples,
+                "query_planner": query_planner_params,
+            },
+            depends_on=["clean"],
+        ),
+        Stage(
+            name="fetch",
+            func=lambda: fetch_pois_stage(
+                output_dir=output_dir,
+                raw_dir=raw_dir,
+                overpass_api=overpass_api or default_overpass_api(),
+                around_batch_size=around_batch_size,
+                query_planner=query_planner,
+                proximity_radius_m=proximity_radius_m,
+                ring_radii_m=ring_radii_m,
+            ),
+            inputs=fetch_inputs,
+            outputs=[manifest_path, raw_dir],
+            params={
+                "around_batch_size": around_batch_size,
+                "query_planner": query_planner_params,
+                "proximity_radius_m": proximity_radius_m,
+                "ring_radii_m": ring_radii_m,
+            },
+            depends_on=["cluster"],
+        ),
+        Stage(
+            name="transform_sites",
+            func=lambda: transform_sites_stage(output_dir=output_dir),
+            inputs=[clean_sites_path],
+            outputs=[site_staging_path],
+            depends_on=["clean"],
+        ),
+        Stage(
+            name="transform_pois",
+            func=lambda: transform_pois_stage(
+                output_dir=output_dir,
+                read_workers=read_workers,
+                read_chunk_size=read_chunk_size,
+                category_workers=category_workers,
+            ),
+            inputs=[manifest_path, raw_dir],
+            outputs=poi_staging_paths,
+            depends_on=["fetch"],
+        ),
+        Stage(
+            name="proximity",
+            func=lambda: proximity_stage(
+                output_dir=output_dir,
+                proximity_radius_m=proximity_radius_m,
+                category_workers=category_workers,
+            ),
+            inputs=[site_staging_path] + poi_staging_paths,
+            outputs=[proximity_path],
+            params={"proximity_radius_m": proximity_radius_m},
+            depends_on=["transform_sites", "transform_pois"],
+        ),
+        Stage(
+            name="enrich",
+            func=lambda: enrich_stage(
+                output_dir=output_dir,
+                enriched_dataset_save_path=enriched_dataset_save_path,
+                ring_radii_m=ring_radii_m,
+                category_workers=category_workers,
+            ),
+            inputs=[site_staging_path, proximity_path] + poi_staging_paths,
+            outputs=[f"{enriched_dataset_save_path}/{ENRICHED_SITES_FILE_NAME}"],
+            params={"tag_features": TAG_FEATURES, "ring_radii_m": ring_radii_m},
+            depends_on=["proximity"],
+        ),
+    ]
+
+
+def run_staged_pipeline(
+    max_workers: int = 2,
+    force: bool = False,
+    stage_names: Optional[List[str]] = None,
+    **pipeline_kwargs,
+) -> None:
+    """
+    Runs the whole pipeline (bronze, silver and gold) as checkpointed stages,
+    skipping the stages that are up to date and resuming after a failure.
+    With `stage_names` (e.g. `LAYER_STAGES["gold"]`) only those stages run,
+    on the outputs an earlier run left in `output_dir`.
+    """
+    stages = build_pipeline_stages(**pipeline_kwargs)
+    runner = StageRunner(
+        stages=stages,
+        state_path=f"{pipeline_kwargs['output_dir']}/{PIPELINE_STATE_FILE_NAME}",
+        max_workers=max_workers,
+        force=force,
+        stage_names=stage_names,
+    )
+    runner.run()
+
+
 def run_etl_pipeline(
-    site_df_path: str, eps_km: float, min_sample_size: int, min_samples: int, output_dir: str
+    site_df_path: str,
+    eps_km: float,
+    min_sample_size: int,
+    min_samples: int,
+    output_dir: str,
+    raw_dir: str,
+    proximity_radius_m: float = 100,
+    overpass_api: "OverPassAPI" = None,
+    around_batch_size: int = 1,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
+    store: Optional[StagingStore] = None,
+    category_workers: int = 1,
+    ring_radii_m: List[float] = RING_RADII_M,
 ):
+    """
+    Runs the bronze and silver layers in sequence. With a `store` the silver
+    stages hand their datasets to each other (and to `enrich_stage`) in
+    memory instead of through the staging directory.
+    """
 
     ### BRONZE LAYER
 
-    site_df = pd.read_csv(site_df_path)
-
-    site_df = clean_site_data(site_df=site_df)
+    clean_sites_stage(site_df_path=site_df_path, output_dir=output_dir)
 
-    site_df = extract_clusters(
-        site_df=site_df,
+    cluster_sites_stage(
+        output_dir=output_dir,
         eps_km=eps_km,
         min_sample_size=min_sample_size,
         min_samples=min_samples,
+        query_planner=query_planner,
     )
 
-    cluster_pois, individual_pois = extract_poi_data(site_df=site_df)
+    if overpass_api is None:
+        overpass_api = default_overpass_api()
+
+    fetch_pois_stage(
+        output_dir=output_dir,
+        raw_dir=raw_dir,
+        overpass_api=overpass_api,
+        around_batch_size=around_batch_size,
+        query_planner=query_planner,
+        proximity_radius_m=proximity_radius_m,
+        ring_radii_m=ring_radii_m,
+    )
+
+    ### BRONZE LAYER
+
+    ### SILVER LAYER
+
+    transform_sites_stage(output_dir=output_dir, store=store)
+    transform_pois_stage(
+        output_dir=output_dir,
+        read_workers=read_workers,
+        read_chunk_size=read_chunk_size,
+        store=store,
+        category_workers=category_workers,
+    )
+    proximity_stage(
+        output_dir=output_dir,
+        proximity_radius_m=proximity_radius_m,
+        store=store,
+        category_workers=category_workers,
+    )
 
-    save_cluster_pois(
-        all_pois=cluster_pois, output_dir="./data_test/raw/cluster_pois/"
+    return (
+        SITE_STAGING_DATASET,
+        POI_STAGING_DATASETS["fast_food"],
+        POI_STAGING_DATASETS["fuel"],
+        POI_STAGING_DATASETS["supermarket"],
+        PROXIMITY_STAGING_DATASET,
     )
+    ### SILVER LAYER
+
 
-    save_site_pois(
-        all_pois=individual_pois, output_dir="./data_test/raw/site_pois/"
+def poi_keys(poi_df: pd.DataFrame) -> np.ndarray:
+    ## OSM ids are only unique per element type
+    return poi_df["poi_id"].to_numpy(dtype=np.int64) * 2 + (
+        poi_df["type"].to_numpy() == "way"
     )
 
-    cluster_pois_file_paths = glob(
-        "./data_test/raw/cluster_pois/*"
+
+def run_streaming_etl_pipeline(
+    site_df_path: str,
+    eps_km: float,
+    min_sample_size: int,
+    min_samples: int,
+    output_dir: str,
+    raw_dir: str,
+    enriched_dataset_save_path: str,
+    proximity_radius_m: float = 100,
+    overpass_api: "OverPassAPI" = None,
+    around_batch_size: int = 1,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    memory_budget_mb: float = 1024,
+    tile_deg: float = 0.5,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
+    ring_radii_m: List[float] = RING_RADII_M,
+    category_workers: int = 1,
+) -> None:
+    """
+    Runs the pipeline for site files that do not fit in memory.
+
+    The site file is read in chunks sized to `memory_budget_mb`, cleaned and
+    spilled to a Parquet dataset partitioned by `tile_deg` x `tile_deg` degree
+    tiles. Every tile is then clustered, queried, transformed, matched and
+    enriched on its own, so only one tile is held in memory at a time. Tiles
+    larger than a chunk are processed in latitude bands of at most one chunk.
+
+    The staging outputs have the layout of the staged pipeline (`site_data/`,
+    `<category>_pois/`, `site_pois_proximities/`, one `tile=...` directory per
+    tile) and the enriched dataset is appended to tile by tile. POIs returned
+    for several tiles are staged once, under the first tile that fetched them.
+    Clusters do not cross tile borders, which only changes how sites are
+    grouped into queries, every site is still queried.
+    """
+    from tqdm import tqdm
+
+    rows_per_chunk = estimate_rows_per_chunk(
+        csv_path=site_df_path, memory_budget_mb=memory_budget_mb
     )
-    individual_pois_file_paths = glob(
-        "./data_test/raw/site_pois/*"
+
+    if overpass_api is None:
+        overpass_api = default_overpass_api()
+
+    ### BRONZE LAYER
+
+    clean_sites_dir = f"{output_dir}/{os.path.splitext(CLEAN_SITES_FILE_NAME)[0]}"
+    reset_dataset(clean_sites_dir)
+
+    with span("spill_sites", rows_per_chunk=rows_per_chunk) as spill_span:
+        spill_span.add(bytes_read=os.path.getsize(site_df_path))
+        for chunk_id, site_df in enumerate(
+            pd.read_csv(site_df_path, chunksize=rows_per_chunk)
+        ):
+            spill_span.add(rows_in=len(site_df))
+            site_df = clean_site_data(site_df=site_df)
+            site_df["tile"] = assign_tiles(site_df, tile_deg=tile_deg)
+            spill_partitions(
+                df=site_df,
+                dataset_dir=clean_sites_dir,
+                partition_column="tile",
+                part_name=f"part-{chunk_id:05d}",
+            )
+            spill_span.add(rows_out=len(site_df))
+
+    tiles = list_partitions(clean_sites_dir, partition_column="tile")
+    logging.info(f"(Streaming): Spilled the cleaned sites into {len(tiles)} tiles.")
+
+    ### BRONZE LAYER
+
+    staging_dirs = {
+        name: f"{output_dir}/{dataset_name}"
+        for name, dataset_name in [
+            ("site", SITE_STAGING_DATASET),
+            ("proximity", PROXIMITY_STAGING_DATASET),
+        ]
+        + list(POI_STAGING_DATASETS.items())
+    }
+    for dataset_dir in staging_dirs.values():
+        reset_dataset(dataset_dir)
+
+    enriched_dataset_file = f"{enriched_dataset_save_path}/{ENRICHED_SITES_FILE_NAME}"
+    os.makedirs(enriched_dataset_save_path, exist_ok=True)
+    if os.path.exists(enriched_dataset_file):
+        os.remove(enriched_dataset_file)
+
+    common_columns = ["poi_id", "lat", "lon", "category"]
+    staged_poi_keys = {
+        category: np.empty(0, dtype=np.int64) for category in POI_CATEGORIES
+    }
+    next_cluster_id = 0
+    raw_writer = RawShardWriter(raw_dir, reset=True)
+
+    for tile in tqdm(tiles, desc="Processing tiles"):
+        tile_site_df = read_partition(
+            clean_sites_dir, partition_column="tile", value=tile
+        ).sort_values("lat", kind="stable")
+        num_bands = -(-len(tile_site_df) // rows_per_chunk)
+
+        for band_id, band_start in enumerate(
+            range(0, len(tile_site_df), rows_per_chunk)
+        ):
+            site_df = tile_site_df.iloc[band_start : band_start + rows_per_chunk].copy()
+            partition = tile if num_bands == 1 else f"{tile}_{band_id}"
+
+            with span("tile", tile=partition) as tile_span:
+                ### BRONZE LAYER
+
+                if query_planner is not None or len(site_df) > max(
+                    min_sample_size, min_samples
+                ):
+                    site_df = extract_clusters(
+                        site_df=site_df,
+                        eps_km=eps_km,
+                        min_sample_size=min_sample_size,
+                        min_samples=min_samples,
+                        query_planner=query_planner,
+                    )
+                else:
+                    site_df["cluster"] = -1
+
+                ## Cluster ids are made unique across tiles so the raw cluster
+                ## files of different tiles do not overwrite each other
+                is_clustered = site_df["cluster"] >= 0
+                site_df.loc[is_clustered, "cluster"] += next_cluster_id
+                if is_clustered.any():
+                    next_cluster_id = int(site_df["cluster"].max()) + 1
+
+                cluster_pois, individual_pois = extract_poi_data(
+                    site_df=site_df,
+                    overpass_api=overpass_api,
+                    around_batch_size=around_batch_size,
+                    query_planner=query_planner,
+                    radius_m=fetch_radius_m(proximity_radius_m, ring_radii_m),
+                )
+                raw_file_paths = save_raw_poi_data(
+                    site_df=site_df,
+                    cluster_pois=cluster_pois,
+                    individual_pois=individual_pois,
+                    raw_writer=raw_writer,
+                )
+
+                ### BRONZE LAYER
+
+                ### SILVER LAYER
+
+                site_df = prepare_site_data(site_df=site_df)
+                site_df["tile"] = partition
+                spill_partitions(
+                    df=site_df,
+                    dataset_dir=staging_dirs["site"],
+                    partition_column="tile",
+                    part_name="part-00000",
+                )
+                site_df = site_df.drop(columns="tile")
+
+                ## Every category only touches its own keys and dataset, so
+                ## the categories are staged side by side
+                def stage_category(category_poi_df):
+                    category, poi_df = category_poi_df
+                    poi_df = prepare_poi_data(df=poi_df)
+
+                    keys = poi_keys(poi_df)
+                    is_new = ~np.isin(keys, staged_poi_keys[category])
+                    staged_poi_keys[category] = np.union1d(
+                        staged_poi_keys[category], keys[is_new]
+                    )
+                    spill_partitions(
+                        df=poi_df[is_new].assign(tile=partition),
+                        dataset_dir=staging_dirs[category],
+                        partition_column="tile",
+                        part_name="part-00000",
+                    )
+                    return poi_df
+
+                raw_poi_dfs = read_raw_data(
+                    poi_json_file_paths=raw_file_paths,
+                    max_workers=read_workers,
+                    chunk_size=read_chunk_size,
+                )
+                poi_dfs = dict(
+                    zip(
+                        POI_CATEGORIES,
+                        map_in_order(
+                            stage_category,
+                            list(zip(POI_CATEGORIES, raw_poi_dfs)),
+                            max_workers=category_workers,
+                            thread_name_prefix="stage-category",
+                        ),
+                    )
+                )
+
+                proximity_df = compute_distance_between_pois_sites(
+                    all_poi_data=pd.concat(
+                        [poi_df[common_columns] for poi_df in poi_dfs.values()],
+                        ignore_index=True,
+                    ),
+                    site_data=site_df,
+                    radius_m=proximity_radius_m,
+                )
+                spill_partitions(
+                    df=proximity_df.assign(tile=partition),
+                    dataset_dir=staging_dirs["proximity"],
+                    partition_column="tile",
+                    part_name="part-00000",
+                    dtypes=PROXIMITY_DTYPES,
+                )
+
+                ### SILVER LAYER
+
+                ### GOLDEN LAYER
+
+                enirched_site_data = EnrichSites(
+                    site_data_path=site_df,
+                    fast_food_data_path=poi_dfs["fast_food"],
+                    supermarket_data_path=poi_dfs["supermarket"],
+                    fuel_data_path=poi_dfs["fuel"],
+                    proximity_data_path=proximity_df,
+                    ring_radii_m=ring_radii_m,
+                ).enirch_site_data_with_features()
+                enirched_site_data.to_csv(
+                    enriched_dataset_file,
+                    mode="a",
+                    header=not os.path.exists(enriched_dataset_file),
+                    index=False,
+                )
+                tile_span.add(rows_in=len(site_df), rows_out=len(enirched_site_data))
+
+                ### GOLDEN LAYER
+
+    raw_writer.close()
+    logging.info(
+        f"(Streaming): Processed {len(tiles)} tiles, peak memory "
+        f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB."
     )
-    all_pois = cluster_pois_file_paths + individual_pois_file_paths
+    logging.info(f"Enriched dataset saved here: {enriched_dataset_file}")
+
+
+def run_incremental_etl_pipeline(
+    site_df_path: str,
+    eps_km: float,
+    min_sample_size: int,
+    min_samples: int,
+    output_dir: str,
+    raw_dir: str,
+    proximity_radius_m: float = 100,
+    overpass_api: "OverPassAPI" = None,
+    around_batch_size: int = 1,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    query_planner: Optional[QuadtreeQueryPlanner] = None,
+    category_workers: int = 1,
+    ring_radii_m: List[float] = RING_RADII_M,
+):
+    """
+    Processes only the sites that are new, moved or deleted since the last run,
+    according to the site manifest in `output_dir`, and merges the results into
+    the existing staging data. Falls back to a full run when there is no
+    manifest yet.
+
+    Returns:
+        The staging dataset names (as run_etl_pipeline), the ids of the sites whose
+        enrichment has to be recomputed and the ids of the sites to drop from
+        the mart. Both id lists are None after a full run.
+    """
+    manifest = SiteManifest(manifest_path=f"{output_dir}/{SITE_MANIFEST_FILE_NAME}")
+
+    if not manifest.exists:
+        logging.info("No site manifest found, running the full pipeline.")
+        file_names = run_etl_pipeline(
+            site_df_path=site_df_path,
+            eps_km=eps_km,
+            min_sample_size=min_sample_size,
+            min_samples=min_samples,
+            output_dir=output_dir,
+            raw_dir=raw_dir,
+            proximity_radius_m=proximity_radius_m,
+            overpass_api=overpass_api,
+            around_batch_size=around_batch_size,
+            read_workers=read_workers,
+            read_chunk_size=read_chunk_size,
+            query_planner=query_planner,
+            category_workers=category_workers,
+            ring_radii_m=ring_radii_m,
+        )
+        return file_names, None, None
+
+    ### BRONZE LAYER
+
+    site_df = pd.read_csv(site_df_path)
+    site_df = clean_site_data(site_df=site_df)
+    site_df["id"] = site_df["id"].astype(str)
+
+    changes = manifest.diff(site_df)
+    changed_site_ids = changes["new"] + changes["moved"]
+    removed_site_ids = changes["moved"] + changes["deleted"]
+
+    manifest.run_id += 1
+    removed_site_locations = manifest.site_locations(removed_site_ids)
+
+    ## Raw files of earlier versions that only covered moved or deleted sites
+    ## are dropped, responses in the append-only shards stay until the next
+    ## full fetch
+    for file_path in manifest.remove_sites(removed_site_ids):
+        if not is_raw_ref(file_path) and os.path.exists(file_path):
+            os.remove(file_path)
+
+    changed_site_df = site_df[site_df["id"].isin(changed_site_ids)].copy()
+    new_raw_files = []
+
+    if len(changed_site_df) > 0:
+        if query_planner is not None or len(changed_site_df) > max(
+            min_sample_size, min_samples
+        ):
+            changed_site_df = extract_clusters(
+                site_df=changed_site_df,
+                eps_km=eps_km,
+                min_sample_size=min_sample_size,
+                min_samples=min_samples,
+                query_planner=query_planner,
+            )
+        else:
+            changed_site_df["cluster"] = -1
+
+        if overpass_api is None:
+            overpass_api = default_overpass_api()
+
+        cluster_pois, individual_pois = extract_poi_data(
+            site_df=changed_site_df,
+            overpass_api=overpass_api,
+            around_batch_size=around_batch_size,
+            query_planner=query_planner,
+            radius_m=fetch_radius_m(proximity_radius_m, ring_radii_m),
+        )
+
+        ## Cluster keys of this run are prefixed with the run id so they do
+        ## not shadow the clusters of earlier runs in the raw index
+        with RawShardWriter(raw_dir) as raw_writer:
+            new_raw_files = save_raw_poi_data(
+                site_df=changed_site_df,
+                cluster_pois=cluster_pois,
+                individual_pois=individual_pois,
+                manifest=manifest,
+                raw_writer=raw_writer,
+                cluster_key_prefix=f"run{manifest.run_id}_",
+            )
 
     ### BRONZE LAYER
 
     ### SILVER LAYER
 
-    return transformation_pipeline(
-        site_df=site_df,
-        poi_json_file_paths=all_pois,
+    file_names, affected_site_ids = incremental_transformation_pipeline(
+        changed_site_df=changed_site_df,
+        removed_site_ids=removed_site_ids,
+        poi_json_file_paths=new_raw_files,
         output_dir=output_dir,
+        proximity_radius_m=proximity_radius_m,
+        read_workers=read_workers,
+        read_chunk_size=read_chunk_size,
+        category_workers=category_workers,
+        removed_site_locations=removed_site_locations,
+        fetch_radius_m=fetch_radius_m(proximity_radius_m, ring_radii_m),
     )
+
+    manifest.update_sites(changed_site_df)
+    manifest.save()
+
+    return file_names, affected_site_ids, removed_site_ids
     ### SILVER LAYER
@@ -2,7 +2,17 @@ import logging
 import numpy as np
 import hdbscan
 import pandas as pd
-from typing import List
+from typing import Dict, List, Optional, Tuple
+from src.utils.instrumentation import span
+
+## Private helpers of hdbscan (tested with the version pinned in
+## requirements.txt). Without them `ClusterSweep` fits every setting
+try:
+    from hdbscan._hdbscan_tree import condense_tree, compute_stability, get_clusters
+except ImportError:
+    condense_tree = compute_stability = get_clusters = None
+
+EARTH_RADIUS_KM = 6371.0088
 
 class ClustesSites:
     def __init__(
@@ -11,7 +21,7 @@ class ClustesSites:
             min_sample_size: int = 5,
             min_samples: int = 4):
 
-        self.eps_radian = eps_km / 6371.0088
+        self.eps_radian = eps_km / EARTH_RADIUS_KM
         self.clusterer = hdbscan.HDBSCAN(
             min_cluster_size=min_sample_size,
             min_samples=min_samples,
@@ -21,10 +31,95 @@ class ClustesSites:
         
 
     def predict_clusters(self,coords_rad: np.ndarray) -> List:
-        try:
-            clusters = self.clusterer.fit_predict(coords_rad)
-            logging.info(f"(ClusterSites): Successfully clustered sites.")
+        with span("hdbscan") as fit_span:
+            try:
+                clusters = self.clusterer.fit_predict(coords_rad)
+                logging.info(f"(ClusterSites): Successfully clustered sites.")
+            except Exception as e:
+                raise ValueError(f"Failed to create clusters.\n{e}")
+            fit_span.add(rows_in=len(coords_rad), rows_out=len(clusters))
             return clusters
-        except Exception as e:
-            raise ValueError(f"Failed to create clusters.\n{e}")
         
+
+
+class ClusterSweep:
+    """
+    Re-extracts HDBSCAN clusters for many parameter settings from cached
+    trees instead of refitting for each one.
+
+    The minimum spanning tree (the expensive part of a fit) only depends on
+    `min_samples`, the condensed tree additionally on `min_sample_size`, and
+    `eps_km` is only applied when the clusters are selected from it. Labels
+    are the same as `ClustesSites(...).predict_clusters(coords_rad)`.
+
+    The trees are reused through private parts of hdbscan. When the installed
+    release does not have them, every setting is fitted with `ClustesSites`.
+    """
+
+    def __init__(self, coords_rad: np.ndarray):
+        self.coords_rad = coords_rad
+        self.single_linkage_trees = {}
+        self.condensed_trees = {}
+        self.reuse_trees = get_clusters is not None
+        if not self.reuse_trees:
+            logging.warning(
+                "(ClusterSweep): hdbscan has no _hdbscan_tree helpers, fitting every setting."
+            )
+
+    def _single_linkage_tree(self, min_samples: int) -> Optional[np.ndarray]:
+        if min_samples not in self.single_linkage_trees:
+            with span("hdbscan", min_samples=min_samples) as fit_span:
+                clusterer = hdbscan.HDBSCAN(
+                    min_samples=min_samples, metric="haversine"
+                ).fit(self.coords_rad)
+                fit_span.add(rows_in=len(self.coords_rad))
+            self.single_linkage_trees[min_samples] = getattr(
+                clusterer, "_single_linkage_tree", None
+            )
+        return self.single_linkage_trees[min_samples]
+
+    def _condensed_tree(self, min_sample_size: int, min_samples: int) -> Optional[Tuple]:
+        key = (min_sample_size, min_samples)
+        if key not in self.condensed_trees:
+            single_linkage_tree = self._single_linkage_tree(min_samples)
+            if single_linkage_tree is None:
+                logging.warning(
+                    "(ClusterSweep): HDBSCAN has no _single_linkage_tree, fitting every setting."
+                )
+                self.reuse_trees = False
+                return None
+            condensed_tree = condense_tree(single_linkage_tree, min_sample_size)
+            self.condensed_trees[key] = (
+                condensed_tree,
+                compute_stability(condensed_tree),
+            )
+        return self.condensed_trees[key]
+
+    def predict_clusters(
+        self, eps_km: float, min_sample_size: int, min_samples: int
+    ) -> np.ndarray:
+        trees = (
+            self._condensed_tree(min_sample_size, min_samples)
+            if self.reuse_trees
+            else None
+        )
+        if trees is None:
+            return np.asarray(
+                ClustesSites(
+                    eps_km=eps_km,
+                    min_sample_size=min_sample_size,
+                    min_samples=min_samples,
+                ).predict_clusters(self.coords_rad)
+            )
+
+        condensed_tree, stability = trees
+        ## Excess of mass selection updates the stabilities in place
+        labels, _, _ = get_clusters(
+            condensed_tree,
+            dict(stability),
+            cluster_selection_method="eom",
+            allow_single_cluster=False,
+            match_reference_implementation=False,
+            cluster_selection_epsilon=eps_km / EARTH_RADIUS_KM,
+        )
+        return labels
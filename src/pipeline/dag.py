@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List, Optional
+
+PIPELINE_STATE_FILE_NAME = "pipeline_state.json"
+
+
+class Stage:
+    """
+    A step of the pipeline. `func` is called without arguments and must
+    write every path listed in `outputs`; `inputs` are the files or
+    directories it reads and `params` the settings that change its result.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        inputs: Optional[List[str]] = None,
+        outputs: Optional[List[str]] = None,
+        params: Optional[Dict] = None,
+        depends_on: Optional[List[str]] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.params = params or {}
+        self.depends_on = depends_on or []
+
+
+class FileHasher:
+    """
+    Content hashes of files and directories. Hashes are memoized by path,
+    size and modification time, so unchanged files are not read again.
+    """
+
+    def __init__(self, memo: Optional[Dict] = None):
+        self.memo = memo or {}
+        self.lock = threading.Lock()
+
+    def hash_file(self, path: str) -> str:
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            cached = self.memo.get(path)
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+
+        with self.lock:
+            self.memo[path] = key + [digest]
+        return digest
+
+    def hash_path(self, path: str) -> Optional[str]:
+        if os.path.isfile(path):
+            return self.hash_file(path)
+        if not os.path.isdir(path):
+            return None
+
+        sha = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                sha.update(os.path.relpath(file_path, path).encode())
+                sha.update(self.hash_file(file_path).encode())
+        return sha.hexdigest()
+
+
+class StageRunner:
+    """
+    Runs stages in dependency order and checkpoints every finished stage to a
+    JSON state file with the hashes of its inputs, parameters and outputs.
+
+    A stage is skipped when it finished before with the same input hashes and
+    parameters and its outputs are still untouched, so a rerun after a crash
+    resumes from the stage that failed. Stages whose dependencies are done run
+    concurrently on a thread pool.
+
+    With `stage_names` only those stages are run; their dependencies outside
+    of it are taken as done by an earlier run.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        state_path: str,
+        max_workers: int = 2,
+        force: bool = False,
+        stage_names: Optional[List[str]] = None,
+    ):
+        self.stages = {stage.name: stage for stage in stages}
+        self.stage_names = stage_names
+        self.state_path = state_path
+        self.max_workers = max_workers
+        self.force = force
+        self.lock = threading.Lock()
+
+        for stage in stages:
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(
+                        f"Stage '{stage.name}' depends on unknown stage '{dependency}'."
+                    )
+        for name in stage_names or []:
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage '{name}'.")
+
+        self.state = {"stages": {}, "file_hashes": {}}
+        if os.path.exists(state_path):
+            with open(state_path, "r") as file:
+                self.state = json.load(file)
+        self.hasher = FileHasher(memo=self.state.get("file_hashes"))
+
+    @staticmethod
+    def _params_hash(params: Dict) -> str:
+        return hashlib.sha256(
+            json.dumps(params, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _hash_paths(self, paths: List[str]) -> Dict:
+        return {path: self.hasher.hash_path(path) for path in paths}
+
+    def _save_state(self) -> None:
+        with self.lock:
+            self.state["file_hashes"] = self.hasher.memo
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(self.state, file, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+    def is_up_to_date(self, stage: Stage) -> bool:
+        if self.force:
+            return False
+
+        record = self.state["stages"].get(stage.name)
+        if record is None or record["status"] != "done":
+            return False
+        if record["params_hash"] != self._params_hash(stage.params):
+            return False
+        if record["input_hashes"] != self._hash_paths(stage.inputs):
+            return False
+
+        output_hashes = self._hash_paths(stage.outputs)
+        if any(digest is None for digest in output_hashes.values()):
+            return False
+        return record["output_hashes"] == output_hashes
+
+    def run_stage(self, stage: Stage) -> None:
+        if self.is_up_to_date(stage):
+            logging.info(f"(StageRunner): Skipping '{stage.name}', it is up to date.")
+            return
+
+        logging.info(f"(StageRunner): Running '{stage.name}'.")
+        start = time.perf_counter()
+        record = {
+            "params_hash": self._params_hash(stage.params),
+            "input_hashes": self._hash_paths(stage.inputs),
+        }
+        try:
+            stage.func()
+        except Exception as e:
+            record.update(status="failed", error=f"{type(e).__name__}: {e}")
+            with self.lock:
+                self.state["stages"][stage.name] = record
+            self._save_state()
+            raise
+
+        record.update(
+            status="done",
+            output_hashes=self._hash_paths(stage.outputs),
+            duration_s=round(time.perf_counter() - start, 3),
+        )
+        with self.lock:
+            self.state["stages"][stage.name] = record
+        self._save_state()
+        logging.info(
+            f"(StageRunner): Finished '{stage.name}' in {record['duration_s']}s."
+        )
+
+    def run(self) -> None:
+        pending = {
+            name: stage
+            for name, stage in self.stages.items()
+            if self.stage_names is None or name in self.stage_names
+        }
+        done = set(self.stages) - set(pending)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if set(stage.depends_on) <= done:
+                        ## Stages run in a copy of the caller's context so their
+                        ## spans are nested under the span of the whole run
+                        running[
+                            executor.submit(
+                                contextvars.copy_context().run, self.run_stage, stage
+                            )
+                        ] = name
+                        del pending[name]
+
+                if not running:
+                    raise ValueError(
+                        f"Stages {list(pending)} have circular dependencies."
+                    )
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    ## Let the other running stages finish and checkpoint
+                    ## before surfacing the failure
+                    if future.exception() is not None:
+                        wait(running)
+                        raise future.exception()
+                    done.add(name)
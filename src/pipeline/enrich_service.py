@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import socketserver
+import pandas as pd
+from urllib.parse import parse_qs, urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+from src.pipeline.enrich_sites import EnrichSites
+from src.pipeline.poi_features import TAG_FEATURES, tag_columns
+from src.pipeline.proximity import POIProximityIndex
+from src.pipeline.ring_features import RING_RADII_M, POIRingIndex
+from src.pipeline.schema import STRING_DTYPE
+from src.pipeline.spill import read_dataset
+from src.pipeline.transforms import POI_LOCATION_COLUMNS, POI_STAGING_DATASETS
+from src.utils.instrumentation import INSTRUMENTATION
+
+## Seconds between two checks of the staging data for a new version
+RELOAD_INTERVAL_S = 5.0
+## Spans kept by the service, every request adds a few
+MAX_SPANS = 10000
+
+
+def staging_version(output_dir: str) -> Tuple:
+    """
+    (path, size, mtime) of every file of the POI staging datasets. The
+    pipeline replaces the files of a dataset when it writes it, so any
+    change to the staging POIs changes the version.
+    """
+    files = []
+    for dataset_name in POI_STAGING_DATASETS.values():
+        dataset_path = os.path.join(output_dir, dataset_name)
+        paths = [dataset_path] if os.path.isfile(dataset_path) else [
+            os.path.join(root, name)
+            for root, _, names in os.walk(dataset_path)
+            for name in names
+        ]
+        for path in paths:
+            stat = os.stat(path)
+            files.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(files))
+
+
+def sites_frame(sites: List[Dict]) -> pd.DataFrame:
+    """
+    Site data of a request: every site needs 'lat' and 'lon', 'site_id'
+    defaults to the position of the site in the request and any other
+    attributes are passed through to the feature row.
+    """
+    if (
+        not isinstance(sites, list)
+        or not sites
+        or not all(isinstance(site, dict) for site in sites)
+    ):
+        raise ValueError("Expected a site object or a list of site objects.")
+    site_data = pd.DataFrame(sites)
+    for column in ["lat", "lon"]:
+        if column not in site_data.columns or site_data[column].isna().any():
+            raise ValueError(f"Every site needs '{column}'.")
+        site_data[column] = pd.to_numeric(site_data[column]).astype(float)
+
+    positions = pd.Series(range(len(site_data)), index=site_data.index).astype(str)
+    site_ids = (
+        site_data["site_id"].where(site_data["site_id"].notna(), positions)
+        if "site_id" in site_data.columns
+        else positions
+    )
+    site_data["site_id"] = site_ids.astype(str).astype(STRING_DTYPE)
+    return site_data
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class ServiceLogFilter(logging.Filter):
+    ## The pipeline steps log at INFO, which the service would repeat on
+    ## every request
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or record.getMessage().startswith(
+            "(EnrichmentService)"
+        )
+
+
+class EnrichmentSnapshot:
+    """
+    The staging POIs of `output_dir` loaded once, with the proximity index
+    and the ring index built over them. A snapshot is never changed after
+    it is loaded, so requests can use it while the next one is built.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        proximity_radius_m: float = 100,
+        ring_radii_m: List[float] = RING_RADII_M,
+        tag_features: Dict = TAG_FEATURES,
+    ):
+        self.proximity_radius_m = proximity_radius_m
+        self.ring_radii_m = ring_radii_m
+        self.tag_features = tag_features
+        ## Taken before reading, a write during the load is picked up by the
+        ## next check
+        self.version = staging_version(output_dir)
+        self.loaded_at = time.time()
+
+        poi_columns = POI_LOCATION_COLUMNS + tag_columns(tag_features)
+        self.poi_data = {
+            category: read_dataset(
+                os.path.join(output_dir, dataset_name), columns=poi_columns
+            )
+            for category, dataset_name in POI_STAGING_DATASETS.items()
+        }
+        self.proximity_index = POIProximityIndex(
+            pd.concat(
+                [poi_df[POI_LOCATION_COLUMNS] for poi_df in self.poi_data.values()],
+                ignore_index=True,
+            )
+        )
+        self.ring_index = POIRingIndex(self.poi_data)
+        self.num_pois = sum(len(poi_df) for poi_df in self.poi_data.values())
+
+    def enrich(self, site_data: pd.DataFrame) -> pd.DataFrame:
+        """
+        The enriched rows of `site_data`, as `EnrichSites` computes them in
+        the golden layer.
+        """
+        proximity_data = self.proximity_index.query_radius(
+            site_data, radius_m=self.proximity_radius_m
+        )
+        ## Only the tags of the POIs near the sites are evaluated
+        poi_ids = proximity_data["poi_id"].unique()
+        nearby_pois = {
+            category: poi_df[poi_df["poi_id"].isin(poi_ids)]
+            for category, poi_df in self.poi_data.items()
+        }
+        return EnrichSites(
+            site_data_path=site_data,
+            fast_food_data_path=nearby_pois["fast_food"],
+            supermarket_data_path=nearby_pois["supermarket"],
+            fuel_data_path=nearby_pois["fuel"],
+            proximity_data_path=proximity_data,
+            tag_features=self.tag_features,
+            ring_radii_m=self.ring_radii_m,
+            ring_index=self.ring_index,
+        ).enirch_site_data_with_features()
+
+
+class EnrichmentService:
+    """
+    Long-running enrichment of single sites or batches of sites against the
+    staging POIs of a pipeline run, without rerunning the pipeline.
+
+    The staging POIs and their spatial indexes are loaded once into an
+    `EnrichmentSnapshot`. A watcher thread checks the staging data every
+    `reload_interval_s` and, once a new version has stopped changing for one
+    interval, loads it in the background and swaps it in. Requests in flight
+    finish on the snapshot they started with, and a failed load keeps the
+    current snapshot.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        proximity_radius_m: float = 100,
+        ring_radii_m: List[float] = RING_RADII_M,
+        tag_features: Dict = TAG_FEATURES,
+        reload_interval_s: float = RELOAD_INTERVAL_S,
+    ):
+        self.output_dir = output_dir
+        self.snapshot_kwargs = dict(
+            proximity_radius_m=proximity_radius_m,
+            ring_radii_m=ring_radii_m,
+            tag_features=tag_features,
+        )
+        self.reload_interval_s = reload_interval_s
+        self.reload_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watcher = None
+        self.num_reloads = 0
+        self.snapshot = self._load()
+
+    def _load(self) -> EnrichmentSnapshot:
+        start = time.perf_counter()
+        snapshot = EnrichmentSnapshot(self.output_dir, **self.snapshot_kwargs)
+        logging.info(
+            f"(EnrichmentService): Loaded {snapshot.num_pois} POIs from {self.output_dir} in {time.perf_counter() - start:.2f}s."
+        )
+        return snapshot
+
+    def reload(self) -> bool:
+        """
+        Loads the staging data again and swaps it in. Returns False when the
+        load failed and the current snapshot is kept.
+        """
+        with self.reload_lock:
+            try:
+                snapshot = self._load()
+            except Exception:
+                logging.exception(
+                    "(EnrichmentService): Reload failed, serving the current snapshot."
+                )
+                return False
+            self.snapshot = snapshot
+            self.num_reloads += 1
+            return True
+
+    def _watch(self) -> None:
+        pending_version = None
+        while not self.stopped.wait(self.reload_interval_s):
+            try:
+                version = staging_version(self.output_dir)
+            except OSError:
+                ## Files replaced while they were listed
+                continue
+            if version == self.snapshot.version:
+                pending_version = None
+            elif version != pending_version:
+                ## Still being written, wait until it settles
+                pending_version = version
+            else:
+                self.reload()
+
+    def start_watcher(self) -> None:
+        self.watcher = threading.Thread(
+            target=self._watch, name="staging-watcher", daemon=True
+        )
+        self.watcher.start()
+
+    def enrich(self, sites: List[Dict]) -> pd.DataFrame:
+        return self.snapshot.enrich(sites_frame(sites))
+
+    def health(self) -> Dict:
+        snapshot = self.snapshot
+        return {
+            "status": "ok",
+            "output_dir": self.output_dir,
+            "num_pois": snapshot.num_pois,
+            "loaded_at": snapshot.loaded_at,
+            "num_reloads": self.num_reloads,
+        }
+
+    def handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status: int, body: str) -> None:
+                body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def enrich(self, request) -> None:
+                ## A site object returns its row, a list of sites (or
+                ## {"sites": [...]}) returns {"sites": [rows]}
+                if isinstance(request, dict) and "sites" in request:
+                    sites, is_batch = request["sites"], True
+                elif isinstance(request, list):
+                    sites, is_batch = request, True
+                else:
+                    sites, is_batch = [request], False
+                try:
+                    enriched = service.enrich(sites)
+                except (ValueError, TypeError) as error:
+                    self.send_json(400, json.dumps({"error": str(error)}))
+                    return
+                rows = enriched.to_json(orient="records")
+                self.send_json(200, f'{{"sites": {rows}}}' if is_batch else rows[1:-1])
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/health":
+                    self.send_json(200, json.dumps(service.health()))
+                elif url.path == "/enrich":
+                    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    self.enrich(query)
+                else:
+                    self.send_json(404, json.dumps({"error": "Not found."}))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                url = urlparse(self.path)
+                if url.path == "/enrich":
+                    try:
+                        request = json.loads(body)
+                    except ValueError:
+                        self.send_json(400, json.dumps({"error": "Invalid JSON."}))
+                        return
+                    self.enrich(request)
+                elif url.path == "/reload":
+                    status = 200 if service.reload() else 500
+                    self.send_json(status, json.dumps(service.health()))
+                else:
+                    self.send_json(404, json.dumps({"error": "Not found."}))
+
+        return Handler
+
+    def serve(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8765,
+        unix_socket: Optional[str] = None,
+    ) -> None:
+        """
+        Serves the HTTP endpoints on `host`:`port`, or on the Unix socket
+        `unix_socket`, until interrupted:
+
+            GET  /health
+            GET  /enrich?lat=<lat>&lon=<lon>[&site_id=<id>]
+            POST /enrich   {"lat": ..., "lon": ...} or {"sites": [...]}
+            POST /reload
+        """
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            httpd = UnixHTTPServer(unix_socket, self.handler())
+            address = unix_socket
+        else:
+            httpd = ThreadingHTTPServer((host, port), self.handler())
+            address = f"http://{host}:{httpd.server_address[1]}"
+        httpd.daemon_threads = True
+
+        self.start_watcher()
+        logging.info(f"(EnrichmentService): Serving on {address}.")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            httpd.server_close()
+            if unix_socket is not None and os.path.exists(unix_socket):
+                os.remove(unix_socket)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for log_handler in logging.getLogger().handlers:
+        log_handler.addFilter(ServiceLogFilter())
+    parser = argparse.ArgumentParser(
+        description="Serve the enrichment of single sites against the staging POIs of a pipeline run."
+    )
+
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Staging directory ('--output_dir') of the pipeline run.",
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Host the HTTP endpoint binds to.",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port of the HTTP endpoint.",
+    )
+
+    parser.add_argument(
+        "--unix_socket",
+        type=str,
+        default=None,
+        help="Serve on this Unix socket instead of '--host' and '--port'.",
+    )
+
+    parser.add_argument(
+        "--proximity_radius_m",
+        type=float,
+        default=100,
+        help="Radius in meters around a site within which POIs are considered nearby.",
+    )
+
+    parser.add_argument(
+        "--ring_radii_m",
+        type=float,
+        nargs="+",
+        default=RING_RADII_M,
+        help="Radii in meters within which the POIs of every category are counted around each site.",
+    )
+
+    parser.add_argument(
+        "--reload_interval_s",
+        type=float,
+        default=RELOAD_INTERVAL_S,
+        help="Seconds between two checks of the staging data for new POIs.",
+    )
+
+    args = parser.parse_args()
+
+    INSTRUMENTATION.configure(max_spans=MAX_SPANS)
+    EnrichmentService(
+        output_dir=args.output_dir,
+        proximity_radius_m=args.proximity_radius_m,
+        ring_radii_m=args.ring_radii_m,
+        reload_interval_s=args.reload_interval_s,
+    ).serve(host=args.host, port=args.port, unix_socket=args.unix_socket)
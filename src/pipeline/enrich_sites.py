@@ -1,169 +1,301 @@
 import numpy as np
 import pandas as pd
-from src.utils.helpers import read_intermediate_data, is_open_24_7
+from typing import Dict, List, Optional, Union
+from src.pipeline.spill import read_dataset
+from src.pipeline.poi_features import TAG_FEATURES, extract_tag_features, tag_columns
+from src.pipeline.ring_features import RING_RADII_M, POIRingIndex
+from src.utils.helpers import map_in_order
+from src.utils.instrumentation import span
+
+CATEGORY_COUNT_COLUMNS = {
+    "fast_food": "num_fast_food",
+    "fuel": "num_fuel_stations",
+    "supermarket": "num_supermarkets",
+}
+CATEGORIES = list(CATEGORY_COUNT_COLUMNS)
+## Number of brands kept per site, most frequent first
+TOP_BRANDS = 3
+
+
+def category_code(category: pd.Series) -> np.ndarray:
+    """
+    Position of every category in `CATEGORIES` (-1 when unknown), compared
+    column-wise which is much faster than mapping string values.
+    """
+    return np.select(
+        [(category == name).to_numpy(dtype=bool) for name in CATEGORIES],
+        range(len(CATEGORIES)),
+        default=-1,
+    )
+
+
+def merge_enriched_site_data(
+    existing_enriched_df: pd.DataFrame,
+    enriched_df: pd.DataFrame,
+    replaced_site_ids: List,
+) -> pd.DataFrame:
+    """
+    Replaces the rows of `replaced_site_ids` in an existing enriched dataset
+    with the freshly enriched rows.
+    """
+    existing_enriched_df = existing_enriched_df[
+        ~existing_enriched_df["site_id"].astype(str).isin(
+            [str(site_id) for site_id in replaced_site_ids]
+        )
+    ]
+    return pd.concat([existing_enriched_df, enriched_df], ignore_index=True)
+
+
+def load_data(
+    data: Union[str, pd.DataFrame],
+    columns: Optional[List[str]] = None,
+    filters: Optional[List] = None,
+) -> pd.DataFrame:
+    ## Staging datasets are read with `columns` and `filters` pushed down,
+    ## DataFrames are filtered by the caller
+    if isinstance(data, pd.DataFrame):
+        return data
+    return read_dataset(data, columns=columns, filters=filters)
 
 
 class EnrichSites:
+    ## The *_path arguments also take DataFrames that are already in memory
     def __init__(
         self,
-        site_data_path: str,
-        fast_food_data_path: str,
-        supermarket_data_path: str,
-        fuel_data_path: str,
-        proximity_data_path: str,
+        site_data_path: Union[str, pd.DataFrame],
+        fast_food_data_path: Union[str, pd.DataFrame],
+        supermarket_data_path: Union[str, pd.DataFrame],
+        fuel_data_path: Union[str, pd.DataFrame],
+        proximity_data_path: Union[str, pd.DataFrame],
+        site_ids: Optional[List] = None,
+        tag_features: Dict = TAG_FEATURES,
+        ring_radii_m: List[float] = RING_RADII_M,
+        ring_index: Optional[POIRingIndex] = None,
+        load_workers: int = 1,
     ):
 
-        self.site_data = read_intermediate_data(file_path=site_data_path)
-        self.fast_food_data = read_intermediate_data(file_path=fast_food_data_path)
-        self.supermarket_data = read_intermediate_data(
-            file_path=supermarket_data_path
-        )
-        self.fuel_data = read_intermediate_data(file_path=fuel_data_path)
-        self.proximity_data = read_intermediate_data(
-            file_path=proximity_data_path
-        )
-        self.site_enriched_data = self.site_data
+        self.tag_features = tag_features
+        self.ring_radii_m = ring_radii_m
+        self.flag_columns = list(tag_features)
+        poi_columns = ["poi_id"] + tag_columns(tag_features)
 
-    def site_poi_counts(self) -> pd.DataFrame:
-        return (
-            self.proximity_data.groupby("site_id")
-            .size()
-            .reset_index(name="total_num_pois")
+        ## Restricting the enrichment to a subset of sites (incremental runs).
+        ## Only the tiles of these sites and the POIs near them are read.
+        site_filters, proximity_filters, poi_filters = None, None, None
+        if site_ids is not None:
+            site_filters = [("site_id", "in", list(site_ids))]
+            proximity_filters = site_filters
+            if isinstance(site_data_path, str):
+                site_tiles = load_data(
+                    site_data_path, columns=["tile"], filters=site_filters
+                )
+                if "tile" in site_tiles.columns:
+                    proximity_filters = site_filters + [
+                        ("tile", "in", list(site_tiles["tile"].unique()))
+                    ]
+
+        ## The site and proximity data are read side by side, then the POIs
+        self.site_data, self.proximity_data = map_in_order(
+            lambda load: load_data(*load),
+            [
+                (site_data_path, None, site_filters),
+                (proximity_data_path, None, proximity_filters),
+            ],
+            max_workers=load_workers,
+            thread_name_prefix="enrich-load",
         )
+        if site_ids is not None:
+            self.site_data = self.site_data[
+                self.site_data["site_id"].isin(site_ids)
+            ]
+            self.proximity_data = self.proximity_data[
+                self.proximity_data["site_id"].isin(site_ids)
+            ]
+            poi_filters = [
+                ("poi_id", "in", list(self.proximity_data["poi_id"].unique()))
+            ]
 
-    def poi_category_counts(self) -> pd.DataFrame:
-        return (
-            self.proximity_data.groupby(["site_id", "category"])
-            .size()
-            .unstack(fill_value=0)
-            .rename(
-                columns={
-                    "supermarket": "num_supermarkets",
-                    "fast_food": "num_fast_food",
-                    "fuel": "num_fuel_stations",
-                }
-            )
+        ## The rings reach beyond the proximity radius, so they are counted
+        ## over the coordinates of all POIs (DataFrames need 'lat' and 'lon'),
+        ## unless an index built over them is passed in. Without a filter the
+        ## POIs read for the features are all POIs and are used for both.
+        poi_paths = {
+            "fast_food": fast_food_data_path,
+            "fuel": fuel_data_path,
+            "supermarket": supermarket_data_path,
+        }
+        shares_locations = ring_index is None and poi_filters is None
+        if shares_locations:
+            poi_columns = poi_columns + ["lat", "lon"]
+        loads = [(path, poi_columns, poi_filters) for path in poi_paths.values()]
+        if ring_index is None and not shares_locations:
+            loads += [(path, ["lat", "lon"]) for path in poi_paths.values()]
+        poi_data = map_in_order(
+            lambda load: load_data(*load),
+            loads,
+            max_workers=load_workers,
+            thread_name_prefix="enrich-load",
         )
 
-    def closest_poi_category(self) -> pd.DataFrame:
-        closest_rows = self.proximity_data.loc[
-            self.proximity_data.groupby("site_id")["distance_m"].idxmin()
-        ]
+        self.fast_food_data, self.fuel_data, self.supermarket_data = poi_data[:3]
+        self.ring_index = ring_index
+        self.poi_locations = None
+        if ring_index is None:
+            self.poi_locations = dict(
+                zip(poi_paths, poi_data[:3] if shares_locations else poi_data[3:])
+            )
+        self.site_enriched_data = self.site_data
 
-        closest_category = closest_rows[["site_id", "category"]].rename(
-            columns={"category": "closest_category"}
+    def extract_poi_data_features(self) -> pd.DataFrame:
+        return extract_tag_features(
+            {
+                "fast_food": self.fast_food_data,
+                "fuel": self.fuel_data,
+                "supermarket": self.supermarket_data,
+            },
+            tag_features=self.tag_features,
         )
-        return closest_category
 
-    def extract_poi_data_features(self):
-        poi_dfs = [self.fast_food_data, self.fuel_data, self.supermarket_data]
-        categories = ["fast_food", "fuel", "supermarket"]
+    def site_poi_features(self) -> pd.DataFrame:
+        """
+        Aggregates the POIs near every site in one grouped pass over the
+        proximity data joined with the POI features: counts, counts per
+        category, any-POI flags, the closest category and the most frequent
+        brands. Returns one row per site that has POIs nearby.
 
-        poi_feature_dfs = []
+        The sites are factorized once and every aggregate is a bincount or
+        a sort over the integer site codes.
+        """
+        columns = (
+            ["site_id", "total_num_pois"]
+            + list(CATEGORY_COUNT_COLUMNS.values())
+            + ["closest_category"]
+            + self.flag_columns
+            + ["top_brands"]
+        )
+        site_pois = self.proximity_data
+        if site_pois.empty:
+            return pd.DataFrame(columns=columns)
 
-        for df, category in zip(poi_dfs, categories):
-            df = df.copy()
-            df["poi_id"] = df["poi_id"]
-            df["category"] = category
+        site_codes, site_ids = pd.factorize(site_pois["site_id"])
+        if isinstance(site_ids, pd.Categorical):
+            ## Dictionary-encoded ids, the sites are matched on their values
+            site_ids = site_ids.categories.take(site_ids.codes)
+        num_sites = len(site_ids)
+        category_codes = category_code(site_pois["category"])
 
-            if "tags.toilets" in df.columns:
-                df["has_toilet"] = (
-                    df["tags.toilets"].fillna("").str.lower() == "yes"
-                )
-            else:
-                df["has_toilet"] = False
+        ## POI features looked up by an integer (poi_id, category) key, the
+        ## first row of a duplicated POI wins
+        poi_features = self.extract_poi_data_features()
+        feature_keys = poi_features["poi_id"].to_numpy(dtype=np.int64) * len(
+            CATEGORIES
+        ) + category_code(poi_features["category"])
+        is_first = ~pd.Index(feature_keys).duplicated()
+        feature_rows = pd.Index(feature_keys[is_first]).get_indexer(
+            site_pois["poi_id"].to_numpy(dtype=np.int64) * len(CATEGORIES)
+            + category_codes
+        )
+        has_features = feature_rows >= 0
+        poi_features = poi_features[is_first].take(np.maximum(feature_rows, 0))
 
-            internet = (
-                df["tags.internet_access"].fillna("")
-                if "tags.internet_access" in df.columns
-                else pd.Series("", index=df.index)
-            )
-            wifi = (
-                df["tags.wifi"].fillna("")
-                if "tags.wifi" in df.columns
-                else pd.Series("", index=df.index)
-            )
-            df["has_wifi"] = internet.str.contains(
-                "yes|wlan", case=False, na=False
-            ) | wifi.str.lower().eq("yes")
-
-            indoor = (
-                df["tags.indoor_seating"].fillna("")
-                if "tags.indoor_seating" in df.columns
-                else pd.Series("", index=df.index)
-            )
-            outdoor = (
-                df["tags.outdoor_seating"].fillna("")
-                if "tags.outdoor_seating" in df.columns
-                else pd.Series("", index=df.index)
+        site_features = pd.DataFrame(
+            {
+                "site_id": site_ids,
+                "total_num_pois": pd.array(
+                    np.bincount(site_codes, minlength=num_sites), dtype="Int32"
+                ),
+            }
+        )
+        for code, column in enumerate(CATEGORY_COUNT_COLUMNS.values()):
+            site_features[column] = pd.array(
+                np.bincount(
+                    site_codes, weights=category_codes == code, minlength=num_sites
+                ).astype(np.int32),
+                dtype="Int32",
             )
-            df["has_seating"] = indoor.str.lower().eq(
-                "yes"
-            ) | outdoor.str.lower().eq("yes")
-
-            if "tags.opening_hours" in df.columns:
-                df["open_24hr"] = df["tags.opening_hours"].apply(is_open_24_7)
-            else:
-                df["open_24hr"] = False
 
-            df["tags.brand"] = (
-                df["tags.brand"] if "tags.brand" in df.columns else np.nan
-            )
+        ## The first of the nearest POIs, as idxmin would pick it
+        order = np.lexsort((site_pois["distance_m"].to_numpy(), site_codes))
+        is_closest = np.r_[True, site_codes[order][1:] != site_codes[order][:-1]]
+        site_features["closest_category"] = (
+            site_pois["category"].take(order[is_closest]).to_numpy()
+        )
 
-            poi_feature_dfs.append(
-                df[
-                    [
-                        "poi_id",
-                        "category",
-                        "has_toilet",
-                        "has_wifi",
-                        "has_seating",
-                        "open_24hr",
-                        "tags.brand",
-                    ]
-                ]
+        for flag in self.flag_columns:
+            is_set = has_features & poi_features[flag].fillna(False).to_numpy(dtype=bool)
+            site_features[flag] = pd.array(
+                np.bincount(site_codes, weights=is_set, minlength=num_sites) > 0,
+                dtype="boolean",
             )
 
-        poi_features_df = pd.concat(poi_feature_dfs, ignore_index=True)
-        return poi_features_df
+        brands = poi_features["tags.brand"].reset_index(drop=True).where(has_features)
+        site_features["top_brands"] = self.top_brands(site_codes, brands, num_sites)
+        return site_features[columns]
 
-    def enirch_site_data_with_features(self) -> pd.DataFrame:
-        ## Enrich with total POI counts
-        self.site_enriched_data = self.site_enriched_data.merge(
-            self.site_poi_counts(), on="site_id", how="left"
+    @staticmethod
+    def top_brands(site_codes: np.ndarray, brands: pd.Series, num_sites: int) -> np.ndarray:
+        """
+        The `TOP_BRANDS` most frequent brands near every site, ties by name,
+        joined with ';' (None for sites without branded POIs).
+        """
+        has_brand = brands.notna().to_numpy()
+        brand_codes, brand_names = pd.factorize(brands[has_brand], sort=True)
+        pair_codes, pair_counts = np.unique(
+            site_codes[has_brand].astype(np.int64) * max(len(brand_names), 1)
+            + brand_codes,
+            return_counts=True,
         )
-        self.site_enriched_data = self.site_enriched_data.fillna(0)
+        pair_sites = pair_codes // max(len(brand_names), 1)
+        pair_brands = pair_codes % max(len(brand_names), 1)
 
-        ## Enrich with total POI count per category
-        self.site_enriched_data = self.site_enriched_data.merge(
-            self.poi_category_counts(), on="site_id", how="left"
+        order = np.lexsort((pair_brands, -pair_counts, pair_sites))
+        pair_sites, pair_brands = pair_sites[order], pair_brands[order]
+        group_start = np.flatnonzero(np.r_[True, pair_sites[1:] != pair_sites[:-1]])
+        rank = np.arange(len(pair_sites)) - np.repeat(
+            group_start, np.diff(np.r_[group_start, len(pair_sites)])
         )
-        self.site_enriched_data = self.site_enriched_data.fillna(0)
 
-        ## Enrich with closest POI category
-        self.site_enriched_data = self.site_enriched_data.merge(
-            self.closest_poi_category(), on="site_id", how="left"
-        )
+        top_brands = np.full(num_sites, None, dtype=object)
+        brand_names = np.asarray(brand_names, dtype=object)
+        for position in range(TOP_BRANDS):
+            selected = rank == position
+            sites = pair_sites[selected]
+            names = brand_names[pair_brands[selected]]
+            if position == 0:
+                top_brands[sites] = names
+            else:
+                top_brands[sites] = top_brands[sites] + ";" + names
+        return top_brands
 
-        ##
-        poi_features = self.extract_poi_data_features()
+    def enirch_site_data_with_features(self) -> pd.DataFrame:
+        with span("enrich_features") as enrich_span:
+            site_features = self.site_poi_features()
+            self.site_enriched_data = self.site_data.merge(
+                site_features, on="site_id", how="left"
+            )
 
-        poi_features = self.proximity_data.merge(
-            poi_features, on=["poi_id", "category"], how="left"
-        )
+            ## Sites without POIs nearby have zero counts and no flags set
+            count_columns = ["total_num_pois"] + list(CATEGORY_COUNT_COLUMNS.values())
+            self.site_enriched_data[count_columns] = (
+                self.site_enriched_data[count_columns].fillna(0).astype("int32")
+            )
+            self.site_enriched_data[self.flag_columns] = (
+                self.site_enriched_data[self.flag_columns].fillna(False).astype("boolean")
+            )
 
-        self.site_enriched_data = self.site_enriched_data.merge(
-            poi_features[
+            ## The left merge keeps the rows of the site data in order
+            with span("ring_features", radii=len(self.ring_radii_m)):
+                ring_index = self.ring_index or POIRingIndex(self.poi_locations)
+                rings = ring_index.features(self.site_data, radii_m=self.ring_radii_m)
+            self.site_enriched_data = pd.concat(
                 [
-                    "site_id",
-                    "has_toilet",
-                    "has_wifi",
-                    "has_seating",
-                    "open_24hr",
-                    "tags.brand",
-                ]
-            ],
-            on="site_id",
-            how="left",
-        )
-        return self.site_enriched_data
\ No newline at end of file
+                    self.site_enriched_data.reset_index(drop=True),
+                    rings.reset_index(drop=True),
+                ],
+                axis=1,
+            )
+
+            enrich_span.add(
+                rows_in=len(self.site_data), rows_out=len(self.site_enriched_data)
+            )
+            return self.site_enriched_data
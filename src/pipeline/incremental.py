@@ -0,0 +1,141 @@
+import os
+import json
+import logging
+import pandas as pd
+from typing import Dict, List
+
+SITE_MANIFEST_FILE_NAME = "site_manifest.json"
+
+
+class SiteManifest:
+    """
+    Records the fingerprint (id + coordinates) and the location of every site
+    that is part of the staging and mart outputs, and which raw POI files
+    cover which sites.
+    Comparing a new site file against it tells an incremental run which sites
+    are new, moved or deleted, so only those have to be processed again.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.sites = {}
+        self.locations = {}
+        self.raw_files = {}
+        self.run_id = 0
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                manifest = json.load(file)
+            self.sites = manifest["sites"]
+            ## Manifests written before the locations were recorded have none
+            self.locations = manifest.get("locations", {})
+            self.raw_files = manifest["raw_files"]
+            self.run_id = manifest["run_id"]
+
+    def reset(self) -> None:
+        self.sites = {}
+        self.locations = {}
+        self.raw_files = {}
+
+    @property
+    def exists(self) -> bool:
+        return len(self.sites) > 0
+
+    @staticmethod
+    def fingerprint_sites(site_df: pd.DataFrame) -> pd.Series:
+        keys = pd.DataFrame(
+            {
+                "id": site_df["id"].astype(str).to_numpy(),
+                "lat": site_df["lat"].round(7).to_numpy(),
+                "lon": site_df["lon"].round(7).to_numpy(),
+            }
+        )
+        fingerprints = pd.util.hash_pandas_object(keys, index=False)
+        return pd.Series(
+            fingerprints.astype(str).to_numpy(),
+            index=site_df["id"].astype(str).to_numpy(),
+        )
+
+    def diff(self, site_df: pd.DataFrame) -> Dict[str, List]:
+        fingerprints = self.fingerprint_sites(site_df)
+        fingerprints = fingerprints[~fingerprints.index.duplicated(keep="last")]
+        previous = pd.Series(self.sites, dtype=str)
+
+        known = fingerprints.index.isin(previous.index)
+        unchanged = known & (
+            fingerprints.to_numpy()
+            == previous.reindex(fingerprints.index).to_numpy()
+        )
+
+        changes = {
+            "new": fingerprints.index[~known].tolist(),
+            "moved": fingerprints.index[known & ~unchanged].tolist(),
+            "deleted": previous.index[
+                ~previous.index.isin(fingerprints.index)
+            ].tolist(),
+            "unchanged": fingerprints.index[unchanged].tolist(),
+        }
+        logging.info(
+            "(Manifest): "
+            + ", ".join(f"{len(ids)} {kind}" for kind, ids in changes.items())
+            + " sites."
+        )
+        return changes
+
+    def update_sites(self, site_df: pd.DataFrame) -> None:
+        self.sites.update(self.fingerprint_sites(site_df).to_dict())
+        self.locations.update(
+            zip(
+                site_df["id"].astype(str),
+                zip(site_df["lat"].astype(float), site_df["lon"].astype(float)),
+            )
+        )
+
+    def site_locations(self, site_ids: List) -> pd.DataFrame:
+        ## 'site_id', 'lat' and 'lon' of the sites whose location is recorded
+        known = [site_id for site_id in site_ids if site_id in self.locations]
+        return pd.DataFrame(
+            [(site_id, *self.locations[site_id]) for site_id in known],
+            columns=["site_id", "lat", "lon"],
+        )
+
+    def remove_sites(self, site_ids: List) -> List[str]:
+        """
+        Removes sites from the manifest and from the coverage of the raw files.
+
+        Returns:
+            List[str]: Raw files that no longer cover any site.
+        """
+        site_ids = set(site_ids)
+        for site_id in site_ids:
+            self.sites.pop(site_id, None)
+            self.locations.pop(site_id, None)
+
+        orphaned_files = []
+        for file_path, covered_site_ids in list(self.raw_files.items()):
+            remaining = [s for s in covered_site_ids if s not in site_ids]
+            if remaining:
+                self.raw_files[file_path] = remaining
+            else:
+                orphaned_files.append(file_path)
+                del self.raw_files[file_path]
+        return orphaned_files
+
+    def add_raw_file(self, file_path: str, site_ids: List) -> None:
+        self.raw_files[file_path] = [str(site_id) for site_id in site_ids]
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(
+                {
+                    "run_id": self.run_id,
+                    "sites": self.sites,
+                    "locations": self.locations,
+                    "raw_files": self.raw_files,
+                },
+                file,
+            )
+        os.replace(tmp_path, self.manifest_path)
+        logging.info(f"(Manifest): Saved {len(self.sites)} sites to {self.manifest_path}.")
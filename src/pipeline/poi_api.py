@@ -1,10 +1,102 @@
+import time
+import random
+import logging
+import threading
+import contextvars
 import requests
-from typing import Dict, List
+import numpy as np
+from tqdm import tqdm
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+from src.pipeline.poi_cache import OverpassResponseCache
+from src.utils.instrumentation import span, record_io
+
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class OverpassQueryError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all fetch workers. Every request takes
+    one token, tokens refill at `rate` per second up to `capacity`, and a
+    Retry-After from the server pauses the whole bucket.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(
+                        self.capacity,
+                        self.tokens + (now - self.updated_at) * self.rate,
+                    )
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(
+                self.paused_until, time.monotonic() + seconds
+            )
+            self.tokens = 0
+            self.updated_at = self.paused_until
 
 
 class OverPassAPI:
-    def __init__(self):
-        self.overpass_url = "https://overpass-api.de/api/interpreter"
+    def __init__(
+        self,
+        overpass_url: str = "https://overpass-api.de/api/interpreter",
+        max_workers: int = 2,
+        requests_per_second: float = 1.0,
+        burst: int = 2,
+        max_retries: int = 5,
+        backoff_base_s: float = 1.0,
+        backoff_max_s: float = 60.0,
+        timeout_s: float = 180.0,
+        cache: Optional[OverpassResponseCache] = None,
+    ):
+        self.overpass_url = overpass_url
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.timeout_s = timeout_s
+        self._init_transport(requests_per_second=requests_per_second, burst=burst)
+        self.request_stats = []
+        self.stats_lock = threading.Lock()
+
+    def _init_transport(self, requests_per_second: float, burst: int) -> None:
+        ## Keep-alive connections shared by all workers and the rate limit
+        ## of the server, used by `_post_query`
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.rate_limiter = TokenBucket(
+            rate=requests_per_second, capacity=burst
+        )
 
     def build_bbox_query(self, bbox: Dict) -> str:
         return f"""
@@ -23,29 +115,224 @@ class OverPassAPI:
         """
 
     def build_around_query(
-        self, lat: float, lon: float, radius: int = 100
+        self, lat: float, lon: float, radius: float = 100
     ) -> str:
         return f"""
         [out:json][timeout:30];
         (
-        node["shop"~"supermarket|convenience"](around:{radius},{lat},{lon});
-        way["shop"~"supermarket|convenience"](around:{radius},{lat},{lon});
+        node["shop"~"supermarket|convenience"](around:{radius:g},{lat},{lon});
+        way["shop"~"supermarket|convenience"](around:{radius:g},{lat},{lon});
 
-        node["amenity"="fast_food"](around:{radius},{lat},{lon});
-        way["amenity"="fast_food"](around:{radius},{lat},{lon});
+        node["amenity"="fast_food"](around:{radius:g},{lat},{lon});
+        way["amenity"="fast_food"](around:{radius:g},{lat},{lon});
 
-        node["amenity"="fuel"](around:{radius},{lat},{lon});
-        way["amenity"="fuel"](around:{radius},{lat},{lon});
+        node["amenity"="fuel"](around:{radius:g},{lat},{lon});
+        way["amenity"="fuel"](around:{radius:g},{lat},{lon});
         );
         out center;
         """
 
+    def build_batched_around_query(
+        self, coordinates: List[Tuple[float, float]], radius: float = 100
+    ) -> str:
+        """
+        Packs the around clauses of several sites into one union query. The
+        elements returned for the whole batch have to be split back to each
+        site locally, see `split_pois_by_site`.
+
+        Args:
+            coordinates (List[Tuple[float, float]]): (lat, lon) of every site in the batch.
+            radius (float): Search radius in meters around every site.
+        """
+        clauses = "\n".join(
+            f"""
+        node["shop"~"supermarket|convenience"](around:{radius:g},{lat},{lon});
+        way["shop"~"supermarket|convenience"](around:{radius:g},{lat},{lon});
+        node["amenity"="fast_food"](around:{radius:g},{lat},{lon});
+        way["amenity"="fast_food"](around:{radius:g},{lat},{lon});
+        node["amenity"="fuel"](around:{radius:g},{lat},{lon});
+        way["amenity"="fuel"](around:{radius:g},{lat},{lon});"""
+            for lat, lon in coordinates
+        )
+        return f"""
+        [out:json][timeout:60];
+        ({clauses}
+        );
+        out center;
+        """
+
+    def _record_request(
+        self, status: Optional[int], latency_s: float, num_bytes: int, attempt: int
+    ) -> None:
+        with self.stats_lock:
+            self.request_stats.append(
+                {
+                    "status": status,
+                    "latency_s": latency_s,
+                    "bytes": num_bytes,
+                    "attempt": attempt,
+                }
+            )
+        logging.debug(
+            f"(OverPassAPI): status={status} latency={latency_s:.3f}s bytes={num_bytes} attempt={attempt}"
+        )
+
+    def _backoff_seconds(self, attempt: int) -> float:
+        ## Full jitter so parallel workers do not retry in lockstep
+        return random.uniform(
+            0, min(self.backoff_max_s, self.backoff_base_s * 2**attempt)
+        )
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
     def query_overpass(self, query: str) -> List:
-        response = requests.post(self.overpass_url, data={"data": query})
-        if response.status_code == 200:
-            return response.json()["elements"]
-        else:
-            print(
-                f"Failed to get POI data. {response.status_code}\n{response.json()}"
+        if self.cache is not None:
+            elements = self.cache.get(query, endpoint=self.overpass_url)
+            if elements is not None:
+                return elements
+            if self.cache.mode == "offline":
+                raise OverpassQueryError(
+                    f"Query {self.cache.query_key(query, self.overpass_url)[:12]} is not cached and the cache is offline."
+                )
+
+        elements = self._post_query(query)
+
+        if self.cache is not None:
+            self.cache.put(query, elements, endpoint=self.overpass_url)
+        return elements
+
+    def _post_query(self, query: str) -> List:
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.post(
+                    self.overpass_url,
+                    data={"data": query},
+                    timeout=self.timeout_s,
+                )
+            except requests.RequestException as e:
+                self._record_request(None, time.perf_counter() - start, 0, attempt)
+                last_error = f"{type(e).__name__}: {e}"
+            else:
+                self._record_request(
+                    response.status_code,
+                    time.perf_counter() - start,
+                    len(response.content),
+                    attempt,
+                )
+                record_io(bytes_read=len(response.content))
+                if response.status_code == 200:
+                    ## Overpass sometimes answers with 200 and an HTML or XML
+                    ## error page, which is retried like any other failure
+                    try:
+                        payload = response.json()
+                    except ValueError:
+                        payload = None
+                        last_error = (
+                            f"Response is not JSON: {response.text[:200]!r}"
+                        )
+
+                    ## Overpass answers a query that ran out of time with
+                    ## 200 and a runtime error remark, so retry it as well.
+                    if payload is not None:
+                        remark = payload.get("remark", "")
+                        if "runtime error" not in remark:
+                            return payload["elements"]
+                        last_error = f"Overpass runtime error: {remark}"
+
+                elif response.status_code in RETRY_STATUS_CODES:
+                    last_error = f"HTTP {response.status_code}"
+                    retry_after = self._parse_retry_after(
+                        response.headers.get("Retry-After")
+                    )
+                    if retry_after is not None:
+                        self.rate_limiter.pause(retry_after)
+                else:
+                    raise OverpassQueryError(
+                        f"Failed to get POI data. {response.status_code}\n{response.text[:500]}"
+                    )
+
+            if attempt < self.max_retries:
+                backoff = self._backoff_seconds(attempt)
+                logging.warning(
+                    f"(OverPassAPI): {last_error}, retrying in {backoff:.1f}s "
+                    f"(attempt {attempt + 1}/{self.max_retries})."
+                )
+                time.sleep(backoff)
+
+        raise OverpassQueryError(
+            f"Failed to get POI data after {self.max_retries + 1} attempts. {last_error}"
+        )
+
+    def query_overpass_many(self, queries: Dict, desc: str = "Querying POIs") -> Dict:
+        """
+        Runs many Overpass queries concurrently on a bounded thread pool.
+
+        Args:
+            queries (Dict): Mapping of a key (cluster id, site id, ...) to an Overpass query.
+            desc (str): Label of the progress bar.
+
+        Returns:
+            Dict: Mapping of the same keys, in the same order, to the returned elements.
+        """
+        results = {}
+        with span("overpass_queries", queries=len(queries)) as query_span:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                ## Every worker call runs in a copy of the caller's context
+                ## so the bytes it downloads are counted in this span
+                futures = {
+                    executor.submit(
+                        contextvars.copy_context().run, self.query_overpass, query
+                    ): key
+                    for key, query in queries.items()
+                }
+                try:
+                    for future in tqdm(
+                        as_completed(futures), total=len(futures), desc=desc
+                    ):
+                        results[futures[future]] = future.result()
+                except BaseException:
+                    ## Queued queries would keep taking rate limit tokens
+                    ## until the pool drains, the failure is raised once the
+                    ## running ones have finished
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+
+            query_span.add(
+                rows_in=len(queries),
+                rows_out=sum(len(elements) for elements in results.values()),
             )
-            return []
+
+        return {key: results[key] for key in queries}
+
+    def summarize_request_stats(self) -> Dict:
+        with self.stats_lock:
+            stats = list(self.request_stats)
+
+        latencies = np.array([s["latency_s"] for s in stats], dtype=float)
+        summary = {
+            "num_requests": len(stats),
+            "num_retries": sum(1 for s in stats if s["attempt"] > 0),
+            "num_failed": sum(1 for s in stats if s["status"] != 200),
+            "total_bytes": sum(s["bytes"] for s in stats),
+            "latency_mean_s": float(latencies.mean()) if len(stats) else 0.0,
+            "latency_p50_s": float(np.percentile(latencies, 50)) if len(stats) else 0.0,
+            "latency_p95_s": float(np.percentile(latencies, 95)) if len(stats) else 0.0,
+        }
+        if self.cache is not None:
+            summary["cache"] = self.cache.stats()
+        return summary
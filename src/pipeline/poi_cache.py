@@ -0,0 +1,146 @@
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional
+from src.utils.instrumentation import record_io
+
+CACHE_MODES = ("use", "refresh", "offline")
+
+
+class OverpassResponseCache:
+    """
+    Persistent, content-addressed cache of Overpass responses.
+
+    Responses are stored as gzip-compressed JSON files named after the hash of
+    the endpoint and the normalized query. Entries older than `ttl_hours` are
+    treated as misses, and the least recently used entries are evicted once
+    the cache grows past `max_size_mb`.
+
+    Modes:
+        use:      serve hits from disk, fetch and store misses.
+        refresh:  ignore existing entries, fetch everything and overwrite them.
+        offline:  serve every readable entry from disk whatever its age,
+                  misses are errors.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = "./data/cache/overpass",
+        ttl_hours: float = 168,
+        max_size_mb: float = 2048,
+        mode: str = "use",
+    ):
+        if mode not in CACHE_MODES:
+            raise ValueError(
+                f"Unknown cache mode '{mode}', expected one of {CACHE_MODES}."
+            )
+
+        self.cache_dir = cache_dir
+        self.ttl_s = ttl_hours * 3600
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.size_bytes = sum(
+            entry.stat().st_size for entry in self._entries()
+        )
+
+    @staticmethod
+    def query_key(query: str, endpoint: str = "") -> str:
+        ## Responses of different endpoints (e.g. a mirror and the main
+        ## instance) are kept apart
+        normalized = re.sub(r"\s+", " ", query).strip()
+        return hashlib.sha256(f"{endpoint}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json.gz")
+
+    def _entries(self) -> List[os.DirEntry]:
+        return [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(".json.gz")
+        ]
+
+    def get(self, query: str, endpoint: str = "") -> Optional[List]:
+        path = self._path(self.query_key(query, endpoint))
+
+        if self.mode != "refresh" and os.path.exists(path):
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as file:
+                    entry = json.load(file)
+            except (OSError, ValueError):
+                logging.warning(f"(Cache): Ignoring unreadable entry {path}.")
+                entry = None
+
+            ## Offline there is nothing to refetch an expired entry from
+            if entry is not None and (
+                self.mode == "offline"
+                or time.time() - entry["fetched_at"] <= self.ttl_s
+            ):
+                ## Touch the entry so eviction sees it as recently used
+                os.utime(path)
+                record_io(bytes_read=os.path.getsize(path))
+                with self.lock:
+                    self.hits += 1
+                return entry["elements"]
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, query: str, elements: List, endpoint: str = "") -> None:
+        key = self.query_key(query, endpoint)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+            json.dump(
+                {"query_key": key, "fetched_at": time.time(), "elements": elements},
+                file,
+            )
+
+        new_size = os.path.getsize(tmp_path)
+        record_io(bytes_written=new_size)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.size_bytes += new_size - old_size
+            over_budget = self.size_bytes > self.max_size_bytes
+
+        if over_budget:
+            self.evict()
+
+    def evict(self) -> None:
+        with self.lock:
+            entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+            for entry in entries:
+                if self.size_bytes <= self.max_size_bytes:
+                    break
+                size = entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                self.size_bytes -= size
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size_mb": round(self.size_bytes / 1024 / 1024, 2),
+            }
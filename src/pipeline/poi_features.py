@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, List
+from src.utils.helpers import is_open_24_7
+
+## Tag features of the POIs: feature name -> list of (tag column, rule,
+## argument). A POI has the feature when any of its tag columns matches;
+## missing columns and values never match. Rules:
+##   "equals"        - the lowercased value is one of `argument` (str or list)
+##   "contains"      - the value matches the regular expression `argument`,
+##                     case-insensitive
+##   "opening_hours" - the `OPENING_HOURS_RULES[argument]` parser accepts the
+##                     value
+## Every rule is evaluated once per distinct tag value, so adding a feature
+## costs about as much as the number of distinct values of its tags.
+TAG_FEATURES = {
+    "has_toilet": [("tags.toilets", "equals", "yes")],
+    "has_wifi": [
+        ("tags.internet_access", "contains", "yes|wlan"),
+        ("tags.wifi", "equals", "yes"),
+    ],
+    "has_seating": [
+        ("tags.indoor_seating", "equals", "yes"),
+        ("tags.outdoor_seating", "equals", "yes"),
+    ],
+    "open_24hr": [("tags.opening_hours", "opening_hours", "24_7")],
+}
+
+## Tag columns kept as they are
+TAG_VALUES = ["tags.brand"]
+
+OPENING_HOURS_RULES: Dict[str, Callable[[str], bool]] = {"24_7": is_open_24_7}
+
+
+def match_values(values: pd.Index, rule: str, argument) -> np.ndarray:
+    """
+    Evaluates a rule of `TAG_FEATURES` on the distinct values of a tag
+    column, values that are not strings never match.
+    """
+    is_str = np.fromiter(
+        (isinstance(value, str) for value in values), dtype=bool, count=len(values)
+    )
+    strings = pd.Series(np.asarray(values, dtype=object)[is_str], dtype=object)
+    if rule == "equals":
+        accepted = [argument] if isinstance(argument, str) else list(argument)
+        matches = strings.str.lower().isin(accepted).to_numpy(dtype=bool)
+    elif rule == "contains":
+        matches = strings.str.contains(argument, case=False, regex=True).to_numpy(
+            dtype=bool
+        )
+    elif rule == "opening_hours":
+        parser = OPENING_HOURS_RULES[argument]
+        matches = np.fromiter(
+            (parser(value) for value in strings), dtype=bool, count=len(strings)
+        )
+    else:
+        raise ValueError(f"Unknown tag feature rule: {rule}")
+
+    is_match = np.zeros(len(values), dtype=bool)
+    is_match[is_str] = matches
+    return is_match
+
+
+def tag_columns(tag_features: Dict) -> List[str]:
+    return sorted(
+        {column for matchers in tag_features.values() for column, _, _ in matchers}
+        | set(TAG_VALUES)
+    )
+
+
+def concat_pois(poi_dfs: Dict[str, pd.DataFrame], columns: List[str]) -> pd.DataFrame:
+    """
+    One table of the POIs of every category (category -> POI frame) with
+    their 'poi_id', 'category' and the tag `columns` they have.
+    """
+    frames = []
+    for category, df in poi_dfs.items():
+        frame = df[["poi_id"] + [c for c in columns if c in df.columns]].copy()
+        frame["category"] = category
+        frames.append(frame)
+    pois = pd.concat(frames, ignore_index=True)
+    return pois.reindex(columns=["poi_id", "category"] + columns)
+
+
+def extract_tag_features(
+    poi_dfs: Dict[str, pd.DataFrame], tag_features: Dict = TAG_FEATURES
+) -> pd.DataFrame:
+    """
+    Evaluates `tag_features` over the POIs of every category at once. Every
+    tag column is factorized a single time and each rule only looks at its
+    distinct values, the result is mapped back to the POIs by their codes.
+
+    Returns:
+        pd.DataFrame: 'poi_id', 'category', one boolean column per feature
+        and the `TAG_VALUES` columns.
+    """
+    columns = tag_columns(tag_features)
+    pois = concat_pois(poi_dfs, columns)
+
+    factorized = {}
+    features = pois[["poi_id", "category"]].copy()
+    for feature, matchers in tag_features.items():
+        has_feature = np.zeros(len(pois), dtype=bool)
+        for column, rule, argument in matchers:
+            if column not in factorized:
+                factorized[column] = pd.factorize(pois[column])
+            codes, uniques = factorized[column]
+            if len(uniques) == 0:
+                continue
+            matches = match_values(uniques, rule, argument)
+            has_feature |= (codes >= 0) & matches[np.maximum(codes, 0)]
+        features[feature] = has_feature
+
+    for column in TAG_VALUES:
+        features[column] = pois[column]
+    return features
@@ -0,0 +1,354 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import numpy as np
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from src.pipeline.poi_api import OverPassAPI
+from src.pipeline.proximity import EARTH_RADIUS_M
+from src.pipeline.query_planner import padded_bounds
+from src.pipeline.raw_store import RAW_INDEX_FILE_NAME, list_shards, scan_raw_dir
+from src.utils.instrumentation import span, record_io
+
+## Tag filters of the queries built by `OverPassAPI` ("shop"~"..." is a
+## regular expression match in Overpass, "amenity"="..." an exact one)
+SHOP_PATTERN = re.compile("supermarket|convenience")
+AMENITY_VALUES = {"fast_food", "fuel"}
+
+BBOX_CLAUSE = re.compile(r"\((-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)\);")
+AROUND_CLAUSE = re.compile(r"\(around:([\d.]+),(-?[\d.]+),(-?[\d.]+)\);")
+
+TYPE_ORDER = {"node": 0, "way": 1, "relation": 2}
+
+
+def is_poi(tags: Dict) -> bool:
+    return bool(SHOP_PATTERN.search(tags.get("shop", ""))) or (
+        tags.get("amenity") in AMENITY_VALUES
+    )
+
+
+def element_bounds(element: Dict) -> Optional[Tuple[float, float, float, float]]:
+    """
+    (min_lat, min_lon, max_lat, max_lon) of an Overpass element: its
+    position for a node, its 'bounds' or 'geometry' for a way when the dump
+    has them and its center otherwise.
+    """
+    if "lat" in element and "lon" in element:
+        return element["lat"], element["lon"], element["lat"], element["lon"]
+    if "bounds" in element:
+        bounds = element["bounds"]
+        return bounds["minlat"], bounds["minlon"], bounds["maxlat"], bounds["maxlon"]
+    if element.get("geometry"):
+        lats = [point["lat"] for point in element["geometry"]]
+        lons = [point["lon"] for point in element["geometry"]]
+        return min(lats), min(lons), max(lats), max(lons)
+    if "center" in element:
+        center = element["center"]
+        return center["lat"], center["lon"], center["lat"], center["lon"]
+    return None
+
+
+def read_overpass_json(paths: List[str]) -> Iterator[Dict]:
+    """
+    Elements of Overpass JSON files, either full responses ({"elements": [...]})
+    or lists of elements, and of raw directories of the bronze layer. The
+    shards of a raw directory are scanned sequentially; directories without
+    shards (the legacy layout, e.g. `data/raw/cluster_pois`) are read as the
+    JSON files they contain.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            if list_shards(path) or os.path.exists(os.path.join(path, RAW_INDEX_FILE_NAME)):
+                for _, elements in scan_raw_dir(path):
+                    yield from elements
+                continue
+
+            json_paths = sorted(
+                glob.glob(os.path.join(path, "**", "*.json"), recursive=True)
+            )
+            if not json_paths:
+                logging.warning(
+                    f"(POIStore): {path} has neither raw shards nor JSON files."
+                )
+            yield from read_overpass_json(json_paths)
+            continue
+        with open(path, "r") as file:
+            payload = json.load(file)
+        record_io(bytes_read=os.path.getsize(path))
+        yield from payload["elements"] if isinstance(payload, dict) else payload
+
+
+def read_osm_pbf(path: str) -> Iterator[Dict]:
+    """
+    POI nodes and ways of an OSM PBF extract, in the shape Overpass returns
+    them for `out center` (a way's center is the center of its bounds).
+    Needs the optional `osmium` package (pyosmium).
+    """
+    try:
+        import osmium
+    except ImportError as e:
+        raise ImportError(
+            "Reading PBF extracts needs pyosmium: pip install osmium"
+        ) from e
+
+    for obj in osmium.FileProcessor(path).with_locations():
+        tags = dict(obj.tags)
+        if not is_poi(tags):
+            continue
+        if obj.is_node():
+            yield {
+                "type": "node",
+                "id": obj.id,
+                "lat": obj.location.lat,
+                "lon": obj.location.lon,
+                "tags": tags,
+            }
+        elif obj.is_way():
+            locations = [node.location for node in obj.nodes if node.location.valid()]
+            if not locations:
+                continue
+            min_lat = min(location.lat for location in locations)
+            min_lon = min(location.lon for location in locations)
+            max_lat = max(location.lat for location in locations)
+            max_lon = max(location.lon for location in locations)
+            yield {
+                "type": "way",
+                "id": obj.id,
+                "bounds": {
+                    "minlat": min_lat,
+                    "minlon": min_lon,
+                    "maxlat": max_lat,
+                    "maxlon": max_lon,
+                },
+                "center": {"lat": (min_lat + max_lat) / 2, "lon": (min_lon + max_lon) / 2},
+                "nodes": [node.ref for node in obj.nodes],
+                "tags": tags,
+            }
+
+
+class LocalPOIStore:
+    """
+    On-disk spatial index of the POIs the pipeline queries, in SQLite: the
+    elements (as Overpass returns them) in a table and their bounds in an
+    R*Tree, so bbox and around queries are index lookups. The R*Tree keeps
+    32-bit bounds, so its candidates are filtered on the exact bounds.
+
+    Build it once from an extract with `LocalPOIStore.build`, then query it
+    from any number of threads; every thread opens its own read-only
+    connection.
+    """
+
+    def __init__(self, db_path: str):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"POI store {db_path} does not exist.")
+        self.db_path = db_path
+        self.local = threading.local()
+
+    @staticmethod
+    def build(elements: Iterable[Dict], db_path: str, batch_size: int = 10000) -> int:
+        """
+        Writes the POI elements to a new store at `db_path`, skipping elements
+        without POI tags or coordinates and duplicates.
+
+        Returns:
+            int: Number of POIs stored.
+        """
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        tmp_path = f"{db_path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        connection = sqlite3.connect(tmp_path)
+        connection.executescript(
+            """
+            CREATE TABLE pois (
+                rowid INTEGER PRIMARY KEY,
+                type TEXT NOT NULL,
+                osm_id INTEGER NOT NULL,
+                element TEXT NOT NULL,
+                min_lat REAL NOT NULL,
+                max_lat REAL NOT NULL,
+                min_lon REAL NOT NULL,
+                max_lon REAL NOT NULL,
+                UNIQUE (type, osm_id)
+            );
+            CREATE VIRTUAL TABLE poi_bounds USING rtree(
+                rowid, min_lat, max_lat, min_lon, max_lon
+            );
+            """
+        )
+
+        seen = set()
+        rows = []
+        num_pois = 0
+
+        def flush():
+            connection.executemany(
+                "INSERT INTO pois VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            connection.executemany(
+                "INSERT INTO poi_bounds VALUES (?, ?, ?, ?, ?)",
+                [(row[0],) + row[4:] for row in rows],
+            )
+            rows.clear()
+
+        for element in elements:
+            key = (element.get("type"), element.get("id"))
+            bounds = element_bounds(element)
+            if key in seen or bounds is None or not is_poi(element.get("tags", {})):
+                continue
+            seen.add(key)
+            num_pois += 1
+            min_lat, min_lon, max_lat, max_lon = bounds
+            rows.append(
+                (num_pois, key[0], key[1], json.dumps(element), min_lat, max_lat, min_lon, max_lon)
+            )
+            if len(rows) >= batch_size:
+                flush()
+        flush()
+
+        connection.commit()
+        connection.close()
+        os.replace(tmp_path, db_path)
+        logging.info(f"(POIStore): Stored {num_pois} POIs in {db_path}.")
+        if num_pois == 0:
+            logging.warning(
+                "(POIStore): The store is empty, every query will return no POIs."
+            )
+        return num_pois
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            self.local.connection = connection
+        return connection
+
+    def _lookup(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> List[Tuple]:
+        return self._connection().execute(
+            """
+            SELECT pois.rowid, pois.element, pois.min_lat, pois.max_lat,
+                   pois.min_lon, pois.max_lon
+            FROM poi_bounds JOIN pois ON pois.rowid = poi_bounds.rowid
+            WHERE poi_bounds.max_lat >= ?1 AND poi_bounds.min_lat <= ?2
+              AND poi_bounds.max_lon >= ?3 AND poi_bounds.min_lon <= ?4
+              AND pois.max_lat >= ?1 AND pois.min_lat <= ?2
+              AND pois.max_lon >= ?3 AND pois.min_lon <= ?4
+            """,
+            (min_lat, max_lat, min_lon, max_lon),
+        ).fetchall()
+
+    def query_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> Dict:
+        return {row[0]: row[1] for row in self._lookup(min_lat, min_lon, max_lat, max_lon)}
+
+    def query_around(self, lat: float, lon: float, radius: float) -> Dict:
+        """
+        POIs within `radius` meters of (lat, lon), measured to the nearest
+        point of their bounds (a way counts when any part of it is close).
+        """
+        min_lat, min_lon, max_lat, max_lon = padded_bounds(lat, lon, lat, lon, radius)
+        rows = self._lookup(min_lat, min_lon, max_lat, max_lon)
+        if not rows:
+            return {}
+
+        bounds = np.array([row[2:] for row in rows], dtype=float)
+        nearest_lat = np.clip(lat, bounds[:, 0], bounds[:, 1])
+        nearest_lon = np.clip(lon, bounds[:, 2], bounds[:, 3])
+
+        lat1, lon1 = np.radians(lat), np.radians(lon)
+        lat2, lon2 = np.radians(nearest_lat), np.radians(nearest_lon)
+        a = (
+            np.sin((lat2 - lat1) / 2) ** 2
+            + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        )
+        distance_m = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+        return {row[0]: row[1] for row, close in zip(rows, distance_m <= radius) if close}
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM pois").fetchone()[0]
+
+
+class LocalOverPassAPI(OverPassAPI):
+    """
+    Drop-in replacement of `OverPassAPI` that answers the bbox and around
+    queries it builds from a `LocalPOIStore` instead of the network. Results
+    are ordered like Overpass output (nodes, then ways, by id), and the
+    request stats and response cache work as for the remote API.
+    """
+
+    def __init__(self, store_path: str, max_workers: int = 4, **kwargs):
+        super().__init__(
+            overpass_url=f"file:{store_path}", max_workers=max_workers, **kwargs
+        )
+        self.store = LocalPOIStore(store_path)
+
+    def _init_transport(self, requests_per_second: float, burst: int) -> None:
+        ## Queries are answered from the store, there is no session to
+        ## open and no server to rate limit
+        self.session = None
+        self.rate_limiter = None
+
+    def _post_query(self, query: str) -> List:
+        start = time.perf_counter()
+
+        matches = {}
+        for min_lat, min_lon, max_lat, max_lon in BBOX_CLAUSE.findall(query):
+            matches.update(
+                self.store.query_bbox(
+                    float(min_lat), float(min_lon), float(max_lat), float(max_lon)
+                )
+            )
+        for radius, lat, lon in AROUND_CLAUSE.findall(query):
+            matches.update(self.store.query_around(float(lat), float(lon), float(radius)))
+
+        elements = [json.loads(element) for element in matches.values()]
+        elements.sort(key=lambda e: (TYPE_ORDER.get(e["type"], 3), e["id"]))
+
+        self._record_request(
+            200,
+            time.perf_counter() - start,
+            sum(len(element) for element in matches.values()),
+            attempt=0,
+        )
+        return elements
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Build the local POI store from an OSM extract."
+    )
+
+    parser.add_argument(
+        "--input",
+        type=str,
+        nargs="+",
+        required=True,
+        help="An OSM PBF extract (.pbf), Overpass JSON files (full responses or lists of elements) or raw directories of earlier runs.",
+    )
+
+    parser.add_argument(
+        "--store_path",
+        type=str,
+        default="./data/poi_store.sqlite",
+        help="Path of the SQLite POI store to create.",
+    )
+
+    args = parser.parse_args()
+
+    with span("build_poi_store"):
+        if len(args.input) == 1 and args.input[0].endswith(".pbf"):
+            elements = read_osm_pbf(args.input[0])
+        else:
+            elements = read_overpass_json(args.input)
+        num_pois = LocalPOIStore.build(elements, db_path=args.store_path)
+
+    if num_pois == 0:
+        sys.exit(f"No POIs found in {args.input}.")
@@ -0,0 +1,111 @@
+import logging
+import numpy as np
+import pandas as pd
+from src.utils.helpers import haversine
+from src.pipeline.schema import PROXIMITY_DTYPES, STRING_DTYPE, apply_dtype_policy
+
+EARTH_RADIUS_M = 6371000
+
+
+class POIProximityIndex:
+    """
+    Spatial index over POI coordinates used to find the POIs around sites
+    without building the full site x POI cross join.
+
+    The POIs are indexed in a BallTree over (lat, lon) in radians with the
+    haversine metric, so a radius query costs O(log m) per site instead of
+    O(m).
+    """
+
+    def __init__(self, poi_data: pd.DataFrame):
+        self.poi_data = poi_data.dropna(subset=["lat", "lon"]).reset_index(
+            drop=True
+        )
+        ## A BallTree cannot be built without points, query_radius returns
+        ## no pairs when there are no POIs
+        self.tree = None
+        if len(self.poi_data) > 0:
+            ## Imported here, scikit-learn takes seconds to import and the gold
+            ## layer only needs this module for `EARTH_RADIUS_M`
+            from sklearn.neighbors import BallTree
+
+            self.tree = BallTree(
+                np.radians(self.poi_data[["lat", "lon"]].to_numpy(dtype=float)),
+                metric="haversine",
+            )
+        logging.info(
+            f"(Proximity): Built spatial index over {len(self.poi_data)} POIs."
+        )
+
+    def query_radius(
+        self, site_data: pd.DataFrame, radius_m: float = 100
+    ) -> pd.DataFrame:
+        """
+        Finds every POI within `radius_m` meters of each site.
+
+        Args:
+            site_data (pd.DataFrame): Sites with 'site_id', 'lat' and 'lon' columns.
+            radius_m (float): Search radius in meters.
+
+        Returns:
+            pd.DataFrame: One row per (site, POI) pair with the columns
+                          'site_id', 'poi_id', 'distance_m' and 'category'.
+        """
+        site_data = site_data.dropna(subset=["lat", "lon"])
+        site_coords = site_data[["lat", "lon"]].to_numpy(dtype=float)
+
+        if len(site_coords) == 0 or len(self.poi_data) == 0:
+            return apply_dtype_policy(
+                pd.DataFrame(columns=["site_id", "poi_id", "distance_m", "category"]),
+                PROXIMITY_DTYPES,
+            )
+
+        ## Slightly widen the search so pairs sitting exactly on the radius
+        ## are not lost to float rounding; the exact cut is applied below.
+        candidates = self.tree.query_radius(
+            np.radians(site_coords),
+            r=radius_m * (1 + 1e-9) / EARTH_RADIUS_M,
+        )
+
+        counts = np.fromiter(
+            (len(c) for c in candidates), dtype=np.int64, count=len(candidates)
+        )
+        site_idx = np.repeat(np.arange(len(site_coords)), counts)
+        poi_idx = (
+            np.concatenate(candidates).astype(np.int64)
+            if counts.sum() > 0
+            else np.empty(0, dtype=np.int64)
+        )
+
+        poi_coords = self.poi_data[["lat", "lon"]].to_numpy(dtype=float)
+        distance_m = haversine(
+            site_coords[site_idx, 0],
+            site_coords[site_idx, 1],
+            poi_coords[poi_idx, 0],
+            poi_coords[poi_idx, 1],
+        )
+
+        ## A site id repeats for every POI near the site, so it is stored
+        ## dictionary-encoded (a categorical over the queried sites)
+        site_codes, site_ids = pd.factorize(site_data["site_id"])
+        proximity_df = pd.DataFrame(
+            {
+                "site_id": pd.Categorical.from_codes(
+                    site_codes[site_idx],
+                    categories=pd.Index(site_ids).astype(STRING_DTYPE),
+                ),
+                "poi_id": self.poi_data["poi_id"].to_numpy()[poi_idx],
+                "distance_m": distance_m.astype(np.float32),
+                "category": self.poi_data["category"].array.take(poi_idx),
+            }
+        )
+        proximity_df = apply_dtype_policy(
+            proximity_df[distance_m <= radius_m].reset_index(drop=True),
+            PROXIMITY_DTYPES,
+        )
+        proximity_df["site_id"] = proximity_df["site_id"].cat.remove_unused_categories()
+
+        logging.info(
+            f"(Proximity): Found {len(proximity_df)} site-POI pairs within {radius_m}m."
+        )
+        return proximity_df
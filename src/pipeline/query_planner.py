@@ -0,0 +1,261 @@
+import logging
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple
+
+METERS_PER_DEGREE = 111320.0
+QUERY_PLANNERS = ("hdbscan", "quadtree")
+
+
+def padded_bounds(
+    min_lat, min_lon, max_lat, max_lon, radius_m: float, min_pad_deg: float = 0.0
+) -> Tuple:
+    """
+    Boxes (scalars or arrays of their corners) grown by `radius_m` on every
+    side, and by at least `min_pad_deg` degrees, so that they contain every
+    POI within `radius_m` of any point inside them.
+    """
+    pad_lat = max(min_pad_deg, radius_m / METERS_PER_DEGREE)
+    max_abs_lat = np.minimum(
+        np.maximum(np.abs(min_lat), np.abs(max_lat)) + pad_lat, 89.9
+    )
+    pad_lon = np.maximum(
+        min_pad_deg, radius_m / (METERS_PER_DEGREE * np.cos(np.radians(max_abs_lat)))
+    )
+    return (
+        min_lat - pad_lat,
+        min_lon - pad_lon,
+        max_lat + pad_lat,
+        max_lon + pad_lon,
+    )
+
+
+def box_area_km2(min_lat, min_lon, max_lat, max_lon):
+    height_km = (max_lat - min_lat) * METERS_PER_DEGREE / 1000
+    width_km = (
+        (max_lon - min_lon)
+        * METERS_PER_DEGREE
+        * np.cos(np.radians((min_lat + max_lat) / 2))
+        / 1000
+    )
+    return height_km * width_km
+
+
+def overlap_area_km2(boxes: np.ndarray) -> float:
+    """
+    Sum of the pairwise intersections of (min_lat, min_lon, max_lat, max_lon)
+    boxes, found with a sweep over the boxes sorted by min_lat.
+    """
+    if len(boxes) < 2:
+        return 0.0
+
+    boxes = boxes[np.argsort(boxes[:, 0])]
+    overlap = 0.0
+    for i in range(len(boxes) - 1):
+        ## Only the boxes starting before this one ends can intersect it
+        end = np.searchsorted(boxes[:, 0], boxes[i, 2], side="left")
+        others = boxes[i + 1 : end]
+        if len(others) == 0:
+            continue
+        min_lat = np.maximum(boxes[i, 0], others[:, 0])
+        min_lon = np.maximum(boxes[i, 1], others[:, 1])
+        max_lat = np.minimum(boxes[i, 2], others[:, 2])
+        max_lon = np.minimum(boxes[i, 3], others[:, 3])
+        intersects = (max_lat > min_lat) & (max_lon > min_lon)
+        overlap += box_area_km2(
+            min_lat[intersects], min_lon[intersects], max_lat[intersects], max_lon[intersects]
+        ).sum()
+    return float(overlap)
+
+
+def summarize_query_boxes(
+    boxes: Dict,
+    num_around_sites: int = 0,
+    around_batch_size: int = 1,
+    radius_m: float = 100,
+) -> Dict:
+    """
+    Request count, area and overlap of a set of bounding box queries (in the
+    format of `extract_cluster_bounding_boxes_dict`) plus the around queries
+    of `radius_m` for `num_around_sites` sites, `around_batch_size` per query.
+    """
+    box_array = np.array(
+        [[b["min_lat"], b["min_lon"], b["max_lat"], b["max_lon"]] for b in boxes.values()],
+        dtype=float,
+    ).reshape(-1, 4)
+    box_area = float(box_area_km2(*box_array.T).sum()) if len(box_array) else 0.0
+    num_around_queries = -(-num_around_sites // max(around_batch_size, 1))
+    around_area = num_around_sites * np.pi * (radius_m / 1000) ** 2
+    total_area = box_area + around_area
+    overlap = overlap_area_km2(box_array)
+
+    return {
+        "num_requests": len(box_array) + num_around_queries,
+        "total_area_km2": round(total_area, 3),
+        "overlap_area_km2": round(overlap, 3),
+        "overlap_ratio": round(overlap / total_area, 4) if total_area else 0.0,
+    }
+
+
+def tile_bounding_boxes(site_df: pd.DataFrame, radius_m: float = 100) -> Dict:
+    """
+    Query box of every planned tile ('cluster' column) from its sites, in the
+    format of `extract_cluster_bounding_boxes_dict`.
+    """
+    bounds = site_df.groupby("cluster").agg(
+        min_lat=("lat", "min"),
+        min_lon=("lon", "min"),
+        max_lat=("lat", "max"),
+        max_lon=("lon", "max"),
+    )
+    bounds["min_lat"], bounds["min_lon"], bounds["max_lat"], bounds["max_lon"] = (
+        padded_bounds(
+            bounds["min_lat"],
+            bounds["min_lon"],
+            bounds["max_lat"],
+            bounds["max_lon"],
+            radius_m,
+        )
+    )
+    tile_boxes = bounds.to_dict(orient="index")
+    return tile_boxes
+
+
+class QuadtreeQueryPlanner:
+    """
+    Covers all sites with a small set of bounding box queries.
+
+    Co-located sites (closer than `colocated_m`) are merged into one location
+    first. The locations are then split recursively into quadrants. A cell
+    becomes one query tile (the box around its locations grown by the search
+    radius) when that is cheaper than querying its quadrants separately and
+    the tile is at most `max_tile_area_km2`.
+
+    The cost of a tile is `request_cost_s` per request plus
+    `area_cost_s_per_km2` for the area it downloads. Every site ends up in
+    exactly one tile, so the tiles do not download the same sites twice; only
+    the radius margins of neighbouring tiles can overlap.
+    """
+
+    def __init__(
+        self,
+        radius_m: float = 100,
+        max_tile_area_km2: float = 25.0,
+        request_cost_s: float = 1.0,
+        area_cost_s_per_km2: float = 0.05,
+        colocated_m: float = 1.0,
+        max_depth: int = 32,
+    ):
+        self.radius_m = radius_m
+        self.max_tile_area_km2 = max_tile_area_km2
+        self.request_cost_s = request_cost_s
+        self.area_cost_s_per_km2 = area_cost_s_per_km2
+        self.colocated_m = colocated_m
+        self.max_depth = max_depth
+        self.stats = {}
+
+    def params(self) -> Dict:
+        return {
+            "radius_m": self.radius_m,
+            "max_tile_area_km2": self.max_tile_area_km2,
+            "request_cost_s": self.request_cost_s,
+            "area_cost_s_per_km2": self.area_cost_s_per_km2,
+            "colocated_m": self.colocated_m,
+        }
+
+    def tile_boxes(self, site_df: pd.DataFrame) -> Dict:
+        return tile_bounding_boxes(site_df, radius_m=self.radius_m)
+
+    def _tile(self, lat: np.ndarray, lon: np.ndarray) -> Tuple[float, float]:
+        area = box_area_km2(
+            *padded_bounds(lat.min(), lon.min(), lat.max(), lon.max(), self.radius_m)
+        )
+        return area, self.request_cost_s + area * self.area_cost_s_per_km2
+
+    def _solve(
+        self,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        idx: np.ndarray,
+        cell: Tuple[float, float, float, float],
+        depth: int,
+    ) -> Tuple[float, List[np.ndarray]]:
+        area, cost = self._tile(lat[idx], lon[idx])
+        if len(idx) == 1 or depth >= self.max_depth:
+            return cost, [idx]
+
+        min_lat, min_lon, max_lat, max_lon = cell
+        mid_lat = (min_lat + max_lat) / 2
+        mid_lon = (min_lon + max_lon) / 2
+        north = lat[idx] >= mid_lat
+        east = lon[idx] >= mid_lon
+        children = [
+            (idx[~north & ~east], (min_lat, min_lon, mid_lat, mid_lon)),
+            (idx[~north & east], (min_lat, mid_lon, mid_lat, max_lon)),
+            (idx[north & ~east], (mid_lat, min_lon, max_lat, mid_lon)),
+            (idx[north & east], (mid_lat, mid_lon, max_lat, max_lon)),
+        ]
+        children = [(child, child_cell) for child, child_cell in children if len(child)]
+
+        ## All locations in one quadrant: zoom in without paying for a split
+        if len(children) == 1:
+            return self._solve(lat, lon, idx, children[0][1], depth + 1)
+
+        ## Every quadrant costs at least one request, so a tile that is not
+        ## more expensive than that cannot be beaten by splitting
+        if area <= self.max_tile_area_km2 and cost <= len(children) * self.request_cost_s:
+            return cost, [idx]
+
+        split_cost = 0.0
+        split_tiles = []
+        for child, child_cell in children:
+            child_cost, child_tiles = self._solve(lat, lon, child, child_cell, depth + 1)
+            split_cost += child_cost
+            split_tiles += child_tiles
+
+        if area <= self.max_tile_area_km2 and cost <= split_cost:
+            return cost, [idx]
+        return split_cost, split_tiles
+
+    def plan(self, site_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Assigns every site in `site_df` ('lat' and 'lon' columns) to a query
+        tile. The tile id is stored in the 'cluster' column, so the rest of
+        the pipeline treats every tile like an HDBSCAN cluster.
+
+        Returns:
+            pd.DataFrame: `site_df` with the 'cluster' column.
+        """
+        site_lat = site_df["lat"].to_numpy(dtype=float)
+        site_lon = site_df["lon"].to_numpy(dtype=float)
+
+        ## Merging co-located sites into one location
+        step = self.colocated_m / METERS_PER_DEGREE
+        keys = np.column_stack([np.round(site_lat / step), np.round(site_lon / step)])
+        _, first, location_of_site = np.unique(
+            keys, axis=0, return_index=True, return_inverse=True
+        )
+        location_of_site = location_of_site.ravel()
+        lat, lon = site_lat[first], site_lon[first]
+
+        tile_of_location = np.empty(len(lat), dtype=np.int64)
+        estimated_cost_s = 0.0
+        if len(lat):
+            root = (lat.min(), lon.min(), lat.max() + 1e-9, lon.max() + 1e-9)
+            estimated_cost_s, tiles = self._solve(
+                lat, lon, np.arange(len(lat)), root, depth=0
+            )
+            for tile_id, tile in enumerate(tiles):
+                tile_of_location[tile] = tile_id
+
+        site_df = site_df.copy()
+        site_df["cluster"] = tile_of_location[location_of_site]
+
+        self.stats = {
+            "num_sites": len(site_df),
+            "num_locations": len(lat),
+            "estimated_cost_s": round(float(estimated_cost_s), 2),
+        }
+        self.stats.update(summarize_query_boxes(self.tile_boxes(site_df)))
+        logging.info(f"(QueryPlanner): Planned {self.stats}.")
+        return site_df
@@ -0,0 +1,220 @@
+import os
+import glob
+import json
+import logging
+import pyarrow as pa
+from typing import Dict, Iterator, List, Tuple
+from src.utils.instrumentation import record_io
+
+## The raw layer is a series of append-only shards of zstd-compressed NDJSON
+## ('raw-00000.ndjson.zst', ...). Every response is one line
+## {"key": ..., "elements": [...]} compressed as its own zstd frame, so a
+## shard is a valid .zst stream that can be scanned from start to end, and a
+## single response can be read from its offset. 'raw_index.ndjson' maps every
+## key to the shard, offset, length and uncompressed size of its latest
+## response.
+RAW_SHARD_PATTERN = "raw-{:05d}.ndjson.zst"
+RAW_INDEX_FILE_NAME = "raw_index.ndjson"
+RAW_COMPRESSION = "zstd"
+RAW_COMPRESSION_LEVEL = 3
+## Size after which the next shard is started
+SHARD_SIZE_MB = 64
+## A response is referenced as '<shard path>#<offset>:<length>:<size>'
+RAW_REF_SEPARATOR = "#"
+SCAN_BLOCK_SIZE = 1 << 20
+
+
+def raw_ref(shard_path: str, offset: int, length: int, size: int) -> str:
+    return f"{shard_path}{RAW_REF_SEPARATOR}{offset}:{length}:{size}"
+
+
+def is_raw_ref(path: str) -> bool:
+    return RAW_REF_SEPARATOR in os.path.basename(path)
+
+
+def parse_raw_ref(ref: str) -> Tuple[str, int, int, int]:
+    shard_path, _, location = ref.rpartition(RAW_REF_SEPARATOR)
+    offset, length, size = location.split(":")
+    return shard_path, int(offset), int(length), int(size)
+
+
+def raw_size(path: str) -> int:
+    ## Compressed bytes of a response, or the size of a legacy JSON file
+    if is_raw_ref(path):
+        return parse_raw_ref(path)[2]
+    return os.path.getsize(path)
+
+
+def list_shards(raw_dir: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(raw_dir, RAW_SHARD_PATTERN.replace("{:05d}", "*"))))
+
+
+class RawShardWriter:
+    """
+    Appends raw responses to the shards in `raw_dir` one at a time, so the
+    bronze layer can stream them in as they arrive. Every `write` returns the
+    reference of the response, which the site manifest records instead of a
+    file path. With `reset` the shards of earlier runs are removed first.
+
+    Only one writer may append to a `raw_dir` at a time. Responses that are
+    no longer referenced stay in their shard until the next reset.
+    """
+
+    def __init__(
+        self,
+        raw_dir: str,
+        reset: bool = False,
+        shard_size_mb: float = SHARD_SIZE_MB,
+        compression_level: int = RAW_COMPRESSION_LEVEL,
+    ):
+        self.raw_dir = raw_dir
+        self.max_shard_bytes = int(shard_size_mb * 1024 * 1024)
+        self.codec = pa.Codec(RAW_COMPRESSION, compression_level=compression_level)
+        os.makedirs(raw_dir, exist_ok=True)
+
+        index_path = os.path.join(raw_dir, RAW_INDEX_FILE_NAME)
+        if reset:
+            for shard_path in list_shards(raw_dir):
+                os.remove(shard_path)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+
+        shard_paths = list_shards(raw_dir)
+        self.shard_id = len(shard_paths) - 1 if shard_paths else 0
+        self.shard_file = None
+        self.index_file = open(index_path, "a")
+        self.num_written = 0
+
+    @property
+    def shard_path(self) -> str:
+        return os.path.join(self.raw_dir, RAW_SHARD_PATTERN.format(self.shard_id))
+
+    def _shard(self):
+        if self.shard_file is None:
+            self.shard_file = open(self.shard_path, "ab")
+        if self.shard_file.tell() >= self.max_shard_bytes:
+            self.shard_file.close()
+            self.shard_id += 1
+            self.shard_file = open(self.shard_path, "ab")
+        return self.shard_file
+
+    def write(self, key: str, elements: List) -> str:
+        shard_file = self._shard()
+        record = json.dumps({"key": key, "elements": elements}).encode() + b"\n"
+        frame = self.codec.compress(record, asbytes=True)
+        offset = shard_file.tell()
+        shard_file.write(frame)
+        self.index_file.write(
+            json.dumps(
+                [key, os.path.basename(self.shard_path), offset, len(frame), len(record)]
+            )
+            + "\n"
+        )
+        record_io(bytes_written=len(frame))
+        self.num_written += 1
+        return raw_ref(self.shard_path, offset, len(frame), len(record))
+
+    def write_many(self, responses: Dict, key_prefix: str = "") -> Dict:
+        """
+        Writes every response of a key -> elements mapping.
+
+        Returns:
+            Dict: Mapping of the same keys to the references of their responses.
+        """
+        return {
+            key: self.write(f"{key_prefix}{key}", elements)
+            for key, elements in responses.items()
+        }
+
+    def flush(self) -> None:
+        ## Makes the responses written so far readable
+        if self.shard_file is not None:
+            self.shard_file.flush()
+        self.index_file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+        self.index_file.close()
+        logging.info(
+            f"(RawStore): Wrote {self.num_written} responses to {self.raw_dir}."
+        )
+
+    def __enter__(self) -> "RawShardWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def load_raw_index(raw_dir: str) -> Dict[str, str]:
+    """
+    Reference of the latest response of every key written to `raw_dir`.
+    """
+    index = {}
+    index_path = os.path.join(raw_dir, RAW_INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return index
+    with open(index_path, "r") as file:
+        for line in file:
+            key, shard_name, offset, length, size = json.loads(line)
+            index[key] = raw_ref(os.path.join(raw_dir, shard_name), offset, length, size)
+    return index
+
+
+def read_raw_responses(paths: List[str]) -> Iterator[List]:
+    """
+    Elements of every raw response in `paths`, in order. References into the
+    shards are read from memory-mapped shards, each opened once, so the
+    references of a run (which are in write order) are read sequentially.
+    Paths of legacy JSON files are read as they are.
+    """
+    codec = pa.Codec(RAW_COMPRESSION)
+    shards = {}
+    try:
+        for path in paths:
+            if not is_raw_ref(path):
+                with open(path, "r") as file:
+                    yield json.load(file)
+                continue
+
+            shard_path, offset, length, size = parse_raw_ref(path)
+            shard = shards.get(shard_path)
+            if shard is None:
+                shard = shards[shard_path] = pa.memory_map(shard_path)
+            record = codec.decompress(
+                shard.read_at(length, offset), decompressed_size=size, asbytes=True
+            )
+            yield json.loads(record)["elements"]
+    finally:
+        for shard in shards.values():
+            shard.close()
+
+
+def scan_shard(shard_path: str) -> Iterator[Tuple[str, List]]:
+    """
+    (key, elements) of every response in a shard, decompressed as one
+    sequential stream.
+    """
+    record_io(bytes_read=os.path.getsize(shard_path))
+    with pa.input_stream(shard_path, compression=RAW_COMPRESSION) as stream:
+        pending = b""
+        while True:
+            block = stream.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            lines = (pending + block).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                record = json.loads(line)
+                yield record["key"], record["elements"]
+        if pending:
+            record = json.loads(pending)
+            yield record["key"], record["elements"]
+
+
+def scan_raw_dir(raw_dir: str) -> Iterator[Tuple[str, List]]:
+    for shard_path in list_shards(raw_dir):
+        yield from scan_shard(shard_path)
@@ -0,0 +1,211 @@
+import logging
+import numpy as np
+import pandas as pd
+from typing import TYPE_CHECKING, Dict, List
+from src.utils.helpers import haversine
+from src.pipeline.proximity import EARTH_RADIUS_M
+
+if TYPE_CHECKING:
+    from scipy.spatial import KDTree
+
+## Radii in meters of the POI count rings around every site
+RING_RADII_M = [100, 250, 500, 1000]
+## POIs looked up per site and category by the k-nearest query. Only sites
+## with `NEAREST_K` POIs of a category inside the largest ring are counted
+## again with a radius query.
+NEAREST_K = 16
+## Dense sites counted per radius query, bounds the candidates held at once
+DENSE_BATCH_SIZE = 1024
+
+
+def nearest_column(category: str) -> str:
+    return f"nearest_{category}_m"
+
+
+def ring_column(category: str, radius_m: float) -> str:
+    return f"num_{category}_{radius_m:g}m"
+
+
+def ring_feature_columns(categories: List[str], radii_m: List[float]) -> List[str]:
+    return [nearest_column(category) for category in categories] + [
+        ring_column(category, radius_m)
+        for category in categories
+        for radius_m in sorted(radii_m)
+    ]
+
+
+def unit_vectors(coords: np.ndarray) -> np.ndarray:
+    ## (lat, lon) in degrees as points on the unit sphere. The straight-line
+    ## distance between them grows with the great-circle distance, so a
+    ## Euclidean KD-tree finds the same neighbors as a haversine BallTree,
+    ## several times faster.
+    lat, lon = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def chord_length(distance_m: float) -> float:
+    return 2 * np.sin(distance_m / (2 * EARTH_RADIUS_M))
+
+
+def count_rings(
+    site_coords: np.ndarray,
+    poi_coords: np.ndarray,
+    tree: "KDTree",
+    radii_m: np.ndarray,
+    k: int = NEAREST_K,
+):
+    """
+    Distance to the nearest POI and number of POIs within every radius of
+    `radii_m` for each site, from one k-nearest query of the POI `tree`
+    (built over the `unit_vectors` of `poi_coords`).
+
+    The k nearest POIs of a site are sorted by distance, so every radius is
+    a count over the same k distances and more radii cost next to nothing.
+    Sites whose k nearest POIs all lie inside the largest ring may have more
+    POIs there and are counted with a radius query instead.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Nearest distance in meters per site
+        and (sites x radii) counts.
+    """
+    k = min(k, len(poi_coords))
+    site_vectors = unit_vectors(site_coords)
+    _, neighbors = tree.query(site_vectors, k=k)
+    neighbors = neighbors.reshape(len(site_vectors), k)
+
+    ## Exact distances as the proximity join computes them, so the rings
+    ## agree with the proximity data at the same radius
+    distance_m = haversine(
+        site_coords[:, [0]],
+        site_coords[:, [1]],
+        poi_coords[neighbors, 0],
+        poi_coords[neighbors, 1],
+    )
+    nearest_m = distance_m.min(axis=1)
+    counts = np.stack(
+        [(distance_m <= radius_m).sum(axis=1) for radius_m in radii_m], axis=1
+    )
+
+    max_radius_m = radii_m.max()
+    is_saturated = (distance_m.max(axis=1) <= max_radius_m) & (k < len(poi_coords))
+    saturated = np.flatnonzero(is_saturated)
+    for start in range(0, len(saturated), DENSE_BATCH_SIZE):
+        batch = saturated[start : start + DENSE_BATCH_SIZE]
+        candidates = tree.query_ball_point(
+            site_vectors[batch], r=chord_length(max_radius_m * (1 + 1e-9))
+        )
+        lengths = np.fromiter(
+            (len(c) for c in candidates), dtype=np.int64, count=len(candidates)
+        )
+        rows = np.repeat(np.arange(len(batch)), lengths)
+        poi_idx = np.concatenate(candidates).astype(np.int64)
+        candidate_distance_m = haversine(
+            site_coords[batch[rows], 0],
+            site_coords[batch[rows], 1],
+            poi_coords[poi_idx, 0],
+            poi_coords[poi_idx, 1],
+        )
+        for i, radius_m in enumerate(radii_m):
+            counts[batch, i] = np.bincount(
+                rows, weights=candidate_distance_m <= radius_m, minlength=len(batch)
+            )
+    if len(saturated) > 0:
+        logging.info(
+            f"(RingFeatures): Counted {len(saturated)} dense sites with a radius query."
+        )
+    return nearest_m, counts
+
+
+class POIRingIndex:
+    """
+    One KD-tree per POI category, built once and queried for the ring
+    features of any number of site batches.
+    """
+
+    def __init__(self, poi_data: Dict[str, pd.DataFrame]):
+        ## Imported here so that a run whose gold stage is up to date does not
+        ## import it. The KD-tree of SciPy is used rather than the one of
+        ## scikit-learn, which takes seconds to import.
+        from scipy.spatial import KDTree
+
+        self.poi_coords = {}
+        self.trees = {}
+        for category, poi_df in poi_data.items():
+            poi_coords = poi_df[["lat", "lon"]].dropna().to_numpy(dtype=float)
+            self.poi_coords[category] = poi_coords
+            ## A KD-tree cannot be built without points
+            self.trees[category] = (
+                KDTree(unit_vectors(poi_coords)) if len(poi_coords) > 0 else None
+            )
+
+    def features(
+        self,
+        site_data: pd.DataFrame,
+        radii_m: List[float] = RING_RADII_M,
+        k: int = NEAREST_K,
+    ) -> pd.DataFrame:
+        """
+        Distance to the nearest POI of every category within the largest of
+        `radii_m` (not limited to the proximity radius) and POI counts per
+        category within each of `radii_m`, one k-nearest query per category.
+        The pipeline fetches the POIs out to the largest ring, so both only
+        depend on the POIs around the site.
+
+        Args:
+            site_data (pd.DataFrame): Sites with 'lat' and 'lon'.
+            radii_m (List[float]): Ring radii in meters.
+            k (int): POIs looked up per site by the k-nearest query.
+
+        Returns:
+            pd.DataFrame: The `ring_feature_columns` in the rows of `site_data`.
+            Distances are NaN for sites without coordinates and when there is
+            no POI of the category within the largest ring.
+        """
+        radii_m = np.asarray(sorted(radii_m), dtype=float)
+        site_coords = site_data[["lat", "lon"]].to_numpy(dtype=float)
+        has_coords = ~np.isnan(site_coords).any(axis=1)
+
+        features = {}
+        counts = {}
+        for category, tree in self.trees.items():
+            nearest_m = np.full(len(site_data), np.nan)
+            category_counts = np.zeros((len(site_data), len(radii_m)), dtype=np.int64)
+
+            if tree is not None and has_coords.any():
+                nearest_m[has_coords], category_counts[has_coords] = count_rings(
+                    site_coords[has_coords],
+                    self.poi_coords[category],
+                    tree,
+                    radii_m,
+                    k=k,
+                )
+
+            ## POIs are only fetched out to the largest ring, a farther nearest
+            ## POI may not be the nearest one
+            nearest_m[nearest_m > radii_m.max()] = np.nan
+            ## Rounded to centimeters, the mart is a CSV and an incremental run
+            ## merges freshly enriched rows into the rows read back from it
+            features[nearest_column(category)] = np.round(nearest_m, 2)
+            counts[category] = category_counts
+
+        for category, category_counts in counts.items():
+            for i, radius_m in enumerate(radii_m):
+                features[ring_column(category, radius_m)] = category_counts[
+                    :, i
+                ].astype(np.int32)
+        return pd.DataFrame(features, index=site_data.index)
+
+
+def ring_features(
+    site_data: pd.DataFrame,
+    poi_data: Dict[str, pd.DataFrame],
+    radii_m: List[float] = RING_RADII_M,
+    k: int = NEAREST_K,
+) -> pd.DataFrame:
+    """
+    Ring features of `site_data` over the POIs with 'lat' and 'lon' of
+    every category in `poi_data`, see `POIRingIndex.features`.
+    """
+    return POIRingIndex(poi_data).features(site_data, radii_m=radii_m, k=k)
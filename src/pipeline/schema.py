@@ -0,0 +1,126 @@
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Dict
+
+POI_CATEGORIES = ["fast_food", "fuel", "supermarket"]
+
+## Arrow-backed strings that use NaN for missing values, the default `str`
+## dtype of pandas 3
+STRING_DTYPE = pd.StringDtype("pyarrow", na_value=np.nan)
+POI_CATEGORY_DTYPE = pd.CategoricalDtype(POI_CATEGORIES)
+
+## Dtype policy of the pipeline data by column name, applied when sites and
+## POIs are ingested and enforced on every staging write. Text columns that
+## are not listed become `STRING_DTYPE`, other columns keep their dtype.
+## Coordinates stay float64: float32 moves a point by up to ~0.5 m, which
+## changes the POIs found at the edge of the search radius.
+COLUMN_DTYPES = {
+    "category": POI_CATEGORY_DTYPE,
+    "state": "category",
+    "operatorName": "category",
+    "distance_m": "float32",
+    "is_outlier": "boolean",
+}
+
+## Proximity rows repeat the site id of every POI near the site, so it is
+## dictionary-encoded
+PROXIMITY_DTYPES = {**COLUMN_DTYPES, "site_id": "category"}
+
+
+def apply_dtype_policy(df: pd.DataFrame, dtypes: Dict = COLUMN_DTYPES) -> pd.DataFrame:
+    """
+    Casts the columns of `df` to `dtypes`, and text columns that are not
+    listed to Arrow-backed strings. Columns that already have their dtype
+    are not copied.
+    """
+    casts = {}
+    for column in df.columns:
+        dtype = dtypes.get(column)
+        values = df[column]
+        if dtype is None:
+            if (
+                values.dtype == object
+                and pd.api.types.infer_dtype(values, skipna=True) == "string"
+            ):
+                casts[column] = STRING_DTYPE
+        elif isinstance(dtype, str) and dtype == "category":
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                casts[column] = dtype
+        elif values.dtype != dtype:
+            casts[column] = dtype
+    if not casts:
+        return df
+    return df.astype(casts)
+
+
+def legacy_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    ## The dtypes before the policy: Python strings in object columns,
+    ## float64 floats and object booleans where values can be missing
+    casts = {}
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, (pd.CategoricalDtype, pd.StringDtype)):
+            casts[column] = object
+        elif dtype == "boolean":
+            casts[column] = object if df[column].isna().any() else bool
+        elif pd.api.types.is_float_dtype(dtype):
+            casts[column] = "float64"
+    return df.astype(casts)
+
+
+def memory_report(df: pd.DataFrame, dtypes: Dict = COLUMN_DTYPES) -> Dict:
+    """
+    In-memory size of `df` with the legacy dtypes and with the policy, in MB,
+    in total and for the columns the policy shrinks the most.
+    """
+    legacy_usage = legacy_dtypes(df).memory_usage(deep=True, index=False)
+    policy_usage = apply_dtype_policy(df, dtypes).memory_usage(deep=True, index=False)
+    saved = (legacy_usage - policy_usage).sort_values(ascending=False)
+
+    return {
+        "rows": len(df),
+        "legacy_mb": round(legacy_usage.sum() / 1024**2, 3),
+        "policy_mb": round(policy_usage.sum() / 1024**2, 3),
+        "reduction": round(1 - policy_usage.sum() / max(legacy_usage.sum(), 1), 3),
+        "top_columns": {
+            column: {
+                "legacy_mb": round(legacy_usage[column] / 1024**2, 3),
+                "policy_mb": round(policy_usage[column] / 1024**2, 3),
+            }
+            for column in saved.index[:5]
+            if saved[column] > 0
+        },
+    }
+
+
+if __name__ == "__main__":
+    import json
+    from src.pipeline.spill import read_dataset
+    from src.pipeline.transforms import (
+        POI_STAGING_DATASETS,
+        SITE_STAGING_DATASET,
+        PROXIMITY_STAGING_DATASET,
+    )
+
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Report the memory of the staging datasets with and without the dtype policy."
+    )
+    parser.add_argument(
+        "--staging_dir",
+        type=str,
+        default="./data/staging",
+        help="Output directory of a pipeline run.",
+    )
+    args = parser.parse_args()
+
+    datasets = {SITE_STAGING_DATASET: COLUMN_DTYPES}
+    datasets.update({name: COLUMN_DTYPES for name in POI_STAGING_DATASETS.values()})
+    datasets[PROXIMITY_STAGING_DATASET] = PROXIMITY_DTYPES
+
+    report = {
+        name: memory_report(read_dataset(f"{args.staging_dir}/{name}"), dtypes)
+        for name, dtypes in datasets.items()
+    }
+    logging.info(f"Staging memory report:\n{json.dumps(report, indent=2)}")
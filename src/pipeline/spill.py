@@ -0,0 +1,378 @@
+import os
+import glob
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from typing import Dict, List, Optional, Tuple
+from src.utils.instrumentation import record_io
+from src.pipeline.schema import COLUMN_DTYPES, apply_dtype_policy
+from src.pipeline.query_planner import padded_bounds
+
+## Working copies of a chunk (parsing, masks, merges) take a multiple of
+## the memory of the raw rows
+CHUNK_MEMORY_FACTOR = 10
+
+PARQUET_COMPRESSION = "zstd"
+## Rows per row group, the unit a filtered read can skip on its statistics
+ROW_GROUP_SIZE = 65536
+
+
+def estimate_rows_per_chunk(
+    csv_path: str, memory_budget_mb: float, sample_rows: int = 1000
+) -> int:
+    """
+    Estimates how many rows of a CSV file can be processed at once within
+    `memory_budget_mb`, from the in-memory size of the first `sample_rows`.
+    """
+    sample = pd.read_csv(csv_path, nrows=sample_rows)
+    if sample.empty:
+        return sample_rows
+
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    rows_per_chunk = int(
+        memory_budget_mb * 1024 * 1024 / (bytes_per_row * CHUNK_MEMORY_FACTOR)
+    )
+    rows_per_chunk = max(rows_per_chunk, 1)
+    logging.info(
+        f"(Spill): ~{bytes_per_row:.0f} bytes per row, processing {rows_per_chunk} rows per chunk "
+        f"within {memory_budget_mb} MB."
+    )
+    return rows_per_chunk
+
+
+def reset_dataset(dataset_dir: str) -> None:
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    os.makedirs(dataset_dir, exist_ok=True)
+
+
+def partition_dir(dataset_dir: str, partition_column: str, value) -> str:
+    return os.path.join(dataset_dir, f"{partition_column}={value}")
+
+
+def assign_tiles(site_df: pd.DataFrame, tile_deg: float) -> pd.Series:
+    lat_index = np.floor(site_df["lat"].to_numpy() / tile_deg).astype(int)
+    lon_index = np.floor(site_df["lon"].to_numpy() / tile_deg).astype(int)
+    return pd.Series(
+        [f"{lat}_{lon}" for lat, lon in zip(lat_index, lon_index)],
+        index=site_df.index,
+    )
+
+
+def tiles_within(df: pd.DataFrame, radius_m: float, tile_deg: float) -> List[str]:
+    """
+    Tiles of `assign_tiles` that hold any point within `radius_m` meters of
+    a row of `df`, from the box around every row.
+    """
+    lat = df["lat"].to_numpy(dtype=float)
+    lon = df["lon"].to_numpy(dtype=float)
+    corners = np.floor(
+        np.column_stack(padded_bounds(lat, lon, lat, lon, radius_m)) / tile_deg
+    ).astype(int)
+
+    tiles = set()
+    for min_lat, min_lon, max_lat, max_lon in np.unique(corners, axis=0):
+        for lat_index in range(min_lat, max_lat + 1):
+            for lon_index in range(min_lon, max_lon + 1):
+                tiles.add(f"{lat_index}_{lon_index}")
+    return sorted(tiles)
+
+
+def write_part(table: pa.Table, part_path: str) -> None:
+    pq.write_table(
+        table,
+        part_path,
+        compression=PARQUET_COMPRESSION,
+        row_group_size=ROW_GROUP_SIZE,
+    )
+    record_io(bytes_written=os.path.getsize(part_path))
+
+
+def to_arrow(df: pd.DataFrame, dtypes: Dict = COLUMN_DTYPES) -> pa.Table:
+    """
+    `df` with the dtype policy as an Arrow table. Categoricals are stored
+    dictionary-encoded with int32 indices, so parts written from different
+    chunks have the same schema whatever their number of categories.
+    """
+    table = pa.Table.from_pandas(apply_dtype_policy(df, dtypes), preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type) and field.type.index_type != pa.int32():
+            table = table.set_column(
+                i,
+                field.name,
+                table.column(i).cast(
+                    pa.dictionary(pa.int32(), field.type.value_type)
+                ),
+            )
+    return table
+
+
+def compact_dictionaries(table: pa.Table) -> pa.Table:
+    """
+    Drops the dictionary values no row of `table` uses. A `take` keeps the
+    whole dictionary, so without this every partition of a dataset would
+    store all the categories of the table it was cut from.
+    """
+    for i, field in enumerate(table.schema):
+        if not pa.types.is_dictionary(field.type) or table.num_rows == 0:
+            continue
+        column = table.column(i).combine_chunks()
+        is_used = np.zeros(len(column.dictionary), dtype=bool)
+        is_used[column.indices.drop_null().to_numpy()] = True
+        ## Used values keep their order, indices are shifted down to them
+        new_positions = pa.array(np.cumsum(is_used, dtype=np.int32) - 1)
+        table = table.set_column(
+            i,
+            field,
+            pa.DictionaryArray.from_arrays(
+                new_positions.take(column.indices),
+                column.dictionary.filter(pa.array(is_used)),
+            ),
+        )
+    return table
+
+
+def write_partitions(
+    table: pa.Table, dataset_dir: str, partition_column: str, part_name: str
+) -> Dict:
+    """
+    Writes an Arrow `table` to a hive-style partitioned Parquet dataset, one
+    file named `part_name` per value of `partition_column`.
+
+    Returns:
+        Dict: Number of rows written per partition value.
+    """
+    partitions = pd.Series(table.column(partition_column).to_numpy(zero_copy_only=False))
+    table = table.drop_columns([partition_column])
+    rows_written = {}
+    for value, rows in partitions.groupby(partitions, sort=False).indices.items():
+        output_dir = partition_dir(dataset_dir, partition_column, value)
+        os.makedirs(output_dir, exist_ok=True)
+        write_part(
+            compact_dictionaries(table.take(rows)),
+            os.path.join(output_dir, f"{part_name}.parquet"),
+        )
+        rows_written[value] = len(rows)
+    return rows_written
+
+
+def spill_partitions(
+    df: pd.DataFrame,
+    dataset_dir: str,
+    partition_column: str,
+    part_name: str,
+    dtypes: Dict = COLUMN_DTYPES,
+) -> Dict:
+    """
+    Writes `df` to a hive-style partitioned Parquet dataset, one file named
+    `part_name` per value of `partition_column`. Every call adds new part
+    files, so a dataset can be filled chunk by chunk without reading it back.
+    The rows are converted to Arrow once with the `dtypes` policy, so all
+    parts of a call share a schema.
+
+    Returns:
+        Dict: Number of rows written per partition value.
+    """
+    return write_partitions(
+        to_arrow(df, dtypes), dataset_dir, partition_column, part_name
+    )
+
+
+def write_table_dataset(
+    table: pa.Table, dataset_dir: str, partition_column: str = "tile"
+) -> Dict:
+    """
+    Replaces the dataset in `dataset_dir` with an Arrow `table` that has the
+    dtype policy already, partitioned by `partition_column`.
+
+    Returns:
+        Dict: Number of rows written per partition value.
+    """
+    reset_dataset(dataset_dir)
+    if table.num_rows == 0:
+        ## An empty part keeps the columns of an empty dataset
+        write_part(
+            table.drop_columns([partition_column]),
+            os.path.join(dataset_dir, "part-00000.parquet"),
+        )
+        return {}
+    return write_partitions(table, dataset_dir, partition_column, "part-00000")
+
+
+def write_dataset(
+    df: pd.DataFrame,
+    dataset_dir: str,
+    partition_column: str = "tile",
+    sort_by: Optional[str] = None,
+    dtypes: Dict = COLUMN_DTYPES,
+) -> Dict:
+    """
+    Replaces the dataset in `dataset_dir` with `df`, partitioned by
+    `partition_column`. Sorting the rows by `sort_by` keeps the values of
+    that column clustered in few row groups, so filters on it skip the rest.
+
+    Returns:
+        Dict: Number of rows written per partition value.
+    """
+    if sort_by is not None:
+        df = df.sort_values(sort_by, kind="stable")
+    return write_table_dataset(to_arrow(df, dtypes), dataset_dir, partition_column)
+
+
+def replace_partitions(
+    df: pd.DataFrame,
+    dataset_dir: str,
+    partitions: List,
+    partition_column: str = "tile",
+    sort_by: Optional[str] = None,
+    dtypes: Dict = COLUMN_DTYPES,
+) -> Dict:
+    """
+    Replaces the `partitions` of the dataset in `dataset_dir` with `df`, whose
+    rows all belong to one of them, and keeps the other partitions. An
+    incremental update only rewrites the partitions it read.
+
+    Returns:
+        Dict: Number of rows written per partition value.
+    """
+    for value in partitions:
+        path = partition_dir(dataset_dir, partition_column, value)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    if sort_by is not None:
+        df = df.sort_values(sort_by, kind="stable")
+    table = to_arrow(df, dtypes)
+    if table.num_rows == 0:
+        if not glob.glob(os.path.join(dataset_dir, "**", "*.parquet"), recursive=True):
+            ## An empty part keeps the columns of an empty dataset
+            write_part(
+                table.drop_columns([partition_column]),
+                os.path.join(dataset_dir, "part-00000.parquet"),
+            )
+        return {}
+    return write_partitions(table, dataset_dir, partition_column, "part-00000")
+
+
+def list_partitions(dataset_dir: str, partition_column: str) -> List[str]:
+    prefix = f"{partition_column}="
+    return sorted(
+        entry.name[len(prefix):]
+        for entry in os.scandir(dataset_dir)
+        if entry.is_dir() and entry.name.startswith(prefix)
+    )
+
+
+def open_dataset(path: str, partition_column: str = "tile") -> ds.Dataset:
+    """
+    A partitioned dataset directory or a single Parquet file as an Arrow
+    dataset. Parts written by different chunks can have different columns,
+    the dataset has the union of them.
+    """
+    if not os.path.isdir(path):
+        return ds.dataset(path, format="parquet")
+
+    part_paths = sorted(
+        glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True)
+    )
+    partitioning = ds.partitioning(
+        pa.schema([(partition_column, pa.string())]), flavor="hive"
+    )
+    schema = pa.unify_schemas(
+        [pq.read_schema(part_path) for part_path in part_paths]
+        + [partitioning.schema],
+        promote_options="permissive",
+    )
+    return ds.dataset(
+        part_paths,
+        schema=schema,
+        format="parquet",
+        partitioning=partitioning,
+        partition_base_dir=path,
+    )
+
+
+def bytes_to_read(
+    dataset: ds.Dataset, columns: List[str], filter: Optional[ds.Expression]
+) -> int:
+    """
+    Compressed size of the column chunks a read of `columns` has to touch,
+    after skipping the partitions and row groups that `filter` excludes.
+    """
+    fragments = dataset.get_fragments(filter=filter)
+    if filter is not None:
+        fragments = [
+            row_group
+            for fragment in fragments
+            for row_group in fragment.split_by_row_group(filter, schema=dataset.schema)
+        ]
+
+    columns = set(columns)
+    num_bytes = 0
+    for fragment in fragments:
+        metadata = fragment.metadata
+        for row_group in fragment.row_groups:
+            row_group_metadata = metadata.row_group(row_group.id)
+            for i in range(row_group_metadata.num_columns):
+                column = row_group_metadata.column(i)
+                if column.path_in_schema in columns:
+                    num_bytes += column.total_compressed_size
+    return num_bytes
+
+
+def read_dataset(
+    path: str,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Tuple]] = None,
+    partition_column: str = "tile",
+) -> pd.DataFrame:
+    """
+    Reads a staging dataset (a partitioned directory or a single Parquet
+    file). `columns` and `filters` (in the format of `pd.read_parquet`, e.g.
+    [("site_id", "in", [...])]) are pushed down to the Parquet reader, so
+    only the selected columns of the matching partitions and row groups are
+    read. Requested columns the dataset does not have are left out, the
+    partition column is only returned when it is requested.
+    """
+    dataset = open_dataset(path, partition_column=partition_column)
+    return scan_dataset(dataset, columns, filters, partition_column, count_bytes=True)
+
+
+def scan_dataset(
+    dataset: ds.Dataset,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Tuple]] = None,
+    partition_column: str = "tile",
+    count_bytes: bool = False,
+) -> pd.DataFrame:
+    ## Column selection and filters of `read_dataset` for any Arrow dataset,
+    ## Parquet files or in-memory tables
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != partition_column]
+    columns = [name for name in columns if name in dataset.schema.names]
+    ## Arrow cannot type an empty value set, and nothing matches it anyway
+    if any(op == "in" and len(values) == 0 for _, op, values in filters or []):
+        return dataset.schema.empty_table().select(columns).to_pandas()
+    filter = pq.filters_to_expression(filters) if filters else None
+
+    if count_bytes:
+        record_io(bytes_read=bytes_to_read(dataset, columns, filter))
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+def read_partition(
+    dataset_dir: str,
+    partition_column: str,
+    value,
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    ## Only the parts of the partition are opened
+    return read_dataset(
+        partition_dir(dataset_dir, partition_column, value),
+        columns=columns,
+        partition_column=partition_column,
+    )
@@ -0,0 +1,113 @@
+import os
+import logging
+import contextvars
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+from src.pipeline.schema import COLUMN_DTYPES
+from src.pipeline.spill import scan_dataset, to_arrow, write_table_dataset
+from src.utils.instrumentation import span
+
+
+class StagingStore:
+    """
+    In-process hand-off of the staging datasets from the silver to the gold
+    layer. Every dataset is kept as the Arrow table a staging write would
+    produce (dtype policy, rows in partition order) and read back with the
+    same column selection and filters as `read_dataset`, without a Parquet
+    round trip.
+
+    With `persist` the tables are also written to their staging datasets in
+    `output_dir` by a background thread, so the next stage does not wait for
+    the write. `flush` waits for the writes and raises their errors; the
+    store is a context manager that flushes on exit.
+    """
+
+    def __init__(self, output_dir: str, persist: bool = True):
+        self.output_dir = output_dir
+        self.persist = persist
+        self.tables: Dict[str, pa.Table] = {}
+        self.side_writes: List[Future] = []
+        ## One writer keeps the writes of a dataset in the order of the puts
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="staging-writer"
+        )
+
+    def __contains__(self, dataset_name: str) -> bool:
+        return dataset_name in self.tables
+
+    def put(
+        self,
+        df: pd.DataFrame,
+        dataset_name: str,
+        partition_column: str = "tile",
+        sort_by: Optional[str] = None,
+        dtypes: Dict = COLUMN_DTYPES,
+    ) -> None:
+        ## Same row order as reading the persisted dataset: partitions in
+        ## directory order, rows sorted by `sort_by` within them
+        sort_columns = [partition_column] + ([sort_by] if sort_by else [])
+        table = to_arrow(df.sort_values(sort_columns, kind="stable"), dtypes)
+        self.tables[dataset_name] = table
+
+        if self.persist:
+            ## The writer records its I/O in the span of the stage that put
+            ## the table
+            self.side_writes.append(
+                self.executor.submit(
+                    contextvars.copy_context().run,
+                    self._write,
+                    table,
+                    dataset_name,
+                    partition_column,
+                )
+            )
+
+    def _write(self, table: pa.Table, dataset_name: str, partition_column: str) -> None:
+        with span("side_write", dataset=dataset_name) as write_span:
+            write_table_dataset(
+                table,
+                dataset_dir=os.path.join(self.output_dir, dataset_name),
+                partition_column=partition_column,
+            )
+            write_span.add(rows_out=table.num_rows)
+        logging.info(
+            f"(StagingStore): Succesfully saved dataset: {self.output_dir}/{dataset_name}"
+        )
+
+    def read(
+        self,
+        dataset_name: str,
+        columns: Optional[List[str]] = None,
+        filters: Optional[List] = None,
+        partition_column: str = "tile",
+    ) -> pd.DataFrame:
+        """
+        A dataset that was put in the store, see `read_dataset` for `columns`
+        and `filters`. The frame has the Arrow-backed dtypes of the table.
+        """
+        return scan_dataset(
+            ds.dataset(self.tables[dataset_name]),
+            columns=columns,
+            filters=filters,
+            partition_column=partition_column,
+        )
+
+    def flush(self) -> None:
+        side_writes, self.side_writes = self.side_writes, []
+        for side_write in side_writes:
+            side_write.result()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self) -> "StagingStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
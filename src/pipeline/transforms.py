@@ -1,50 +1,280 @@
-import os
-import json
 import logging
+import numpy as np
 import pandas as pd
-from glob import glob
-from typing import List, Union
-from src.utils.helpers import haversine, save_intermediete_data
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+from src.pipeline.proximity import POIProximityIndex
+from src.pipeline.raw_store import raw_size, read_raw_responses
+from src.pipeline.spill import (
+    assign_tiles,
+    read_dataset,
+    replace_partitions,
+    tiles_within,
+    write_dataset,
+)
+from src.pipeline.schema import (
+    COLUMN_DTYPES,
+    POI_CATEGORIES,
+    PROXIMITY_DTYPES,
+    apply_dtype_policy,
+)
+from src.pipeline.staging_store import StagingStore
+from src.pipeline.validation import validate_coordinates
+from src.utils.helpers import map_in_order
+from src.utils.instrumentation import span
+
+## The staging layer is a set of Parquet datasets partitioned by geotiles
+## of `STAGING_TILE_DEG` degrees ('tile=<lat>_<lon>' directories). Sites
+## and their proximities are staged in the tile of the site, POIs in their
+## own tile.
+POI_STAGING_DATASETS = {category: f"{category}_pois" for category in POI_CATEGORIES}
+SITE_STAGING_DATASET = "site_data"
+PROXIMITY_STAGING_DATASET = "site_pois_proximities"
+STAGING_TILE_DEG = 0.5
+
+## Columns of the POIs the proximity join needs
+POI_LOCATION_COLUMNS = ["poi_id", "lat", "lon", "category"]
+
+## Important columns in site data
+SITE_COLUMNS = [
+    "id",
+    "locality",
+    "postalCode",
+    "state",
+    "operatorId",
+    "operatorName",
+    "lon",
+    "lat",
+]
+
+
+def save_staging_data(
+    df: pd.DataFrame,
+    output_dir: str,
+    dataset_name: str,
+    tiles: pd.Series,
+    sort_by: str = None,
+    dtypes: Dict = COLUMN_DTYPES,
+    store: Optional[StagingStore] = None,
+    partitions: List = None,
+) -> None:
+    ## With a `store` the dataset is handed on in memory and persisted by
+    ## the store, if at all. With `partitions` only those tiles of the
+    ## dataset are replaced by `df`
+    df = df.assign(tile=np.asarray(tiles, dtype=object))
+    if store is not None:
+        store.put(df, dataset_name, sort_by=sort_by, dtypes=dtypes)
+        return
+
+    if partitions is not None:
+        replace_partitions(
+            df,
+            dataset_dir=f"{output_dir}/{dataset_name}",
+            partitions=partitions,
+            sort_by=sort_by,
+            dtypes=dtypes,
+        )
+    else:
+        write_dataset(
+            df,
+            dataset_dir=f"{output_dir}/{dataset_name}",
+            sort_by=sort_by,
+            dtypes=dtypes,
+        )
+    logging.info(f"Succesfully saved dataset: {output_dir}/{dataset_name}")
+
+
+def read_staging_data(
+    output_dir: str,
+    dataset_name: str,
+    columns: List = None,
+    filters: List = None,
+    store: Optional[StagingStore] = None,
+) -> pd.DataFrame:
+    """
+    Reads a staging dataset, see `read_dataset` for how `columns` and
+    `filters` are pushed down. Datasets put in `store` are read from memory.
+    """
+    if store is not None and dataset_name in store:
+        return store.read(dataset_name, columns=columns, filters=filters)
+    return read_dataset(
+        f"{output_dir}/{dataset_name}", columns=columns, filters=filters
+    )
 
 
-def read_raw_data(poi_json_file_paths: List) -> List[pd.DataFrame]:
-    fast_food_poi_df = []
-    fuel_station_poi_df = []
-    supermarket_poi_df = []
+def site_tiles_of(site_ids: pd.Series, site_df: pd.DataFrame) -> np.ndarray:
+    ## Tile of the site of every id, proximities are staged with their site
+    site_df = site_df.drop_duplicates(subset="site_id")
+    tiles = assign_tiles(site_df, tile_deg=STAGING_TILE_DEG).to_numpy()
+    return tiles[pd.Index(site_df["site_id"]).get_indexer(site_ids)]
 
-    for poi_json_file in poi_json_file_paths:
-        with open(poi_json_file, "r") as file:
-            poi_data = json.load(file)
 
+def save_poi_staging_data(
+    df: pd.DataFrame,
+    output_dir: str,
+    category: str,
+    store: Optional[StagingStore] = None,
+    partitions: List = None,
+) -> None:
+    save_staging_data(
+        df=df,
+        output_dir=output_dir,
+        dataset_name=POI_STAGING_DATASETS[category],
+        tiles=assign_tiles(df, tile_deg=STAGING_TILE_DEG),
+        sort_by="poi_id",
+        store=store,
+        partitions=partitions,
+    )
+
+
+def save_proximity_staging_data(
+    proximity_df: pd.DataFrame,
+    site_df: pd.DataFrame,
+    output_dir: str,
+    store: Optional[StagingStore] = None,
+    partitions: List = None,
+) -> None:
+    save_staging_data(
+        df=proximity_df,
+        output_dir=output_dir,
+        dataset_name=PROXIMITY_STAGING_DATASET,
+        tiles=site_tiles_of(proximity_df["site_id"], site_df),
+        sort_by="site_id",
+        dtypes=PROXIMITY_DTYPES,
+        store=store,
+        partitions=partitions,
+    )
+
+
+def flatten_poi_element(element: Dict, prefix: str = "") -> Dict:
+    """
+    Flattens a raw OSM element the same way pd.json_normalize does: nested
+    objects such as 'tags' and 'center' become dotted columns ('tags.brand',
+    'center.lat') placed after the scalar fields.
+    """
+    row = {}
+    nested = []
+    for key, value in element.items():
+        if isinstance(value, dict):
+            nested.append((key, value))
+        else:
+            row[f"{prefix}{key}"] = value
+
+    for key, value in nested:
+        row.update(flatten_poi_element(value, prefix=f"{prefix}{key}."))
+    return row
+
+
+def categorize_poi_element(element: Dict) -> Union[str, None]:
+    tags = element.get("tags", {})
+
+    amenity = tags.get("amenity")
+    shop = tags.get("shop")
+
+    if amenity == "fast_food":
+        return "fast_food"
+    elif amenity == "fuel":
+        return "fuel"
+    elif shop == "supermarket":
+        return "supermarket"
+    return None
+
+
+class ColumnBuffer:
+    """
+    Append-only column store used to build a DataFrame with a single
+    constructor call. Columns that are missing from a row are padded with NaN,
+    so the result matches a pd.concat of one-row frames.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.num_rows = 0
+
+    def append(self, row: Dict) -> None:
+        for key, value in row.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = []
+            if len(column) < self.num_rows:
+                column.extend([np.nan] * (self.num_rows - len(column)))
+            column.append(value)
+        self.num_rows += 1
+
+    def pad(self) -> Dict:
+        for column in self.columns.values():
+            if len(column) < self.num_rows:
+                column.extend([np.nan] * (self.num_rows - len(column)))
+        return self.columns
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.pad())
+
+
+def read_raw_data_shard(poi_json_file_paths: List) -> Dict[str, pd.DataFrame]:
+    buffers = {category: ColumnBuffer() for category in POI_CATEGORIES}
+
+    for poi_data in read_raw_responses(poi_json_file_paths):
         for poi in poi_data:
-            tags = poi.get("tags", {})
+            category = categorize_poi_element(poi)
+            if category is None:
+                continue
 
-            amenity = tags.get("amenity")
-            shop = tags.get("shop")
+            row = flatten_poi_element(poi)
+            row["category"] = category
+            buffers[category].append(row)
 
-            if amenity == "fast_food":
-                df = pd.json_normalize(poi)
-                df["category"] = "fast_food"
-                fast_food_poi_df.append(df)
+    return {
+        category: buffer.to_frame() for category, buffer in buffers.items()
+    }
 
-            elif amenity == "fuel":
-                df = pd.json_normalize(poi)
-                df["category"] = "fuel"
-                fuel_station_poi_df.append(df)
 
-            elif shop == "supermarket":
-                df = pd.json_normalize(poi)
-                df["category"] = "supermarket"
-                supermarket_poi_df.append(df)
+def read_raw_data(
+    poi_json_file_paths: List, max_workers: int = 1, chunk_size: int = 512
+) -> List[pd.DataFrame]:
+    """
+    Reads raw POI responses (references into the raw shards, or legacy JSON
+    files) into one DataFrame per category.
 
-    fast_food_poi_df = pd.concat(fast_food_poi_df)
-    fuel_station_poi_df = pd.concat(fuel_station_poi_df)
-    supermarket_poi_df = pd.concat(supermarket_poi_df)
+    With `max_workers` > 1 the responses are split into chunks of
+    `chunk_size` responses that are parsed on a process pool. Every worker
+    returns one frame per category and the parent concatenates them in chunk
+    order, so the result is the same as reading the responses sequentially.
+    """
+    with span("read_raw_data", files=len(poi_json_file_paths)) as read_span:
+        read_span.add(
+            bytes_read=sum(raw_size(path) for path in poi_json_file_paths)
+        )
+        if max_workers <= 1 or len(poi_json_file_paths) <= chunk_size:
+            category_dfs = read_raw_data_shard(poi_json_file_paths)
+        else:
+            shards = [
+                poi_json_file_paths[start : start + chunk_size]
+                for start in range(0, len(poi_json_file_paths), chunk_size)
+            ]
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                shard_dfs = list(executor.map(read_raw_data_shard, shards))
+
+            category_dfs = {
+                category: pd.concat(
+                    [shard[category] for shard in shard_dfs], ignore_index=True
+                )
+                for category in POI_CATEGORIES
+            }
+            logging.info(
+                f"(Transforms): Parsed {len(shards)} chunks of raw POI responses on {max_workers} processes."
+            )
 
-    logging.info(
-        f"(Transforms): Succesfully read {len(poi_json_file_paths)} raw POI data file and converted to DataFrame."
+        logging.info(
+            f"(Transforms): Succesfully read {len(poi_json_file_paths)} raw POI responses and converted to DataFrame."
+        )
+        read_span.add(rows_out=sum(len(df) for df in category_dfs.values()))
+
+    return (
+        category_dfs["fast_food"],
+        category_dfs["fuel"],
+        category_dfs["supermarket"],
     )
-    return (fast_food_poi_df, fuel_station_poi_df, supermarket_poi_df)
 
 
 def deduplicate_poi_data(df: pd.DataFrame) -> pd.DataFrame:
@@ -75,179 +305,473 @@ def extract_lat_long_for_ways(df: pd.DataFrame) -> pd.DataFrame:
         pd.DataFrame: The input DataFrame with new 'latitude' and 'longitude' columns,
                       where missing values from 'lat'/'lon' are filled using 'center.lat'/'center.lon'.
     """
-    df["lat"] = df["lat"].fillna(df["center.lat"])
-    df["lon"] = df["lon"].fillna(df["center.lon"])
-    df = df.drop(["center.lat", "center.lon"], axis=1)
+    for column in ["lat", "lon"]:
+        if column not in df.columns:
+            df[column] = np.nan
+        if f"center.{column}" in df.columns:
+            df[column] = df[column].fillna(df[f"center.{column}"])
+    df = df.drop(["center.lat", "center.lon"], axis=1, errors="ignore")
     logging.info(
         f"(Transforms): Successfully extracted latitudes and longitudes of ways(center)."
     )
     return df
 
 
-def validate_lat(lat: float) -> Union[float, None]:
+def prepare_poi_data(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Returns the latitude if it's within the valid range (-90 to 90), else None.
+    Cleans the raw POI DataFrame of one category: renames 'id' to 'poi_id',
+    deduplicates, fills the coordinates of ways, validates lat/lon and
+    applies the dtype policy.
     """
-    try:
-        lat = float(lat)
-        if -90.0 <= lat <= 90.0:
-            return lat
-    except (ValueError, TypeError):
-        pass
-    logging.critical("Latitude is wrong.")
-    return None
+    if df.empty:
+        return apply_dtype_policy(
+            pd.DataFrame(columns=["type", "poi_id", "lat", "lon", "category"])
+        )
 
+    df = df.rename(columns={"id": "poi_id"})
+    df = deduplicate_poi_data(df=df)
+    df = extract_lat_long_for_ways(df=df)
+    df = validate_coordinates(df=df)
+    return apply_dtype_policy(df)
 
-def validate_lon(lon: float) -> Union[float, None]:
-    """
-    Returns the longitude if it's within the valid range (-180 to 180), else None.
-    """
-    try:
-        lon = float(lon)
-        if -180.0 <= lon <= 180.0:
-            return lon
-    except (ValueError, TypeError):
 
-        pass
-    logging.critical("Longitude is wrong.")
-    return None
+def prepare_site_data(site_df: pd.DataFrame) -> pd.DataFrame:
+    site_df = site_df[SITE_COLUMNS]
+    return site_df.rename({"id": "site_id"}, axis=1)
 
 
 def compute_distance_between_pois_sites(
-    all_poi_data: pd.DataFrame, site_data: pd.DataFrame
+    all_poi_data: pd.DataFrame, site_data: pd.DataFrame, radius_m: float = 100
 ) -> pd.DataFrame:
-    all_poi_data["key"] = 1
-    site_data["key"] = 1
-    pairs = all_poi_data.merge(
-        site_data, on="key", suffixes=("_site", "_poi")
-    ).drop("key", axis=1)
-
-    pairs["distance_m"] = haversine(
-        pairs["lat_site"],
-        pairs["lon_site"],
-        pairs["lat_poi"],
-        pairs["lon_poi"],
-    )
-
-    proximity_df = pairs.loc[
-        pairs["distance_m"] <= 100,
-        ["site_id", "poi_id", "distance_m", "category"],
-    ]
-    return proximity_df
+    """
+    Finds all POIs within `radius_m` meters of every site using a spatial index
+    over the POIs instead of a full site x POI cross join.
 
+    Args:
+        all_poi_data (pd.DataFrame): POIs with 'poi_id', 'lat', 'lon' and 'category'.
+        site_data (pd.DataFrame): Sites with 'site_id', 'lat' and 'lon'.
+        radius_m (float): Search radius in meters.
 
-def transformation_pipeline(
-    site_df: pd.DataFrame, poi_json_file_paths: List, output_dir: str
-) -> pd.DataFrame:
+    Returns:
+        pd.DataFrame: Proximity data with 'site_id', 'poi_id', 'distance_m' and 'category'.
+    """
+    with span("proximity_join", radius_m=radius_m) as join_span:
+        proximity_index = POIProximityIndex(poi_data=all_poi_data)
+        proximity_df = proximity_index.query_radius(
+            site_data=site_data, radius_m=radius_m
+        )
+        join_span.add(rows_in=len(site_data), rows_out=len(proximity_df))
+        return proximity_df
 
-    ## Important columns in site data
-    important_columns = [
-        "id",
-        "locality",
-        "postalCode",
-        "state",
-        "operatorId",
-        "operatorName",
-        "lon",
-        "lat",
-    ]
-    site_df = site_df[important_columns]
-    site_df = site_df.rename({"id": "site_id"}, axis=1)
 
+def transform_site_data(
+    site_df: pd.DataFrame, output_dir: str, store: Optional[StagingStore] = None
+) -> str:
+    ## Saving cleaned site data
+    site_df = prepare_site_data(site_df=site_df)
+    save_staging_data(
+        df=site_df,
+        output_dir=output_dir,
+        dataset_name=SITE_STAGING_DATASET,
+        tiles=assign_tiles(site_df, tile_deg=STAGING_TILE_DEG),
+        store=store,
+    )
+    return SITE_STAGING_DATASET
+
+
+def transform_poi_data(
+    poi_json_file_paths: List,
+    output_dir: str,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    store: Optional[StagingStore] = None,
+    category_workers: int = 1,
+):
     ## Reading raw POI data and seperating them into category based DataFrames
-    (fast_food_poi_df, fuel_station_poi_df, supermarket_poi_df) = (
-        read_raw_data(poi_json_file_paths=poi_json_file_paths)
+    poi_dfs = read_raw_data(
+        poi_json_file_paths=poi_json_file_paths,
+        max_workers=read_workers,
+        chunk_size=read_chunk_size,
     )
 
-    ## Renaming the column "id" to "poi_id"
-    fast_food_poi_df = fast_food_poi_df.rename(columns={"id": "poi_id"})
-    fuel_station_poi_df = fuel_station_poi_df.rename(columns={"id": "poi_id"})
-    supermarket_poi_df = supermarket_poi_df.rename(columns={"id": "poi_id"})
+    ## Renaming, deduplicating, extracting coordinates of ways, validating and
+    ## saving the POI data of every category, the categories are independent
+    ## and run on `category_workers` threads
+    def transform_category(category_poi_df):
+        category, poi_df = category_poi_df
+        save_poi_staging_data(
+            df=prepare_poi_data(df=poi_df),
+            output_dir=output_dir,
+            category=category,
+            store=store,
+        )
 
-    ## Deduplicating POI data
-    fast_food_poi_df = deduplicate_poi_data(df=fast_food_poi_df)
-    fuel_station_poi_df = deduplicate_poi_data(df=fuel_station_poi_df)
-    supermarket_poi_df = deduplicate_poi_data(df=supermarket_poi_df)
+    map_in_order(
+        transform_category,
+        list(zip(POI_CATEGORIES, poi_dfs)),
+        max_workers=category_workers,
+        thread_name_prefix="transform-category",
+    )
 
-    ## Extracting Latitude and Longitude for ways type data
-    fast_food_poi_df = extract_lat_long_for_ways(df=fast_food_poi_df)
-    fuel_station_poi_df = extract_lat_long_for_ways(df=fuel_station_poi_df)
-    supermarket_poi_df = extract_lat_long_for_ways(df=supermarket_poi_df)
+    return (
+        POI_STAGING_DATASETS["fast_food"],
+        POI_STAGING_DATASETS["fuel"],
+        POI_STAGING_DATASETS["supermarket"],
+    )
 
-    ## Validating Latitude and Longitude values
-    fast_food_poi_df["lat"] = fast_food_poi_df["lat"].apply(validate_lat)
-    fast_food_poi_df["lon"] = fast_food_poi_df["lon"].apply(validate_lon)
 
-    fuel_station_poi_df["lat"] = fuel_station_poi_df["lat"].apply(validate_lat)
-    fuel_station_poi_df["lon"] = fuel_station_poi_df["lon"].apply(validate_lon)
+def build_proximity_data(
+    output_dir: str,
+    proximity_radius_m: float = 100,
+    store: Optional[StagingStore] = None,
+    category_workers: int = 1,
+) -> str:
+    ## The site and POI datasets are read side by side
+    site_df, *all_pois_data = map_in_order(
+        lambda dataset: read_staging_data(
+            output_dir, dataset[0], columns=dataset[1], store=store
+        ),
+        [(SITE_STAGING_DATASET, ["site_id", "lat", "lon"])]
+        + [
+            (dataset_name, POI_LOCATION_COLUMNS)
+            for dataset_name in POI_STAGING_DATASETS.values()
+        ],
+        max_workers=category_workers,
+        thread_name_prefix="read-staging",
+    )
+    all_pois_data = pd.concat(all_pois_data)
 
-    supermarket_poi_df["lat"] = supermarket_poi_df["lat"].apply(validate_lat)
-    supermarket_poi_df["lon"] = supermarket_poi_df["lon"].apply(validate_lon)
+    ## Creating proximity relationship dataset between site and POI
+    proximity_df = compute_distance_between_pois_sites(
+        all_poi_data=all_pois_data,
+        site_data=site_df,
+        radius_m=proximity_radius_m,
+    )
 
-    ## Saving fast food POI data
-    fast_food_poi_df_file_name = (
-        f"{fast_food_poi_df.category.values[0]}_pois.parquet"
+    ## Saving proximity data
+    save_proximity_staging_data(
+        proximity_df=proximity_df, site_df=site_df, output_dir=output_dir, store=store
     )
-    save_intermediete_data(
-        df=fast_food_poi_df,
-        output_dir=output_dir,
-        file_name=fast_food_poi_df_file_name,
+    return PROXIMITY_STAGING_DATASET
+
+
+def transformation_pipeline(
+    site_df: pd.DataFrame,
+    poi_json_file_paths: List,
+    output_dir: str,
+    proximity_radius_m: float = 100,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    store: Optional[StagingStore] = None,
+    category_workers: int = 1,
+) -> pd.DataFrame:
+
+    site_data_file_name = transform_site_data(
+        site_df=site_df, output_dir=output_dir, store=store
     )
 
-    ## Saving fuel stations POI data
-    fuel_station_poi_df_file_name = (
-        f"{fuel_station_poi_df.category.values[0]}_pois.parquet"
+    (
+        fast_food_poi_df_file_name,
+        fuel_station_poi_df_file_name,
+        supermarket_poi_df_file_name,
+    ) = transform_poi_data(
+        poi_json_file_paths=poi_json_file_paths,
+        output_dir=output_dir,
+        read_workers=read_workers,
+        read_chunk_size=read_chunk_size,
+        store=store,
+        category_workers=category_workers,
     )
-    save_intermediete_data(
-        df=fuel_station_poi_df,
+
+    proximity_data_file_name = build_proximity_data(
         output_dir=output_dir,
-        file_name=fuel_station_poi_df_file_name,
+        proximity_radius_m=proximity_radius_m,
+        store=store,
+        category_workers=category_workers,
     )
 
-    ## Saving supermarket POI data
-    supermarket_poi_df_file_name = (
-        f"{supermarket_poi_df.category.values[0]}_pois.parquet"
+    return (
+        site_data_file_name,
+        fast_food_poi_df_file_name,
+        fuel_station_poi_df_file_name,
+        supermarket_poi_df_file_name,
+        proximity_data_file_name,
     )
-    save_intermediete_data(
-        df=supermarket_poi_df,
-        output_dir=output_dir,
-        file_name=supermarket_poi_df_file_name,
+
+
+def locate_staged_sites(
+    output_dir: str, site_ids: List, site_locations: Optional[pd.DataFrame] = None
+) -> pd.DataFrame:
+    ## 'site_id', 'lat' and 'lon' of staged sites, from `site_locations`
+    ## where known, the others are looked up by id in the site dataset
+    site_ids = set(site_ids)
+    if site_locations is None:
+        site_locations = pd.DataFrame(columns=["site_id", "lat", "lon"])
+    site_locations = site_locations[site_locations["site_id"].isin(site_ids)]
+
+    unknown_site_ids = sorted(site_ids - set(site_locations["site_id"]))
+    if not unknown_site_ids:
+        return site_locations
+    staged_locations = read_staging_data(
+        output_dir,
+        SITE_STAGING_DATASET,
+        columns=["site_id", "lat", "lon"],
+        filters=[("site_id", "in", unknown_site_ids)],
     )
+    return pd.concat([site_locations, staged_locations], ignore_index=True)
 
-    ## Saving cleaned site data
-    site_data_file_name = "site_data.parquet"
-    save_intermediete_data(
-        df=site_df, output_dir=output_dir, file_name=site_data_file_name
+
+def upsert_staged_pois(
+    fetched_poi_df: pd.DataFrame,
+    changed_site_df: pd.DataFrame,
+    output_dir: str,
+    category: str,
+    fetch_radius_m: float,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Merges the POIs of one category fetched around `changed_site_df` into the
+    staging tiles they touch: the tiles within `fetch_radius_m` of the changed
+    sites and the tiles of the fetched POIs and of their staged versions.
+    Only those tiles are read and rewritten.
+
+    A fetched POI has changed when it is new or when its location or tags
+    differ from the staged version. A staged POI within `fetch_radius_m` of a
+    changed site that the fetch did not return is gone and removed.
+
+    Returns:
+        The locations of the POIs in the rewritten tiles, the new locations of
+        the changed POIs, and the new and old locations of the changed and
+        removed POIs.
+    """
+    dataset_name = POI_STAGING_DATASETS[category]
+    key = ["type", "poi_id"]
+
+    ## Staged versions of the fetched POIs can lie in other tiles, the
+    ## dataset is sorted by 'poi_id' so the lookup skips most row groups
+    previous_tiles = read_staging_data(
+        output_dir,
+        dataset_name,
+        columns=["tile"],
+        filters=[("poi_id", "in", fetched_poi_df["poi_id"].unique().tolist())],
+    )
+    tiles = sorted(
+        set(tiles_within(changed_site_df, fetch_radius_m, tile_deg=STAGING_TILE_DEG))
+        | set(assign_tiles(fetched_poi_df, tile_deg=STAGING_TILE_DEG))
+        | set(previous_tiles.get("tile", []))
+    )
+    staged_poi_df = read_staging_data(
+        output_dir, dataset_name, filters=[("tile", "in", tiles)]
+    )
+
+    staged_keys = staged_poi_df.set_index(key).index
+    fetched_keys = fetched_poi_df.set_index(key).index
+    is_known = fetched_keys.isin(staged_keys)
+
+    ## Known POIs are compared on their location and tags, as objects so
+    ## that the dtypes of the staged and fetched columns do not matter
+    compared_columns = ["lat", "lon"] + sorted(
+        column
+        for column in set(staged_poi_df.columns) | set(fetched_poi_df.columns)
+        if column.startswith("tags.")
+    )
+    previous = (
+        staged_poi_df.set_index(key)
+        .reindex(index=fetched_keys[is_known], columns=compared_columns)
+        .astype(object)
+    )
+    current = (
+        fetched_poi_df.set_index(key)
+        .reindex(index=fetched_keys[is_known], columns=compared_columns)
+        .astype(object)
+    )
+    is_same = ((previous == current) | (previous.isna() & current.isna())).all(axis=1)
+    is_changed = ~is_known
+    is_changed[is_known] = ~is_same.to_numpy()
+
+    ## POIs that the fetch covered but did not return any more
+    is_missing = ~staged_keys.isin(fetched_keys)
+    reached_poi_ids = compute_distance_between_pois_sites(
+        all_poi_data=staged_poi_df.loc[is_missing, POI_LOCATION_COLUMNS],
+        site_data=changed_site_df,
+        radius_m=fetch_radius_m,
+    )["poi_id"]
+    is_removed = is_missing & staged_poi_df["poi_id"].isin(reached_poi_ids).to_numpy()
+
+    is_replaced = staged_keys.isin(fetched_keys[is_changed])
+    changed_poi_df = fetched_poi_df.loc[is_changed, POI_LOCATION_COLUMNS]
+    touched_poi_df = pd.concat(
+        [
+            changed_poi_df,
+            staged_poi_df.loc[is_replaced | is_removed, POI_LOCATION_COLUMNS],
+        ],
+        ignore_index=True,
     )
 
-    
-    staging_pois_files = glob(f"{output_dir}/*_pois.parquet")
-    common_columns = ["poi_id", "lat", "lon", "category"]
+    if is_changed.any() or is_removed.any():
+        poi_df = pd.concat(
+            [staged_poi_df[~is_replaced & ~is_removed], fetched_poi_df[is_changed]],
+            ignore_index=True,
+        )
+        save_poi_staging_data(
+            df=poi_df, output_dir=output_dir, category=category, partitions=tiles
+        )
+    else:
+        poi_df = staged_poi_df
 
-    all_pois_data = [
-        pd.read_parquet(file)[common_columns]
-        for file in staging_pois_files
+    logging.info(
+        f"(Transforms): {category}: {int((~is_known).sum())} new, "
+        f"{int(is_changed.sum() - (~is_known).sum())} changed and "
+        f"{int(is_removed.sum())} removed POIs in {len(tiles)} tiles."
+    )
+    return poi_df[POI_LOCATION_COLUMNS], changed_poi_df, touched_poi_df
+
+
+def incremental_transformation_pipeline(
+    changed_site_df: pd.DataFrame,
+    removed_site_ids: List,
+    poi_json_file_paths: List,
+    output_dir: str,
+    proximity_radius_m: float = 100,
+    read_workers: int = 1,
+    read_chunk_size: int = 512,
+    category_workers: int = 1,
+    removed_site_locations: Optional[pd.DataFrame] = None,
+    fetch_radius_m: Optional[float] = None,
+):
+    """
+    Merges new or moved sites and the raw POI files fetched for them into the
+    existing staging data in `output_dir` instead of rebuilding it. Only the
+    tiles of the changed and removed sites, of the POIs fetched for them and
+    of the sites near a changed POI are read and rewritten.
+
+    Moved and deleted sites are dropped from the site and proximity data (their
+    staged location is taken from `removed_site_locations` where known). The
+    fetched POIs are upserted into the category tables, see
+    `upsert_staged_pois`, with `fetch_radius_m` (default `proximity_radius_m`)
+    the radius the POIs were fetched out to, which covers the largest ring.
+    Proximities are computed for the changed sites against all POIs, and the
+    proximities of the changed and removed POIs are recomputed for the
+    unchanged sites. Unchanged sites within `fetch_radius_m` of a changed or
+    removed POI are returned as affected, so their rings are enriched again. POIs that no longer
+    cover any site stay in the staging tables, they do not match any site and
+    so do not affect the proximity data.
+
+    Returns:
+        The staging dataset names (as transformation_pipeline) and the ids of the
+        sites whose proximity or ring features changed.
+    """
+    if fetch_radius_m is None:
+        fetch_radius_m = proximity_radius_m
+
+    changed_site_df = prepare_site_data(site_df=changed_site_df)
+    changed_site_ids = set(changed_site_df["site_id"])
+    removed_site_ids = set(removed_site_ids)
+    replaced_site_ids = removed_site_ids | changed_site_ids
+    removed_site_df = locate_staged_sites(
+        output_dir, removed_site_ids, site_locations=removed_site_locations
+    )
+
+    ## Upserting the POIs of the new raw files
+    fetched_poi_dfs = read_raw_data(
+        poi_json_file_paths=poi_json_file_paths,
+        max_workers=read_workers,
+        chunk_size=read_chunk_size,
+    )
+
+    def upsert_category(category_poi_df):
+        category, fetched_poi_df = category_poi_df
+        return upsert_staged_pois(
+            fetched_poi_df=prepare_poi_data(df=fetched_poi_df),
+            changed_site_df=changed_site_df,
+            output_dir=output_dir,
+            category=category,
+            fetch_radius_m=fetch_radius_m,
+        )
+
+    ## The categories are upserted side by side, in category order
+    upserted = map_in_order(
+        upsert_category,
+        list(zip(POI_CATEGORIES, fetched_poi_dfs)),
+        max_workers=category_workers,
+        thread_name_prefix="upsert-category",
+    )
+    tile_pois_data, changed_pois_data, touched_pois_data = (
+        pd.concat(poi_dfs, ignore_index=True) for poi_dfs in zip(*upserted)
+    )
+
+    ## Updating site data, in the tiles of the changed and removed sites
+    site_tiles = set(assign_tiles(changed_site_df, tile_deg=STAGING_TILE_DEG)) | set(
+        assign_tiles(removed_site_df, tile_deg=STAGING_TILE_DEG)
+    )
+    ## Unchanged sites within `fetch_radius_m` of a changed POI, the
+    ## largest ring, are enriched again
+    tiles = sorted(
+        site_tiles
+        | set(tiles_within(touched_pois_data, fetch_radius_m, tile_deg=STAGING_TILE_DEG))
+    )
+    unchanged_site_df = read_staging_data(
+        output_dir, SITE_STAGING_DATASET, filters=[("tile", "in", tiles)]
+    )
+    unchanged_site_df = unchanged_site_df[
+        ~unchanged_site_df["site_id"].isin(replaced_site_ids)
     ]
-    all_pois_data = pd.concat(all_pois_data)
+    site_df = pd.concat([unchanged_site_df, changed_site_df], ignore_index=True)
+    site_tile_of_row = assign_tiles(site_df, tile_deg=STAGING_TILE_DEG)
+    save_staging_data(
+        df=site_df[site_tile_of_row.isin(site_tiles)],
+        output_dir=output_dir,
+        dataset_name=SITE_STAGING_DATASET,
+        tiles=site_tile_of_row[site_tile_of_row.isin(site_tiles)],
+        partitions=sorted(site_tiles),
+    )
 
+    ## Updating proximity data, in the tiles of the sites read
+    proximity_df = read_staging_data(
+        output_dir, PROXIMITY_STAGING_DATASET, filters=[("tile", "in", tiles)]
+    )
+    is_stale = proximity_df["site_id"].isin(replaced_site_ids) | pd.MultiIndex.from_frame(
+        proximity_df[["poi_id", "category"]].astype(object)
+    ).isin(
+        pd.MultiIndex.from_frame(touched_pois_data[["poi_id", "category"]].astype(object))
+    )
 
-    ## Creating proximity relationship dataset between site and POI
-    proximity_df = compute_distance_between_pois_sites(
-        all_poi_data=all_pois_data, site_data=site_df
+    changed_proximity_df = compute_distance_between_pois_sites(
+        all_poi_data=tile_pois_data,
+        site_data=changed_site_df,
+        radius_m=proximity_radius_m,
+    )
+    added_proximity_df = compute_distance_between_pois_sites(
+        all_poi_data=changed_pois_data,
+        site_data=unchanged_site_df,
+        radius_m=proximity_radius_m,
+    )
+    touched_proximity_df = compute_distance_between_pois_sites(
+        all_poi_data=touched_pois_data,
+        site_data=unchanged_site_df,
+        radius_m=fetch_radius_m,
     )
 
-    ## Saving proximity data
-    proximity_data_file_name = "site_pois_proximities.parquet"
-    save_intermediete_data(
-        df=proximity_df,
+    proximity_df = pd.concat(
+        [proximity_df[~is_stale], changed_proximity_df, added_proximity_df],
+        ignore_index=True,
+    ).drop_duplicates(subset=["site_id", "poi_id", "category"])
+    save_proximity_staging_data(
+        proximity_df=proximity_df,
+        site_df=site_df,
         output_dir=output_dir,
-        file_name=proximity_data_file_name,
+        partitions=tiles,
     )
 
-    return (
-        site_data_file_name,
-        fast_food_poi_df_file_name,
-        fuel_station_poi_df_file_name,
-        supermarket_poi_df_file_name,
-        proximity_data_file_name,
+    affected_site_ids = changed_site_ids | set(touched_proximity_df["site_id"])
+    logging.info(
+        f"(Transforms): Incrementally updated staging data for {len(affected_site_ids)} sites "
+        f"in {len(tiles)} tiles."
     )
+
+    return (
+        SITE_STAGING_DATASET,
+        POI_STAGING_DATASETS["fast_food"],
+        POI_STAGING_DATASETS["fuel"],
+        POI_STAGING_DATASETS["supermarket"],
+        PROXIMITY_STAGING_DATASET,
+    ), sorted(affected_site_ids)
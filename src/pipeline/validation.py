@@ -0,0 +1,86 @@
+import logging
+import numpy as np
+import pandas as pd
+from typing import Dict, Tuple
+
+COORDINATE_RANGES = {"lat": (-90.0, 90.0), "lon": (-180.0, 180.0)}
+
+GERMANY_BOUNDS = {
+    "lat_min": 47.2,
+    "lat_max": 55.1,
+    "lon_min": 5.9,
+    "lon_max": 15.0,
+}
+
+
+NUMBER_PATTERN = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+GEO_COORDINATES_PATTERN = (
+    rf"\s*\[\s*{NUMBER_PATTERN}\s*,\s*{NUMBER_PATTERN}\s*\]\s*"
+)
+
+
+def parse_geo_coordinates(geo_coordinates: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """
+    Parses stringified '[longitude, latitude]' values without evaluating every
+    string: well-formed values are picked with one vectorized regex match and
+    their numbers are parsed by NumPy in a single pass over the column.
+
+    Args:
+        geo_coordinates (pd.Series): Strings such as '[10.07688,53.57944]'.
+
+    Returns:
+        Tuple[pd.Series, pd.Series]: Float longitude and latitude, NaN where the
+                                     value could not be parsed.
+    """
+    geo_coordinates = geo_coordinates.astype(str)
+    well_formed = geo_coordinates.str.fullmatch(
+        GEO_COORDINATES_PATTERN, na=False
+    ).to_numpy(dtype=bool)
+
+    numbers = ",".join(
+        geo_coordinates[well_formed].str.strip().str.strip("[]").tolist()
+    )
+    coordinates = np.full((len(geo_coordinates), 2), np.nan)
+    if numbers:
+        coordinates[well_formed] = np.array(
+            numbers.split(","), dtype=float
+        ).reshape(-1, 2)
+
+    num_unparsable = int((~well_formed).sum())
+    if num_unparsable:
+        logging.warning(
+            f"(Validation): {num_unparsable} geoCoordinates values could not be parsed."
+        )
+
+    lon = pd.Series(coordinates[:, 0], index=geo_coordinates.index)
+    lat = pd.Series(coordinates[:, 1], index=geo_coordinates.index)
+    return lon, lat
+
+
+def validate_coordinates(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Range-checks the 'lat' and 'lon' columns with array masks. Values that are
+    missing, not numeric or out of range are set to NaN, and the number of
+    rejected rows is logged once per column.
+    """
+    for column, (low, high) in COORDINATE_RANGES.items():
+        values = pd.to_numeric(df[column], errors="coerce").astype(float)
+        valid = values.between(low, high)
+
+        num_rejected = int((~valid).sum())
+        if num_rejected:
+            logging.critical(
+                f"(Validation): Rejected {num_rejected} invalid '{column}' values."
+            )
+
+        df[column] = values.where(valid, np.nan)
+    return df
+
+
+def within_bounds(df: pd.DataFrame, bounds: Dict = GERMANY_BOUNDS) -> pd.Series:
+    return (
+        (df["lat"] >= bounds["lat_min"])
+        & (df["lat"] <= bounds["lat_max"])
+        & (df["lon"] >= bounds["lon_min"])
+        & (df["lon"] <= bounds["lon_max"])
+    )
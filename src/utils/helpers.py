@@ -1,48 +1,41 @@
 import os
 import re
-import json
 import logging
+import contextvars
 import numpy as np
 import pandas as pd
-from typing import Dict
-def extract_cluster_bounding_boxes_dict(df: pd.DataFrame) -> Dict:
-    cluster_boxes = {}
-    buffer = 0.003
-
-    for cluster_id in sorted(df["cluster"].unique()):
-        if cluster_id == -1:
-            continue
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from src.utils.instrumentation import record_io
+from src.pipeline.schema import apply_dtype_policy
+from src.pipeline.query_planner import padded_bounds
 
-        cluster_points = df[df["cluster"] == cluster_id]
-        min_lat = cluster_points["lat"].min() - buffer
-        max_lat = cluster_points["lat"].max() + buffer
-        min_lon = cluster_points["lon"].min() - buffer
-        max_lon = cluster_points["lon"].max() + buffer
 
-        cluster_boxes[cluster_id] = {
-            "min_lat": min_lat,
-            "min_lon": min_lon,
-            "max_lat": max_lat,
-            "max_lon": max_lon,
-        }
-
-    return cluster_boxes
+def extract_cluster_bounding_boxes_dict(df: pd.DataFrame, radius_m: float = 100) -> Dict:
+    ## Boxes are grown by at least `radius_m` on every side, so they hold
+    ## every POI within `radius_m` of their sites
+    buffer = 0.003
 
-def save_cluster_pois(all_pois: Dict, output_dir: str):
-    os.makedirs(output_dir, exist_ok=True)
-    
-    for cluster_id, pois in all_pois.items():
-        file_path = os.path.join(output_dir, f"cluster_{cluster_id}.json")
-        with open(file_path, "w") as file:
-            json.dump(pois, file)
+    cluster_points = df[df["cluster"] != -1]
+    bounds = cluster_points.groupby("cluster").agg(
+        min_lat=("lat", "min"),
+        min_lon=("lon", "min"),
+        max_lat=("lat", "max"),
+        max_lon=("lon", "max"),
+    )
+    bounds["min_lat"], bounds["min_lon"], bounds["max_lat"], bounds["max_lon"] = (
+        padded_bounds(
+            bounds["min_lat"],
+            bounds["min_lon"],
+            bounds["max_lat"],
+            bounds["max_lon"],
+            radius_m,
+            min_pad_deg=buffer,
+        )
+    )
 
-def save_site_pois(all_pois: Dict, output_dir: str):
-    os.makedirs(output_dir, exist_ok=True)
-    
-    for site_id, pois in all_pois.items():
-        file_path = os.path.join(output_dir, f"site_{site_id}.json")
-        with open(file_path, "w") as file:
-            json.dump(pois, file)
+    return bounds.to_dict(orient="index")
 
 
 def save_intermediete_data(
@@ -55,17 +48,42 @@ def save_intermediete_data(
         logging.info(f"Succesfully saved file: {output_dir}/{file_name}")
 
     if "parquet" in file_name:
-        df.to_parquet(f"{output_dir}/{file_name}", index=False)
-        print(f"Succesfully saved file: {output_dir}/{file_name}")
+        apply_dtype_policy(df).to_parquet(f"{output_dir}/{file_name}", index=False)
+        logging.info(f"Succesfully saved file: {output_dir}/{file_name}")
+
+    record_io(bytes_written=os.path.getsize(f"{output_dir}/{file_name}"))
 
 
 def read_intermediate_data(file_path: str) -> pd.DataFrame:
+    record_io(bytes_read=os.path.getsize(file_path))
     if ".csv" in file_path:
         return pd.read_csv(file_path)
     if ".parquet" in file_path:
         return pd.read_parquet(file_path)
     
 
+def map_in_order(
+    func: Callable, items: List, max_workers: int = 1, thread_name_prefix: str = "worker"
+) -> List:
+    """
+    `func` applied to every item, on up to `max_workers` threads. The results
+    are in the order of `items` whichever call finishes first, and every call
+    runs in a copy of the caller's context so its I/O is recorded in the
+    caller's span. With one worker the items are processed in this thread.
+    """
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(items)), thread_name_prefix=thread_name_prefix
+    ) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, func, item)
+            for item in items
+        ]
+        return [future.result() for future in futures]
+
+
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371000
     phi1 = np.radians(lat1)
@@ -80,15 +98,68 @@ def haversine(lat1, lon1, lat2, lon2):
     return 2 * R * np.arcsin(np.sqrt(a))
 
 
+def split_pois_by_site(
+    elements: List, site_ids: List, lats: List, lons: List, radius: float = 100
+) -> Dict:
+    """
+    Splits the elements returned by a batched around query back to the sites of
+    the batch. An element is assigned to every site within `radius` meters of
+    its coordinates (the 'center' for ways), the same point the silver layer
+    later uses to compute proximities. Overpass matches ways by their geometry,
+    so a large way can come back with its center outside the radius; such
+    elements are assigned to the nearest site of the batch instead.
+
+    Returns:
+        Dict: Mapping of every site id to its list of elements.
+    """
+    pois_by_site = {site_id: [] for site_id in site_ids}
+    if not elements:
+        return pois_by_site
+
+    poi_lats = np.array(
+        [e.get("lat", e.get("center", {}).get("lat", np.nan)) for e in elements],
+        dtype=float,
+    )
+    poi_lons = np.array(
+        [e.get("lon", e.get("center", {}).get("lon", np.nan)) for e in elements],
+        dtype=float,
+    )
+
+    ## (sites x elements) distance matrix, batches are small
+    distances = haversine(
+        np.asarray(lats, dtype=float)[:, None],
+        np.asarray(lons, dtype=float)[:, None],
+        poi_lats[None, :],
+        poi_lons[None, :],
+    )
+
+    within_radius = distances <= radius
+    unmatched = ~within_radius.any(axis=0) & ~np.isnan(distances).all(axis=0)
+    nearest_site = np.argmin(
+        np.where(np.isnan(distances), np.inf, distances), axis=0
+    )
+    within_radius[nearest_site[unmatched], np.flatnonzero(unmatched)] = True
+
+    for site_idx, site_id in enumerate(site_ids):
+        pois_by_site[site_id] = [
+            elements[i] for i in np.flatnonzero(within_radius[site_idx])
+        ]
+    return pois_by_site
+
+
+OPEN_24_7_PATTERNS = [
+    re.compile(r"\bmo-su\b.*00:00[-–]24:00"),
+    re.compile(r"\bmo-su\b.*24:00"),
+    re.compile(r"\b00:00[-–]24:00\b"),
+]
+
+
+@lru_cache(maxsize=65536)
 def is_open_24_7(value):
+    ## Memoized, POIs share a small set of opening hours
     if not isinstance(value, str):
         return False
     val = value.strip().lower()
     if "24/7" in val:
         return True
-    patterns = [
-        r"\bmo-su\b.*00:00[-–]24:00",
-        r"\bmo-su\b.*24:00",
-        r"\b00:00[-–]24:00\b"
-    ]
-    return any(re.search(p, val) for p in patterns)
\ No newline at end of file
+    return any(pattern.search(val) for pattern in OPEN_24_7_PATTERNS)
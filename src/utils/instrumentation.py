@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import cProfile
+import logging
+import resource
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+## Innermost open span of the current thread / task. Worker threads only see
+## it when they are started through `contextvars.copy_context().run`.
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        ## Outside Linux only the peak of the whole process is known
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span:
+    """
+    One timed unit of work. Rows are counted by the code inside the span,
+    bytes read and written are added to the innermost open span and rolled
+    up into its parents when it closes.
+    """
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.status = "ok"
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration_s = None
+        self.start_rss_bytes = current_rss_bytes()
+        self.peak_rss_bytes = self.start_rss_bytes
+        self.lock = threading.Lock()
+
+    def add(
+        self,
+        rows_in: int = 0,
+        rows_out: int = 0,
+        bytes_read: int = 0,
+        bytes_written: int = 0,
+    ) -> None:
+        with self.lock:
+            self.rows_in += int(rows_in)
+            self.rows_out += int(rows_out)
+            self.bytes_read += int(bytes_read)
+            self.bytes_written += int(bytes_written)
+
+    def set(self, **attributes) -> None:
+        with self.lock:
+            self.attributes.update(attributes)
+
+    def observe_rss(self, rss_bytes: int) -> None:
+        with self.lock:
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss_bytes)
+
+    @property
+    def path(self) -> str:
+        return self.name if self.parent is None else f"{self.parent.path}/{self.name}"
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_s": round(self.duration_s, 6),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "start_rss_mb": round(self.start_rss_bytes / 1024 / 1024, 1),
+            "peak_rss_mb": round(self.peak_rss_bytes / 1024 / 1024, 1),
+            "attributes": self.attributes,
+        }
+
+
+class Instrumentation:
+    """
+    Records spans for a pipeline run and writes them as a JSON run report and
+    as a Prometheus textfile (for the node exporter textfile collector).
+
+    Peak memory is the resident set size of the process sampled every
+    `sample_interval_s` while a span is open, so spans running concurrently
+    share the same samples.
+
+    Stages listed in `profile_stages` run under cProfile and their stats are
+    dumped to `{profile_dir}/{stage}.prof`. Every span also renames its thread
+    after the stage, so `py-spy dump --pid <pid>` shows which stage a thread
+    is in.
+    """
+
+    def __init__(self, sample_interval_s: float = 0.01):
+        self.sample_interval_s = sample_interval_s
+        self.profile_stages = set()
+        self.profile_dir = "."
+        self.spans = []
+        self.open_spans = set()
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.started_at = time.time()
+
+    def configure(
+        self,
+        profile_stages: Optional[List[str]] = None,
+        profile_dir: Optional[str] = None,
+        max_spans: Optional[int] = None,
+    ) -> None:
+        self.profile_stages = set(profile_stages or [])
+        if profile_dir is not None:
+            self.profile_dir = profile_dir
+        ## Long-running processes only keep their latest spans
+        if max_spans is not None:
+            with self.lock:
+                self.spans = deque(self.spans, maxlen=max_spans)
+
+    def _sample_rss(self) -> None:
+        while True:
+            time.sleep(self.sample_interval_s)
+            with self.lock:
+                open_spans = list(self.open_spans)
+            if open_spans:
+                rss_bytes = current_rss_bytes()
+                for open_span in open_spans:
+                    open_span.observe_rss(rss_bytes)
+
+    def _start_sampler(self) -> None:
+        with self.lock:
+            if self.sampler is None:
+                self.sampler = threading.Thread(
+                    target=self._sample_rss, name="rss-sampler", daemon=True
+                )
+                self.sampler.start()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        self._start_sampler()
+        new_span = Span(name, parent=_current_span.get(), attributes=attributes)
+        token = _current_span.set(new_span)
+        with self.lock:
+            self.open_spans.add(new_span)
+
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = f"{thread_name}:{name}"
+
+        profiler = None
+        if name in self.profile_stages:
+            logging.info(
+                f"(Instrumentation): Profiling '{name}' (pid={os.getpid()}, thread={thread.name})."
+            )
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            yield new_span
+        except BaseException:
+            new_span.status = "error"
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profile_path = os.path.join(self.profile_dir, f"{name}.prof")
+                profiler.dump_stats(profile_path)
+                logging.info(f"(Instrumentation): Saved the profile of '{name}' to {profile_path}.")
+
+            thread.name = thread_name
+            new_span.duration_s = time.perf_counter() - new_span.start
+            new_span.observe_rss(current_rss_bytes())
+            _current_span.reset(token)
+
+            if new_span.parent is not None:
+                new_span.parent.add(
+                    bytes_read=new_span.bytes_read,
+                    bytes_written=new_span.bytes_written,
+                )
+                new_span.parent.observe_rss(new_span.peak_rss_bytes)
+            with self.lock:
+                self.open_spans.discard(new_span)
+                self.spans.append(new_span)
+
+    def record_io(self, bytes_read: int = 0, bytes_written: int = 0) -> None:
+        open_span = _current_span.get()
+        if open_span is not None:
+            open_span.add(bytes_read=bytes_read, bytes_written=bytes_written)
+
+    def stage_summary(self) -> Dict:
+        """
+        Aggregates the finished spans by name: durations, rows and bytes are
+        summed (a stage that ran once per tile shows up once), peak memory is
+        the maximum.
+        """
+        summary = {}
+        with self.lock:
+            spans = list(self.spans)
+
+        for finished_span in spans:
+            stage = summary.setdefault(
+                finished_span.name,
+                {
+                    "count": 0,
+                    "errors": 0,
+                    "duration_s": 0.0,
+                    "rows_in": 0,
+                    "rows_out": 0,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "peak_rss_mb": 0.0,
+                },
+            )
+            stage["count"] += 1
+            stage["errors"] += finished_span.status == "error"
+            stage["duration_s"] += finished_span.duration_s
+            stage["rows_in"] += finished_span.rows_in
+            stage["rows_out"] += finished_span.rows_out
+            stage["bytes_read"] += finished_span.bytes_read
+            stage["bytes_written"] += finished_span.bytes_written
+            stage["peak_rss_mb"] = max(
+                stage["peak_rss_mb"], finished_span.peak_rss_bytes / 1024 / 1024
+            )
+
+        for stage in summary.values():
+            stage["duration_s"] = round(stage["duration_s"], 6)
+            stage["peak_rss_mb"] = round(stage["peak_rss_mb"], 1)
+        return summary
+
+    def report(self) -> Dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.started_at)
+        return {
+            "run": {
+                "pid": os.getpid(),
+                "started_at": self.started_at,
+                "duration_s": round(time.time() - self.started_at, 3),
+                "max_rss_mb": round(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+                ),
+            },
+            "stages": self.stage_summary(),
+            "spans": [s.to_dict() for s in spans],
+        }
+
+    @staticmethod
+    def _write_atomic(path: str, content: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+    def write_json(self, path: str) -> None:
+        self._write_atomic(path, json.dumps(self.report(), indent=2, default=str))
+        logging.info(f"(Instrumentation): Saved the run report to {path}.")
+
+    def to_prometheus(self, prefix: str = "poi_pipeline") -> str:
+        metrics = [
+            ("runs_total", "count", "counter", "Number of times the stage ran."),
+            ("errors_total", "errors", "counter", "Number of times the stage failed."),
+            ("duration_seconds", "duration_s", "gauge", "Wall time spent in the stage."),
+            ("rows_in_total", "rows_in", "counter", "Rows the stage read."),
+            ("rows_out_total", "rows_out", "counter", "Rows the stage produced."),
+            ("bytes_read_total", "bytes_read", "counter", "Bytes the stage read from disk or the network."),
+            ("bytes_written_total", "bytes_written", "counter", "Bytes the stage wrote."),
+            ("peak_rss_bytes", "peak_rss_mb", "gauge", "Peak resident memory of the process during the stage."),
+        ]
+        summary = self.stage_summary()
+
+        lines = []
+        for suffix, key, metric_type, description in metrics:
+            name = f"{prefix}_stage_{suffix}"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for stage, values in sorted(summary.items()):
+                value = values[key]
+                if key == "peak_rss_mb":
+                    value = int(value * 1024 * 1024)
+                lines.append(f'{name}{{stage="{stage}"}} {value}')
+
+        report = self.report()["run"]
+        lines += [
+            f"# HELP {prefix}_run_duration_seconds Wall time of the run.",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration_s']}",
+            f"# HELP {prefix}_run_max_rss_bytes Peak resident memory of the run.",
+            f"# TYPE {prefix}_run_max_rss_bytes gauge",
+            f"{prefix}_run_max_rss_bytes {int(report['max_rss_mb'] * 1024 * 1024)}",
+            f"# HELP {prefix}_run_timestamp_seconds Time the run finished.",
+            f"# TYPE {prefix}_run_timestamp_seconds gauge",
+            f"{prefix}_run_timestamp_seconds {round(time.time(), 3)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        self._write_atomic(path, self.to_prometheus())
+        logging.info(f"(Instrumentation): Saved the Prometheus metrics to {path}.")
+
+
+INSTRUMENTATION = Instrumentation()
+span = INSTRUMENTATION.span
+record_io = INSTRUMENTATION.record_io